@@ -4,6 +4,17 @@ import math
 import numpy as np
 from slicer.ScriptedLoadableModule import *
 import logging
+import threading
+import hashlib
+import collections
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+from SkullMarkerLib import detectBoneSurfaceDepths, FiducialPointGrid, fiducialScanlineNumbers
+from SkullMarkerLib import sequenceImageToReference, writePointCloud, detectSequenceBoneSurfacePoints
+from USGeometryLib import ScanlineSampler
+from USGeometryLib.Profiling import Profiler, profiledMethod
 
 
 #
@@ -94,6 +105,20 @@ class SkullMarkerWidget(ScriptedLoadableModuleWidget):
       "Select the fiducial list which will contain fiducials marking bone surfaces along scanlines")
     inputsFormLayout.addRow("Fiducials points: ", self.fiducialSelector)
 
+    #
+    # Point cloud model selector
+    #
+    self.pointCloudSelector = slicer.qMRMLNodeComboBox()
+    self.pointCloudSelector.nodeTypes = (("vtkMRMLModelNode"), "")
+    self.pointCloudSelector.noneEnabled = True
+    self.pointCloudSelector.addEnabled = True
+    self.pointCloudSelector.removeEnabled = True
+    self.pointCloudSelector.renameEnabled = True
+    self.pointCloudSelector.setMRMLScene(slicer.mrmlScene)
+    self.pointCloudSelector.setToolTip(
+      "Optional model that collects bone surface points as a point cloud instead of the fiducial list, for very many points")
+    inputsFormLayout.addRow("Point cloud model: ", self.pointCloudSelector)
+
     #
     # Number of scanlines selector
     #
@@ -139,6 +164,40 @@ class SkullMarkerWidget(ScriptedLoadableModuleWidget):
     self.thresholdSlider.setValue(200)
     inputsFormLayout.addRow("Bone surface threshold: ", self.thresholdSlider)
 
+    #
+    # Background processing checkbox
+    #
+    self.backgroundProcessingCheckBox = qt.QCheckBox()
+    self.backgroundProcessingCheckBox.checked = False
+    self.backgroundProcessingCheckBox.setToolTip("Detect bone surface points on a worker thread, dropping the oldest frames when detection falls behind.")
+    inputsFormLayout.addRow("Process frames in background: ", self.backgroundProcessingCheckBox)
+
+    #
+    # Frame skipping checkbox
+    #
+    self.skipUnchangedFramesCheckBox = qt.QCheckBox()
+    self.skipUnchangedFramesCheckBox.checked = False
+    self.skipUnchangedFramesCheckBox.setToolTip("Skip frames that are duplicates of the previous frame, or taken while the probe is not moving.")
+    inputsFormLayout.addRow("Skip unchanged frames: ", self.skipUnchangedFramesCheckBox)
+
+    #
+    # Frames per output update
+    #
+    self.framesPerUpdate = qt.QSpinBox()
+    self.framesPerUpdate.setMinimum(1)
+    self.framesPerUpdate.setMaximum(100)
+    self.framesPerUpdate.setValue(1)
+    self.framesPerUpdate.setToolTip("Accepted points of this many frames are added to the output in one update.")
+    inputsFormLayout.addRow("Frames per output update: ", self.framesPerUpdate)
+
+    #
+    # Profiling checkbox
+    #
+    self.profilingCheckBox = qt.QCheckBox()
+    self.profilingCheckBox.checked = False
+    self.profilingCheckBox.setToolTip("Time each processing stage and count processed, skipped and dropped frames. The summary is shown when fiducial placement stops.")
+    inputsFormLayout.addRow("Profile processing: ", self.profilingCheckBox)
+
     #
     # Inputs Area
     #
@@ -171,12 +230,21 @@ class SkullMarkerWidget(ScriptedLoadableModuleWidget):
     self.messageLabel = qt.QLabel()
     functionsFormLayout.addRow(self.messageLabel)
 
+    #
+    # Save profiling summary button
+    #
+    self.saveProfileButton = qt.QPushButton("Save profiling summary")
+    self.saveProfileButton.toolTip = "Saves the stage latencies and frame counters of the last profiled fiducial placement as JSON."
+    functionsFormLayout.addRow(self.saveProfileButton)
+
 
     # connections
     self.fiducialPlacementButton.connect('clicked(bool)', self.onFiducialPlacementButton)
+    self.saveProfileButton.connect('clicked(bool)', self.onSaveProfileButton)
     self.configureParametersButton.connect('clicked(bool)', self.onConfigureParametersButton)
     self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onInputSelect)
     self.fiducialSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onInputSelect)
+    self.pointCloudSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onInputSelect)
     self.configFileButton.connect('clicked(bool)', self.selectFile)
     self.startingDepthMM.connect('valueChanged(int)', self.validateStartingDepth)
     self.endingDepthMM.connect('valueChanged(int)', self.validateEndingDepth)
@@ -208,7 +276,12 @@ class SkullMarkerWidget(ScriptedLoadableModuleWidget):
     if self.fiducialPlacementButton.isChecked() == False:
       self.logic.stopTrackingVolumeChanges(self.inputSelector.currentNode())
       self.fiducialPlacementButton.setText("Start fiducial placement")
-      self.messageLabel.setText('')
+      message = ''
+      if self.logic.frameGateEnabled:
+        message = 'Skipped {} unchanged frames'.format(self.logic.skippedFrames)
+      if self.logic.profiler.enabled:
+        message = '\n'.join([line for line in [message, self.logic.profiler.summaryText()] if line])
+      self.messageLabel.setText(message)
       return
 
     if len(self.configFile.text) < 4:
@@ -216,6 +289,9 @@ class SkullMarkerWidget(ScriptedLoadableModuleWidget):
       self.fiducialPlacementButton.setChecked(False)
       return
 
+    # Enabled before the geometry is imported, so that the setup of the USGeometry logic is timed too
+    self.logic.profiler.setEnabled(self.profilingCheckBox.checked)
+    self.logic.profiler.reset()
     success = self.logic.importGeometry(self.configFile.text, self.inputSelector.currentNode())
     if success == False:
       logging.info('Could not load ultrasound geometry!')
@@ -224,16 +300,21 @@ class SkullMarkerWidget(ScriptedLoadableModuleWidget):
       return
 
     selectedFiducialNode = self.fiducialSelector.currentNode()
-    if selectedFiducialNode == None:
+    selectedPointCloudNode = self.pointCloudSelector.currentNode()
+    if selectedFiducialNode == None and selectedPointCloudNode == None:
       self.messageLabel.setText('Select output fiducial list!')
       self.fiducialPlacementButton.setChecked(False)
       return
 
     self.logic.setFiducialNode(selectedFiducialNode)
+    self.logic.setPointCloudModelNode(selectedPointCloudNode)
+    self.logic.setFramesPerOutputUpdate(self.framesPerUpdate.value)
     self.logic.setMinMaxDepth(self.startingDepthMM.value, self.endingDepthMM.value)
     self.logic.setThreshold(self.thresholdSlider.value)
     self.logic.setMinimumDistanceBetween(self.minimumDistanceBetweenPointsMM.value)
     self.logic.setFiducialArray()
+    self.logic.setBackgroundProcessing(self.backgroundProcessingCheckBox.checked)
+    self.logic.setFrameGate(self.skipUnchangedFramesCheckBox.checked)
 
     # Validate the number of scanlines
     if (self.scanlineNumber.value > self.logic.usGeometryLogic.numberOfScanlines):
@@ -255,6 +336,12 @@ class SkullMarkerWidget(ScriptedLoadableModuleWidget):
     self.messageLabel.setText('Scan skull surface...')
 
 
+  def onSaveProfileButton(self):
+    fileName = qt.QFileDialog().getSaveFileName(None, "Save profiling summary", "SkullMarkerProfile.json", "JSON files (*.json)")
+    if fileName:
+      self.logic.profiler.writeJson(fileName)
+
+
   def onConfigureParametersButton(self):
     logic = SkullMarkerLogic(self.configFile.text, self.inputSelector.currentNode(), self.fiducialSelector.currentNode(), self.startingDepthMM.value, self.endingDepthMM.value, self.minimumDistanceBetweenPointsMM.value)
 
@@ -316,11 +403,17 @@ class SkullMarkerWidget(ScriptedLoadableModuleWidget):
 #
 # SkullMarkerLogic
 #
+
+# Settings of bone surface detection, captured for every frame so that a worker thread is not affected when they change
+DetectionParameters = collections.namedtuple('DetectionParameters', ['scanlineSampler', 'startingDepthPixel', 'endingDepthPixel', 'threshold'])
+
 class SkullMarkerLogic(ScriptedLoadableModuleLogic):
 
   def __init__(self, parent = None):
     ScriptedLoadableModuleLogic.__init__(self, parent)
     self.fiducialScanlines = []
+    self.scanlineSampler = None
+    self.scanlineInterpolation = 'nearest'
     self.threshold = 0
     self.fiducialNodeId = None
     self.usGeometryLogic = None
@@ -328,10 +421,41 @@ class SkullMarkerLogic(ScriptedLoadableModuleLogic):
     self.maxDepthMm = 0
     self.threshold = 200
     self.minDistanceBetween = 0
-    self.fiducialArray = None
+    self.fiducialPoints = None
 
     self.volumeModifiedObserverTag = None
 
+    # Background processing of live frames
+    self.backgroundProcessing = False
+    self.maximumQueuedFrames = 4
+    self.dropOldestFrames = True
+    self.resultsIntervalMs = 100
+    self.maximumConsecutiveFailures = 5
+    self.workerStopTimeoutS = 0.2
+    self.frameQueue = None
+    self.resultQueue = None
+    self.workerThread = None
+    self.resultsTimer = None
+    self.pendingPoints = []
+    self.droppedFrames = 0
+    self.failedFrames = 0
+
+    # Batched output of accepted points
+    self.framesPerOutputUpdate = 1
+    self.framesSinceOutputUpdate = 0
+    self.pointCloudModelNodeId = None
+
+    # Skipping of unchanged live frames
+    self.frameGateEnabled = False
+    self.minimumTranslationMm = 0.5
+    self.minimumRotationDeg = 0.5
+    self.skipDuplicateFrames = True
+    self.frameHashDownsampling = 4
+    self.resetFrameGate()
+
+    # Stage timers and frame counters, shared with the USGeometry logic. Disabled until profiler.setEnabled(True)
+    self.profiler = Profiler()
+
 
   def importGeometry(self, configFile, inputVolume):
     if inputVolume == None:
@@ -344,6 +468,7 @@ class SkullMarkerLogic(ScriptedLoadableModuleLogic):
 
     import USGeometry
     self.usGeometryLogic = USGeometry.USGeometryLogic()
+    self.usGeometryLogic.profiler = self.profiler
 
     setupSuccess = self.usGeometryLogic.setup(configFile, inputVolume)
     if setupSuccess == False:
@@ -359,6 +484,31 @@ class SkullMarkerLogic(ScriptedLoadableModuleLogic):
       return
     self.fiducialNodeId = fiducialNode.GetID()
 
+  def setPointCloudModelNode(self, modelNode):
+    '''
+    :param modelNode: Model node that collects accepted points as vertices instead of the fiducial node, or None to use the fiducial node.
+      Rendering a point cloud stays fast for any number of points, unlike separate markups.
+    '''
+    if modelNode == None:
+      self.pointCloudModelNodeId = None
+      return
+    if modelNode.GetPolyData() == None or modelNode.GetPolyData().GetPoints() == None:
+      pointCloud = vtk.vtkPolyData()
+      pointCloud.SetPoints(vtk.vtkPoints())
+      pointCloud.SetVerts(vtk.vtkCellArray())
+      modelNode.SetAndObservePolyData(pointCloud)
+      if modelNode.GetDisplayNode() == None:
+        modelNode.CreateDefaultDisplayNodes()
+    self.pointCloudModelNodeId = modelNode.GetID()
+
+  def setFramesPerOutputUpdate(self, framesPerOutputUpdate):
+    '''
+    :param framesPerOutputUpdate: Accepted points of this many processed frames are added to the output node in one
+      modification, so that displays are updated once per batch instead of once per point. With background
+      processing the results timer adds the points instead.
+    '''
+    self.framesPerOutputUpdate = max(1, int(framesPerOutputUpdate))
+
   def setMinMaxDepth(self, minDepthMm, maxDepthMm):
     self.minDepthMm = minDepthMm
     self.maxDepthMm = maxDepthMm
@@ -370,38 +520,99 @@ class SkullMarkerLogic(ScriptedLoadableModuleLogic):
     self.threshold = t
 
   def setFiducialArray(self):
-    self.fiducialArray = None
+    self.fiducialPoints = None
 
   def computeFiducialScanlines(self, scanlineNumber):
-    # Find the middle scanline which will always be used
-    midScanlineNumber = (self.usGeometryLogic.numberOfScanlines - 1) / 2
-    midScanline = self.usGeometryLogic.scanlineEndPoints(midScanlineNumber)
-    self.fiducialScanlines.append(midScanline)
-
-    # Compute the interval between scanlines for even spacing
-    scanlinesPerHalf = scanlineNumber / 2  # How many scanlines there will be per half
-    scanlineInterval = 1
-    if (scanlinesPerHalf > 0):  # If only 1 scanline there will not be any interval since only middle scanline is used
-      scanlineInterval = midScanlineNumber / scanlinesPerHalf  # Number of scanlines to move between each scanline used for fiducials
-
-    # If there is an even number of scanlines an extra scanline will need to be added after loop to make up for offset
-    evenNumberOfScanlines = False
-    if (scanlineNumber % 2 == 0):
-      scanlinesPerHalf -= 1  # Decrease by one otherwise loop would result in an extra scanline
-      evenNumberOfScanlines = True
-    for i in range(scanlinesPerHalf):
-      # Compute and add scanline to right of middle
-      rightScanline = self.usGeometryLogic.scanlineEndPoints(midScanlineNumber + ((i + 1) * scanlineInterval))
-      self.fiducialScanlines.append(rightScanline)
-      # Compute and add scanline to left of middle
-      leftScanline = self.usGeometryLogic.scanlineEndPoints(midScanlineNumber - ((i + 1) * scanlineInterval))
-      self.fiducialScanlines.append(leftScanline)
-
-    # If there was an even number of scanlines, add the extra scanline
-    if (evenNumberOfScanlines):
-      additionalScanline = self.usGeometryLogic.scanlineEndPoints(
-        midScanlineNumber + ((scanlinesPerHalf + 1) * scanlineInterval))  # Added to right arbitrarily
-      self.fiducialScanlines.append(additionalScanline)
+    scanlineNumbers = fiducialScanlineNumbers(self.usGeometryLogic.numberOfScanlines, scanlineNumber)
+    [startPoints, endPoints] = self.usGeometryLogic.computeScanlineEndPoints(scanlineNumbers)
+    self.fiducialScanlines = [[list(startPoint), list(endPoint)] for startPoint, endPoint in zip(startPoints, endPoints)]
+    # Sample indices along the scanlines are computed once, so curvilinear probes cost the same per frame as linear ones
+    self.scanlineSampler = ScanlineSampler(startPoints, endPoints, self.usGeometryLogic.outputImageSizePixel[:2],
+      self.usGeometryLogic.outputImageSpacing, self.scanlineInterpolation)
+
+  def setScanlineInterpolation(self, interpolation):
+    '''
+    :param interpolation: 'nearest' or 'linear' sampling of the image along the fiducial scanlines.
+    '''
+    self.scanlineInterpolation = interpolation
+    if self.scanlineSampler is not None:
+      [startPoints, endPoints] = np.array(self.fiducialScanlines).transpose(1, 0, 2)
+      self.scanlineSampler = ScanlineSampler(startPoints, endPoints, self.usGeometryLogic.outputImageSizePixel[:2],
+        self.usGeometryLogic.outputImageSpacing, self.scanlineInterpolation)
+
+
+  def setFrameGate(self, enabled, minimumTranslationMm=0.5, minimumRotationDeg=0.5, skipDuplicateFrames=True):
+    '''
+    Configures skipping of live frames that cannot add new points.
+    :param enabled: Check frames before detection.
+    :param minimumTranslationMm: Frames are skipped while the image moved less than this distance
+      and rotated less than minimumRotationDeg since the last processed frame.
+    :param minimumRotationDeg: Rotation in degrees below which a frame counts as stationary.
+    :param skipDuplicateFrames: Skip frames whose downsampled image is identical to the previous frame (e.g. frozen stream).
+    '''
+    self.frameGateEnabled = enabled
+    self.minimumTranslationMm = minimumTranslationMm
+    self.minimumRotationDeg = minimumRotationDeg
+    self.skipDuplicateFrames = skipDuplicateFrames
+
+
+  def resetFrameGate(self):
+    self.skippedFrames = 0
+    self.previousFrameHash = None
+    self.lastProcessedIjkToRas = None
+
+
+  def isFrameChanged(self, frame, ijkToRas):
+    '''
+    :param frame: Image of the frame as a (rows, columns) array.
+    :param ijkToRas: 4x4 numpy array mapping image pixels to RAS.
+    :return: False if the frame should be skipped, and counts it in skippedFrames.
+    '''
+    if not self.frameGateEnabled:
+      return True
+
+    if self.skipDuplicateFrames:
+      frameHash = hashlib.md5(np.ascontiguousarray(frame[::self.frameHashDownsampling, ::self.frameHashDownsampling]).tobytes()).digest()
+      isDuplicate = (frameHash == self.previousFrameHash)
+      self.previousFrameHash = frameHash
+      if isDuplicate:
+        self.skippedFrames += 1
+        self.profiler.count('framesSkipped')
+        return False
+
+    if self.lastProcessedIjkToRas is not None:
+      translationMm = np.linalg.norm(ijkToRas[:3, 3] - self.lastProcessedIjkToRas[:3, 3])
+      # Rotation between the frames, with the pixel spacing removed from the matrix columns
+      rotation = ijkToRas[:3, :3] / np.linalg.norm(ijkToRas[:3, :3], axis=0)
+      lastRotation = self.lastProcessedIjkToRas[:3, :3] / np.linalg.norm(self.lastProcessedIjkToRas[:3, :3], axis=0)
+      cosAngle = (np.trace(lastRotation.T.dot(rotation)) - 1.0) / 2.0
+      rotationDeg = math.degrees(math.acos(min(1.0, max(-1.0, cosAngle))))
+      if translationMm < self.minimumTranslationMm and rotationDeg < self.minimumRotationDeg:
+        self.skippedFrames += 1
+        self.profiler.count('framesSkipped')
+        return False
+
+    self.lastProcessedIjkToRas = ijkToRas
+    return True
+
+
+  def setBackgroundProcessing(self, enabled, maximumQueuedFrames=4, dropOldestFrames=True, resultsIntervalMs=100, maximumConsecutiveFailures=5):
+    '''
+    Configures processing of live frames on a worker thread. The volume observer then only
+    snapshots each frame and the detection parameters into a bounded queue. The worker only detects
+    the bone surface points, a timer on the main thread checks their distances and adds the accepted
+    points to the fiducial node. Takes effect the next time tracking is started.
+    :param enabled: Process frames on a worker thread instead of inside the observer.
+    :param maximumQueuedFrames: Number of frames that may wait for the worker.
+    :param dropOldestFrames: When the queue is full, drop the oldest queued frame (True) or the new frame (False).
+    :param resultsIntervalMs: Interval of adding the accepted points to the fiducial node.
+    :param maximumConsecutiveFailures: Number of frames in a row that may fail detection before the worker stops.
+    '''
+    self.backgroundProcessing = enabled
+    self.maximumQueuedFrames = maximumQueuedFrames
+    self.dropOldestFrames = dropOldestFrames
+    self.resultsIntervalMs = resultsIntervalMs
+    self.maximumConsecutiveFailures = maximumConsecutiveFailures
 
 
   def startTrackingVolumeChanges(self, inputVolume):
@@ -409,6 +620,10 @@ class SkullMarkerLogic(ScriptedLoadableModuleLogic):
       logging.warning('None give instead of inputVolume')
       return
 
+    self.resetFrameGate()
+    self.framesSinceOutputUpdate = 0
+    if self.backgroundProcessing:
+      self.startBackgroundProcessing()
     self.volumeModifiedObserverTag = inputVolume.AddObserver('ModifiedEvent', self.onVolumeModified)
 
 
@@ -416,13 +631,176 @@ class SkullMarkerLogic(ScriptedLoadableModuleLogic):
     if self.volumeModifiedObserverTag != None:
       inputVolume.RemoveObserver(self.volumeModifiedObserverTag)
     self.volumeModifiedObserverTag = None
+    self.stopBackgroundProcessing()
+    self.addPendingFiducials()
+
+
+  def startBackgroundProcessing(self):
+    self.stopBackgroundProcessing()
+    self.droppedFrames = 0
+    self.failedFrames = 0
+    self.frameQueue = queue.Queue(self.maximumQueuedFrames)
+    self.resultQueue = queue.Queue()
+    self.pendingPoints = []
+    # The worker gets its own queues, so that a worker still finishing a frame after stopping cannot use the next ones
+    self.workerThread = threading.Thread(target=self.processQueuedFrames, args=(self.frameQueue, self.resultQueue), name='SkullMarkerWorker')
+    self.workerThread.daemon = True
+    self.workerThread.start()
+    self.resultsTimer = qt.QTimer()
+    self.resultsTimer.setInterval(self.resultsIntervalMs)
+    self.resultsTimer.connect('timeout()', self.addDetectedPoints)
+    self.resultsTimer.start()
+
+
+  def stopBackgroundProcessing(self):
+    if self.workerThread is None:
+      return
+    # Frames still queued are dropped, so that stopping only waits for the frame being processed. Only the main thread
+    # puts frames into the queue, so the stop signal always fits after emptying it
+    while True:
+      try:
+        self.frameQueue.get_nowait()
+      except queue.Empty:
+        break
+      self.droppedFrames += 1
+      self.profiler.count('framesDropped')
+    self.frameQueue.put_nowait(None)
+    self.workerThread.join(self.workerStopTimeoutS)
+    if self.workerThread.is_alive():
+      logging.warning('Background worker is still processing a frame, its points are dropped')
+    if self.failedFrames > 0:
+      logging.error('Bone surface detection failed on {0} frames'.format(self.failedFrames))
+    self.workerThread = None
+    self.frameQueue = None
+    self.resultsTimer.stop()
+    self.resultsTimer = None
+    self.addDetectedPoints()
+    self.resultQueue = None
+
+
+  def enqueueFrame(self, frame, ijkToRas):
+    '''
+    Queues a frame for the worker, with the current detection parameters.
+    '''
+    if not self.workerThread.is_alive():
+      # The worker stopped after repeated failures
+      self.droppedFrames += 1
+      self.profiler.count('framesDropped')
+      return
+    queuedFrame = (frame, ijkToRas, self.detectionParameters())
+    try:
+      self.frameQueue.put_nowait(queuedFrame)
+      return
+    except queue.Full:
+      pass
+    self.droppedFrames += 1
+    self.profiler.count('framesDropped')
+    if not self.dropOldestFrames:
+      return
+    try:
+      self.frameQueue.get_nowait()
+    except queue.Empty:
+      pass
+    try:
+      self.frameQueue.put_nowait(queuedFrame)
+    except queue.Full:
+      pass # The worker cannot have taken more than one frame, but never block the main thread
+
+
+  def processQueuedFrames(self, frameQueue, resultQueue):
+    '''
+    Worker thread loop. Only detects bone surface points with the parameters queued with each frame, and passes them
+    to the main thread in resultQueue, so that the collected points and the logic settings are only used by the main thread.
+    '''
+    consecutiveFailures = 0
+    while True:
+      queuedFrame = frameQueue.get()
+      if queuedFrame is None:
+        return
+      [frame, ijkToRas, detectionParameters] = queuedFrame
+      try:
+        rasBoneSurfacePoints = self.detectBoneSurfacePoints(frame, ijkToRas, detectionParameters)
+      except Exception:
+        logging.exception('Bone surface detection failed')
+        self.failedFrames += 1
+        self.profiler.count('framesFailed')
+        consecutiveFailures += 1
+        if consecutiveFailures >= self.maximumConsecutiveFailures:
+          logging.error('Stopping background processing after {0} failed frames in a row'.format(consecutiveFailures))
+          return
+        continue
+      consecutiveFailures = 0
+      resultQueue.put(rasBoneSurfacePoints)
+
+
+  def addDetectedPoints(self):
+    '''
+    Keeps the points detected by the worker that are far enough from the collected points, and adds them to the output.
+    Called by the results timer on the main thread.
+    '''
+    while True:
+      try:
+        rasBoneSurfacePoints = self.resultQueue.get_nowait()
+      except queue.Empty:
+        break
+      self.pendingPoints.extend(self.acceptBoneSurfacePoints(rasBoneSurfacePoints))
+    self.addPendingFiducials()
+
+
+  @profiledMethod('outputUpdate')
+  def addPendingFiducials(self):
+    [pendingPoints, self.pendingPoints] = [self.pendingPoints, []]
+    self.framesSinceOutputUpdate = 0
+    if len(pendingPoints) == 0:
+      return
+    self.profiler.count('outputUpdates')
+    if self.pointCloudModelNodeId is not None:
+      self.addPointCloudPoints(pendingPoints)
+      return
+    fiducialNode = slicer.util.getNode(self.fiducialNodeId)
+    if fiducialNode == None:
+      logging.error('Fiducial node not found!')
+      return
+    # One modified event for all points
+    modifyFlag = fiducialNode.StartModify()
+    for rasBoneSurfacePoint in pendingPoints:
+      fiducialNode.AddFiducialFromArray(rasBoneSurfacePoint)
+    fiducialNode.EndModify(modifyFlag)
 
 
-  def onVolumeModified(self, volumeNode, event):
-    # Fiducials for bone surface will be placed between these two values
-    self.startingDepthPixel = int(self.minDepthMm / self.usGeometryLogic.outputImageSpacing[1])
-    self.endingDepthPixel = int(self.maxDepthMm / self.usGeometryLogic.outputImageSpacing[1])
+  def addPointCloudPoints(self, rasPoints):
+    modelNode = slicer.util.getNode(self.pointCloudModelNodeId)
+    if modelNode == None:
+      logging.error('Point cloud model not found!')
+      return
+    pointCloud = modelNode.GetPolyData()
+    points = pointCloud.GetPoints()
+    vertices = pointCloud.GetVerts()
+    for rasPoint in rasPoints:
+      pointId = points.InsertNextPoint(rasPoint[0], rasPoint[1], rasPoint[2])
+      vertices.InsertNextCell(1)
+      vertices.InsertCellPoint(pointId)
+    points.Modified()
+    vertices.Modified()
+    pointCloud.Modified()
+
+
+  def volumeIjkToRas(self, volumeNode):
+    '''
+    :return: IJK to RAS matrix of the volume including its parent transforms, as a 4x4 numpy array.
+    '''
+    ijkToRas = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRas)
+    parentTransform = volumeNode.GetParentTransformNode()
+    if parentTransform != None:
+      parentToRasMatrix = vtk.vtkMatrix4x4()
+      parentTransform.GetMatrixTransformToWorld(parentToRasMatrix)
+      vtk.vtkMatrix4x4.Multiply4x4(parentToRasMatrix, ijkToRas, ijkToRas)
+    return np.array([[ijkToRas.GetElement(row, column) for column in range(4)] for row in range(4)])
+
 
+  @profiledMethod('onVolumeModified')
+  def onVolumeModified(self, volumeNode, event):
     if volumeNode == None:
       logging.error('volumeNode == None')
       return
@@ -431,119 +809,130 @@ class SkullMarkerLogic(ScriptedLoadableModuleLogic):
       logging.error('volumeNode is not a vtkMRMLScalarVolumeNode')
       return
 
-    currentImageData = slicer.util.array(volumeNode.GetID())
-    ijkToRas = vtk.vtkMatrix4x4()
-    volumeNode.GetIJKToRASMatrix(ijkToRas)
-    parentTransform = volumeNode.GetParentTransformNode()
-    if parentTransform != None:
-      parentToRasMatrix = vtk.vtkMatrix4x4()
-      parentTransform.GetMatrixTransformToWorld(parentToRasMatrix)
-      vtk.vtkMatrix4x4.Multiply4x4(parentToRasMatrix, ijkToRas, ijkToRas)
-    fiducialNode = slicer.util.getNode(self.fiducialNodeId)
-    if fiducialNode == None:
-      logging.error('Fiducial node not found!')
+    self.profiler.count('framesReceived')
+    with self.profiler.timer('arrayFromVolume'):
+      currentImageData = slicer.util.array(volumeNode.GetID())
+      ijkToRas = self.volumeIjkToRas(volumeNode)
+
+    with self.profiler.timer('frameGate'):
+      frameChanged = self.isFrameChanged(currentImageData[0], ijkToRas)
+    if not frameChanged:
+      return
+
+    if self.workerThread is not None:
+      # The frame buffer is reused by the next frame, so the worker gets a copy
+      self.enqueueFrame(np.array(currentImageData[0]), ijkToRas)
       return
 
-    if self.fiducialArray == None:
-      self.fiducialArray = np.reshape([],(0,3))
+    acceptedPoints = self.acceptedBoneSurfacePoints(currentImageData[0], ijkToRas)
 
-    modifyFlag = fiducialNode.StartModify()
     # If configuring, only keep max two frames of scanline fiducials
     # if (SkullMarkerLogic.configuring == 1 and self.fiducialNode.GetNumberOfFiducials() >= len(
     #         self.fiducialScanlines) * 2):
     #   self.fiducialNode.RemoveAllMarkups()
-    for i in range(len(self.fiducialScanlines)):
-      [scanlineStartPoint, scanlineEndPoint] = self.fiducialScanlines[i]
-      # Because we are dealing with linear we can just iterate down a column and do not need to use vtkLineSource as for curvilinear - can be added
-      startPoint = (scanlineStartPoint[0], self.startingDepthPixel, 0, 1)
-      endPoint = (scanlineEndPoint[0], self.endingDepthPixel, 0, 1)
-
-      # Determine if there is a bone surface point on scanline
-      currentScanline = currentImageData[0, :, startPoint[0]]
-      boneSurfacePoint = self.scanlineBoneSurfacePoint(currentScanline, startPoint, endPoint, self.threshold)
-
-      # Add bone surface point fiducial
-      if boneSurfacePoint is not None:
-        rasBoneSurfacePoint = ijkToRas.MultiplyPoint(boneSurfacePoint)
-        rasBoneSurfacePoint = self.checkDistances(rasBoneSurfacePoint, self.fiducialArray)
+    self.queueAcceptedPoints(acceptedPoints)
+
+
+  def queueAcceptedPoints(self, acceptedPoints):
+    '''
+    Collects the accepted points of a processed frame, and adds the collected points to the output
+    once every framesPerOutputUpdate frames.
+    '''
+    self.pendingPoints.extend(acceptedPoints)
+    self.framesSinceOutputUpdate += 1
+    if self.framesSinceOutputUpdate >= self.framesPerOutputUpdate:
+      self.addPendingFiducials()
+
+
+  def detectionParameters(self):
+    '''
+    :return: DetectionParameters of the current settings.
+    '''
+    # Fiducials for bone surface will be placed between these two values
+    startingDepthPixel = int(self.minDepthMm / self.usGeometryLogic.outputImageSpacing[1])
+    endingDepthPixel = int(self.maxDepthMm / self.usGeometryLogic.outputImageSpacing[1])
+    return DetectionParameters(self.scanlineSampler, startingDepthPixel, endingDepthPixel, self.threshold)
+
+  def detectBoneSurfacePoints(self, frame, ijkToRas, detectionParameters):
+    '''
+    Detects bone surface points of one frame. Only uses its arguments, so it can run on a worker thread.
+    :param frame: Image of the frame as a (rows, columns) array.
+    :param ijkToRas: 4x4 numpy array mapping image pixels to RAS.
+    :param detectionParameters: DetectionParameters, e.g. from detectionParameters().
+    :return: (numberOfPoints, 3) array of RAS points.
+    '''
+    scanlineSampler = detectionParameters.scanlineSampler
+    with self.profiler.timer('detection'):
+      # Profiles start at the transducer and step one row spacing along each scanline, for linear and curvilinear probes
+      scanlineProfiles = scanlineSampler.sample(frame)
+
+      # Determine bone surface points on all scanlines at once
+      boneSurfaceDepths = detectBoneSurfaceDepths(scanlineProfiles, detectionParameters.startingDepthPixel,
+        detectionParameters.endingDepthPixel, detectionParameters.threshold)
+      [scanlineIndices] = np.nonzero(boneSurfaceDepths >= 0)
+      boneSurfacePixels = scanlineSampler.pixelPositions(scanlineIndices, boneSurfaceDepths[scanlineIndices])
+      boneSurfacePoints = np.column_stack([boneSurfacePixels, np.zeros(len(scanlineIndices)), np.ones(len(scanlineIndices))])
+      rasBoneSurfacePoints = boneSurfacePoints.dot(ijkToRas.T)[:, :3]
+    self.profiler.count('framesProcessed')
+    self.profiler.count('pointsDetected', len(rasBoneSurfacePoints))
+    return rasBoneSurfacePoints
+
+  def acceptBoneSurfacePoints(self, rasBoneSurfacePoints):
+    '''
+    Keeps the points far enough from the points collected so far, and collects them. Main thread only.
+    :return: List of accepted RAS points.
+    '''
+    if self.fiducialPoints is None:
+      self.fiducialPoints = FiducialPointGrid(self.minDistanceBetween)
+
+    acceptedPoints = []
+    with self.profiler.timer('distanceChecks'):
+      for rasBoneSurfacePoint in rasBoneSurfacePoints:
+        rasBoneSurfacePoint = self.checkDistances(rasBoneSurfacePoint, self.fiducialPoints)
         if rasBoneSurfacePoint is not None:
-          self.fiducialArray = np.append(self.fiducialArray, [rasBoneSurfacePoint[:3]], axis=0)
-          fiducialNode.AddFiducialFromArray(rasBoneSurfacePoint[:3])
-
-      fiducialNode.EndModify(modifyFlag)
-
-  def checkDistances(self, rasBoneSurfacePoint, fiducialArray):
-    tooCloseCheck = False
-    totalPointsSoFar = len(fiducialArray)
-    numChecked=0
-    while ((numChecked < totalPointsSoFar) and (tooCloseCheck==False)):
-      currentPoint = fiducialArray[numChecked]
-      distanceBetweenPoints = np.linalg.norm(currentPoint - rasBoneSurfacePoint[:3])
-
-      '''
-      distanceX = (rasBoneSurfacePoint[0] - currentPoint[0])*(rasBoneSurfacePoint[0]-currentPoint[0])
-      distanceY = (rasBoneSurfacePoint[1] - currentPoint[1])*(rasBoneSurfacePoint[1]-currentPoint[1])
-      distanceZ = (rasBoneSurfacePoint[2] - currentPoint[2])*(rasBoneSurfacePoint[2]-currentPoint[2])
-      distanceBetweenPoints = math.sqrt(distanceX+distanceY+distanceZ)
-      '''
-      if (distanceBetweenPoints<self.minDistanceBetween):
-        tooCloseCheck = True
-
-      else:
-        numChecked = numChecked + 1
-
-    if (tooCloseCheck == True):
+          self.fiducialPoints.insert(rasBoneSurfacePoint)
+          acceptedPoints.append(rasBoneSurfacePoint)
+    self.profiler.count('pointsAccepted', len(acceptedPoints))
+    return acceptedPoints
+
+  def acceptedBoneSurfacePoints(self, frame, ijkToRas):
+    '''
+    Detects bone surface points of one frame and keeps the ones far enough from the points collected so far.
+    :param frame: Image of the frame as a (rows, columns) array.
+    :param ijkToRas: 4x4 numpy array mapping image pixels to RAS.
+    :return: List of accepted RAS points.
+    '''
+    return self.acceptBoneSurfacePoints(self.detectBoneSurfacePoints(frame, ijkToRas, self.detectionParameters()))
+
+  def processSequence(self, sequenceFile, configFile, scanlineNumber=None):
+    '''
+    Marks bone surface points on all frames of a recorded sequence at once, with the depth range,
+    threshold and minimum distance set on the logic. Points are in the reference coordinate frame
+    of the recording (tracker if the recording has no reference).
+    :param sequenceFile: Path of the PLUS sequence .mha file.
+    :param configFile: Path of the PLUS configuration file of the recording.
+    :param scanlineNumber: Number of scanlines to search, all scanlines of the geometry by default.
+    :return: (numberOfPoints, 4) array of accepted points as x, y, z and frame index.
+    '''
+    return detectSequenceBoneSurfacePoints(sequenceFile, configFile, scanlineNumber,
+      self.minDepthMm, self.maxDepthMm, self.threshold, self.minDistanceBetween)
+
+  def checkDistances(self, rasBoneSurfacePoint, fiducialPoints):
+    '''
+    :param rasBoneSurfacePoint: Candidate point, RAS coordinates in the first three elements.
+    :param fiducialPoints: FiducialPointGrid of the points collected so far.
+    :return: rasBoneSurfacePoint, or None if it is closer than minDistanceBetween to a collected point.
+    '''
+    if fiducialPoints.isTooClose(rasBoneSurfacePoint):
       return None
     else:
       return rasBoneSurfacePoint
 
   def scanlineBoneSurfacePoint(self, currentScanline, startPoint, endPoint, threshold):
-    boneSurfacePoint = None
-    boneSurfacePointValue = None
-    boneAreaDepth = self.endingDepthPixel - self.startingDepthPixel
-    for offset in range(boneAreaDepth):
-      currentPixelValue = currentScanline[int(startPoint[1]) + offset]
-      # Only consider pixels above specified threshold
-      if (currentPixelValue > threshold):
-        # Check for artifact
-        # ***Note: currently testing w/ magic numbers***
-        pointIsNotArtifact = True
-        pixelAboveOffset = int( offset - 3 )
-        pixelBelowOffset = int( offset + 3 )
-        pixelAboveAverage = int(currentScanline[int(startPoint[1]) + pixelAboveOffset])
-        pixelBelowAverage = int(currentScanline[int(startPoint[1]) + pixelBelowOffset])
-        averageRange = 3
-        for i in range(averageRange):
-          pixelAboveAverage += currentScanline[int(startPoint[1]) + pixelAboveOffset - i]
-          pixelBelowAverage += currentScanline[int(startPoint[1]) + pixelBelowAverage + i]
-        pixelAboveAverage /= averageRange
-        pixelBelowAverage /= averageRange
-
-        cutoff = currentPixelValue * 0.40
-        if (pixelAboveAverage < cutoff and pixelBelowAverage < cutoff):
-          pointIsNotArtifact = False
-
-        # Check for intensity increase/decrease (ie ridge)
-        pointIsRidge = False
-        gradientCheckLength = 5
-        aboveDifferenceSum = belowDifferenceSum = 0
-        previousAbovePixelValue = previousBelowPixelValue = int(currentPixelValue)
-        for i in range(1, gradientCheckLength + 1):  # +1 because we don't consider potential pixel point
-          abovePixelValue = int(currentScanline[int(startPoint[1]) + offset - i])
-          belowPixelValue = int(currentScanline[int(startPoint[1]) + offset + i])
-          aboveDifferenceSum += (previousAbovePixelValue - abovePixelValue)
-          currentBelowDifference = belowPixelValue - previousBelowPixelValue
-          belowDifferenceSum += (belowPixelValue - previousBelowPixelValue)
-          previousAbovePixelValue = abovePixelValue
-          previousBelowPixelValue = belowPixelValue
-
-        if (aboveDifferenceSum > 0 and belowDifferenceSum < 0):
-          pointIsRidge = True
-
-        if (pointIsNotArtifact and pointIsRidge):
-          boneSurfacePoint = (int(startPoint[0]), int(startPoint[1]) + offset, 0, 1)
-
-    return boneSurfacePoint
+    boneSurfaceDepth = detectBoneSurfaceDepths(currentScanline, int(startPoint[1]), int(endPoint[1]), threshold)
+    if boneSurfaceDepth < 0:
+      return None
+    return (int(startPoint[0]), int(boneSurfaceDepth), 0, 1)
 
 
 class SkullMarkerTest(ScriptedLoadableModuleTest):
@@ -565,8 +954,423 @@ class SkullMarkerTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_SkullMarker1()
+    self.test_SkullMarker_DetectBoneSurfaceDepths()
+    self.test_SkullMarker_FiducialPointGrid()
+    self.test_SkullMarker_BatchedOutput()
+    self.test_SkullMarker_Profiling()
+    self.test_SkullMarker_BackgroundProcessing()
+    self.test_SkullMarker_ParameterSweep()
+    self.test_SkullMarker_FrameGate()
+    self.test_SkullMarker_ProcessSequence()
 
 
   def test_SkullMarker1(self):
 
     self.delayDisplay('Test passed!')
+
+  def test_SkullMarker_DetectBoneSurfaceDepths(self):
+    self.delayDisplay("Starting DetectBoneSurfaceDepths test")
+
+    # Two bright ridges below soft tissue on the first scanline, only soft tissue on the second one
+    scanlineProfiles = np.zeros((2, 100), dtype=np.uint8)
+    scanlineProfiles[:, :70] = 120
+    scanlineProfiles[0, 28:33] = [160, 190, 250, 190, 160]
+    scanlineProfiles[0, 58:63] = [160, 190, 240, 190, 160]
+    boneSurfaceDepths = detectBoneSurfaceDepths(scanlineProfiles, 10, 90, 200)
+    self.assertEqual(list(boneSurfaceDepths), [60, -1])
+
+    # Searching above the deeper ridge finds the shallower one
+    boneSurfaceDepths = detectBoneSurfaceDepths(scanlineProfiles, 10, 50, 200)
+    self.assertEqual(list(boneSurfaceDepths), [30, -1])
+
+    self.delayDisplay('DetectBoneSurfaceDepths test passed!')
+
+  def test_SkullMarker_FiducialPointGrid(self):
+    self.delayDisplay("Starting FiducialPointGrid test")
+
+    fiducialPoints = FiducialPointGrid(2.0, initialCapacity=2)
+    for point in [[0.0, 0.0, 0.0], [2.5, 0.0, 0.0], [0.0, -3.9, 1.0], [10.0, 10.0, 10.0]]:
+      self.assertFalse(fiducialPoints.isTooClose(point))
+      fiducialPoints.insert(point)
+    self.assertEqual(fiducialPoints.numberOfPoints, 4)
+
+    # Points in neighboring grid cells are found as well
+    self.assertTrue(fiducialPoints.isTooClose([1.9, 0.5, 0.0]))
+    self.assertTrue(fiducialPoints.isTooClose([-1.2, -1.2, 0.0]))
+    self.assertFalse(fiducialPoints.isTooClose([5.0, 5.0, 5.0]))
+
+    self.delayDisplay('FiducialPointGrid test passed!')
+
+  def test_SkullMarker_BatchedOutput(self):
+    self.delayDisplay("Starting BatchedOutput test")
+
+    logic = SkullMarkerLogic()
+    fiducialNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    logic.setFiducialNode(fiducialNode)
+    logic.setFramesPerOutputUpdate(3)
+
+    # Points of three frames are added in one update
+    for frameIndex in range(5):
+      logic.queueAcceptedPoints([np.array([frameIndex, 0.0, 0.0]), np.array([frameIndex, 1.0, 0.0])])
+      self.assertEqual(fiducialNode.GetNumberOfFiducials(), 6 if frameIndex >= 2 else 0)
+    logic.addPendingFiducials()
+    self.assertEqual(fiducialNode.GetNumberOfFiducials(), 10)
+
+    # A point cloud model collects the points as vertices instead
+    modelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode')
+    logic.setPointCloudModelNode(modelNode)
+    logic.setFramesPerOutputUpdate(1)
+    logic.queueAcceptedPoints([np.array([1.0, 2.0, 3.0]), np.array([4.0, 5.0, 6.0])])
+    self.assertEqual(modelNode.GetPolyData().GetNumberOfPoints(), 2)
+    self.assertEqual(modelNode.GetPolyData().GetNumberOfVerts(), 2)
+    self.assertEqual(fiducialNode.GetNumberOfFiducials(), 10)
+
+    self.delayDisplay('BatchedOutput test passed!')
+
+  def test_SkullMarker_Profiling(self):
+    self.delayDisplay("Starting Profiling test")
+
+    logic = SkullMarkerLogic()
+    fiducialNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    logic.setFiducialNode(fiducialNode)
+
+    # Nothing is recorded while disabled
+    logic.queueAcceptedPoints([np.array([0.0, 0.0, 0.0])])
+    self.assertEqual(logic.profiler.summary()['timers'], {})
+
+    logic.profiler.setEnabled(True)
+    for frameIndex in range(4):
+      logic.queueAcceptedPoints([np.array([frameIndex, 0.0, 0.0])])
+    summary = logic.profiler.summary()
+    self.assertEqual(summary['timers']['outputUpdate']['count'], 4)
+    self.assertLessEqual(summary['timers']['outputUpdate']['p50Ms'], summary['timers']['outputUpdate']['p95Ms'])
+    self.assertEqual(summary['counters']['outputUpdates'], 4)
+    self.assertIn('outputUpdate: 4 calls', logic.profiler.summaryText())
+
+    self.delayDisplay('Profiling test passed!')
+
+  def test_SkullMarker_BackgroundProcessing(self):
+    self.delayDisplay("Starting BackgroundProcessing test")
+
+    testDataPath = os.path.join(os.path.dirname(__file__), '..', 'USGeometry', 'Testing', 'Data', 'Linear')
+    volumeNode = slicer.util.loadVolume(os.path.join(testDataPath, 'BoneUltrasound_L14_Trimmed.mha'), returnNode=True)[1]
+    frames = slicer.util.array(volumeNode.GetID())
+    def frameToRas(frameIndex):
+      ijkToRas = np.eye(4)
+      ijkToRas[2, 3] = 3.0 * frameIndex
+      return ijkToRas
+
+    def setUpLogic():
+      logic = SkullMarkerLogic()
+      logic.importGeometry(os.path.join(testDataPath, 'BoneUltrasound_L14_config.xml'), volumeNode)
+      logic.computeFiducialScanlines(32)
+      [logic.minDepthMm, logic.maxDepthMm, logic.threshold, logic.minDistanceBetween] = [2, 40, 200, 2]
+      logic.setFiducialNode(slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode'))
+      return logic
+
+    # Points of processing the frames on the main thread
+    synchronousLogic = setUpLogic()
+    expectedPoints = []
+    for frameIndex in range(len(frames)):
+      expectedPoints.extend(synchronousLogic.acceptedBoneSurfacePoints(frames[frameIndex], frameToRas(frameIndex)))
+    self.assertGreater(len(expectedPoints), 0)
+
+    # Detection blocks the worker until released, and accepting the points is recorded
+    logic = setUpLogic()
+    logic.setBackgroundProcessing(True, maximumQueuedFrames=len(frames), maximumConsecutiveFailures=2)
+    [workerBusy, workerReleased, framesDone] = [threading.Event(), threading.Event(), threading.Event()]
+    detectedFrames = []
+    detectBoneSurfacePoints = logic.detectBoneSurfacePoints
+    def blockingDetection(frame, ijkToRas, detectionParameters):
+      workerBusy.set()
+      workerReleased.wait(10)
+      detectedFrames.append(int(ijkToRas[2, 3] / 3.0))
+      rasBoneSurfacePoints = detectBoneSurfacePoints(frame, ijkToRas, detectionParameters)
+      if len(detectedFrames) == len(frames):
+        framesDone.set()
+      return rasBoneSurfacePoints
+    logic.detectBoneSurfacePoints = blockingDetection
+    acceptedPoints = []
+    acceptingThreads = set()
+    acceptBoneSurfacePoints = logic.acceptBoneSurfacePoints
+    def recordedAccept(rasBoneSurfacePoints):
+      acceptingThreads.add(threading.current_thread())
+      points = acceptBoneSurfacePoints(rasBoneSurfacePoints)
+      acceptedPoints.extend(points)
+      return points
+
+    logic.acceptBoneSurfacePoints = recordedAccept
+
+    # Frames keep the parameters that were set when they were queued
+    logic.startBackgroundProcessing()
+    for frameIndex in range(len(frames)):
+      logic.enqueueFrame(np.array(frames[frameIndex]), frameToRas(frameIndex))
+      if frameIndex == 0:
+        self.assertTrue(workerBusy.wait(10))
+    [logic.minDepthMm, logic.maxDepthMm, logic.threshold] = [0, 1, 255]
+    logic.setScanlineInterpolation('linear')
+    workerReleased.set()
+    self.assertTrue(framesDone.wait(10))
+    logic.stopBackgroundProcessing()
+    self.assertEqual(detectedFrames, list(range(len(frames))))
+    self.assertEqual(logic.droppedFrames, 0)
+    self.assertEqual(acceptingThreads, set([threading.current_thread()]))
+    self.assertTrue(np.array_equal(np.array(acceptedPoints), np.array(expectedPoints)))
+    self.assertEqual(slicer.util.getNode(logic.fiducialNodeId).GetNumberOfFiducials(), len(expectedPoints))
+
+    # While the worker is busy with the first frame, the oldest queued frame is dropped for the newest one.
+    # Stopping drops the queued frames and does not wait for the busy worker
+    logic.setBackgroundProcessing(True, maximumQueuedFrames=2, maximumConsecutiveFailures=2)
+    [workerBusy, workerReleased] = [threading.Event(), threading.Event()]
+    del detectedFrames[:]
+    logic.startBackgroundProcessing()
+    for frameIndex in range(4):
+      logic.enqueueFrame(np.array(frames[frameIndex]), frameToRas(frameIndex))
+      if frameIndex == 0:
+        self.assertTrue(workerBusy.wait(10))
+    self.assertEqual(logic.droppedFrames, 1)
+    self.assertEqual([int(ijkToRas[2, 3] / 3.0) for [frame, ijkToRas, detectionParameters] in list(logic.frameQueue.queue)], [2, 3])
+    workerThread = logic.workerThread
+    logic.stopBackgroundProcessing()
+    self.assertEqual(logic.droppedFrames, 3)
+    self.assertIsNone(logic.workerThread)
+    self.assertIsNone(logic.resultsTimer)
+    workerReleased.set()
+    workerThread.join(10)
+    self.assertFalse(workerThread.is_alive())
+    self.assertEqual(detectedFrames, [0])
+
+    # Without dropping the oldest frames, the new frame is dropped
+    logic.setBackgroundProcessing(True, maximumQueuedFrames=2, dropOldestFrames=False, maximumConsecutiveFailures=2)
+    [workerBusy, workerReleased, framesDone] = [threading.Event(), threading.Event(), threading.Event()]
+    del detectedFrames[:]
+    logic.startBackgroundProcessing()
+    for frameIndex in range(4):
+      logic.enqueueFrame(np.array(frames[frameIndex]), frameToRas(frameIndex))
+      if frameIndex == 0:
+        self.assertTrue(workerBusy.wait(10))
+    self.assertEqual([int(ijkToRas[2, 3] / 3.0) for [frame, ijkToRas, detectionParameters] in list(logic.frameQueue.queue)], [1, 2])
+    self.assertEqual(logic.droppedFrames, 1)
+    workerReleased.set()
+    workerThread = logic.workerThread
+    logic.stopBackgroundProcessing()
+    workerThread.join(10)
+
+    # The worker stops after repeated failures, and stopping does not wait for it
+    def failDetection(frame, ijkToRas, detectionParameters):
+      raise RuntimeError('detection failed')
+    logic.detectBoneSurfacePoints = failDetection
+    logic.startBackgroundProcessing()
+    workerThread = logic.workerThread
+    for frameIndex in range(2):
+      logic.enqueueFrame(np.array(frames[frameIndex]), frameToRas(frameIndex))
+    workerThread.join(10)
+    self.assertFalse(workerThread.is_alive())
+    self.assertEqual(logic.failedFrames, 2)
+    for frameIndex in range(4):
+      logic.enqueueFrame(np.array(frames[frameIndex]), frameToRas(frameIndex))
+    self.assertEqual(logic.droppedFrames, 4)
+    logic.stopBackgroundProcessing()
+    self.assertIsNone(logic.workerThread)
+
+    self.delayDisplay('BackgroundProcessing test passed!')
+
+  def test_SkullMarker_ParameterSweep(self):
+    self.delayDisplay("Starting ParameterSweep test")
+    import glob
+    from USGeometryLib import MetaImageSequence, ScanlineGeometry, readScanConversionGeometry
+    from SkullMarkerLib import readScanlineProfiles, sweepDetectionParameters, paretoOptimalResults, SweepResult
+    from SkullMarkerLib.ParameterSweep import boneSurfaceCandidates, deepestQualifyingDepths, windowBoneSurfaceDepths, closePointPairs, minimumDistanceFilter
+
+    testDataPath = os.path.join(os.path.dirname(__file__), '..', 'USGeometry', 'Testing', 'Data', 'Linear')
+    sequenceFile = os.path.join(testDataPath, 'BoneUltrasound_L14_Trimmed.mha')
+    configFile = os.path.join(testDataPath, 'BoneUltrasound_L14_config.xml')
+    groundTruthFiles = sorted(glob.glob(os.path.join(testDataPath, 'TestManualSegmentations', '*.mha')))
+    thresholds = [100, 200]
+    depthWindowsMm = [(2, 10), (2, 40), (0, 100)]
+    minDistances = [0, 2]
+
+    # Candidate checks and the deepest qualifying depths find the same points as detection in every depth window
+    scanlineGeometry = ScanlineGeometry(readScanConversionGeometry(configFile))
+    [startPoints, endPoints] = scanlineGeometry.computeScanlineEndPoints(np.arange(scanlineGeometry.numberOfScanlines))
+    scanlineSampler = ScanlineSampler(startPoints, endPoints, scanlineGeometry.outputImageSizePixel[:2], scanlineGeometry.outputImageSpacing)
+    scanlineProfiles = readScanlineProfiles(MetaImageSequence(sequenceFile), scanlineSampler)
+    [candidateValues, candidateChecks] = boneSurfaceCandidates(scanlineProfiles)
+    for threshold in thresholds:
+      deepestQualifying = deepestQualifyingDepths(candidateValues, candidateChecks, threshold)
+      for [minDepthMm, maxDepthMm] in depthWindowsMm:
+        startingDepthPixel = int(minDepthMm / scanlineGeometry.outputImageSpacing[1])
+        endingDepthPixel = int(maxDepthMm / scanlineGeometry.outputImageSpacing[1])
+        boneSurfaceDepths = detectBoneSurfaceDepths(scanlineProfiles, startingDepthPixel, endingDepthPixel, threshold)
+        self.assertGreater(np.count_nonzero(boneSurfaceDepths >= 0), 0)
+        self.assertTrue(np.array_equal(windowBoneSurfaceDepths(deepestQualifying, startingDepthPixel, endingDepthPixel), boneSurfaceDepths))
+
+    # The close point pairs give the points that the grid accepts when they are inserted in order
+    randomPoints = np.random.RandomState(3).rand(300, 3) * 10.0
+    randomPoints[10::20] = randomPoints[:15]
+    pointPairs = closePointPairs(randomPoints, 2.0)
+    for minDistance in [0, 0.5, 1.0, 2.0]:
+      fiducialPoints = FiducialPointGrid(minDistance)
+      accepted = []
+      for point in randomPoints:
+        accepted.append(not fiducialPoints.isTooClose(point))
+        if accepted[-1]:
+          fiducialPoints.insert(point)
+      self.assertEqual(list(minimumDistanceFilter(len(randomPoints), pointPairs, minDistance)), accepted)
+
+    # Every setting is scored, and the Pareto-optimal ones trade false negatives for true positives
+    [results, paretoResults] = sweepDetectionParameters(sequenceFile, configFile, groundTruthFiles, thresholds, depthWindowsMm, minDistances)
+    self.assertEqual(len(results), len(thresholds) * len(depthWindowsMm) * len(minDistances))
+    self.assertEqual(paretoResults, paretoOptimalResults(results))
+    self.assertGreater(len(paretoResults), 0)
+    for [result, nextResult] in zip(paretoResults, paretoResults[1:]):
+      self.assertLessEqual(result.falseNegative, nextResult.falseNegative)
+      self.assertLess(result.truePositive, nextResult.truePositive)
+    for paretoResult in paretoResults:
+      self.assertFalse(any(result.truePositive > paretoResult.truePositive and result.falseNegative <= paretoResult.falseNegative
+                           for result in results if result.truePositive is not None))
+
+    # Dominated settings and settings without metrics are left out
+    sweepResults = [SweepResult(100, 2, 10, 0, 5, 90.0, 10.0, 30.0), SweepResult(100, 2, 40, 0, 8, 80.0, 20.0, 10.0),
+                    SweepResult(200, 2, 40, 0, 6, 70.0, 30.0, 20.0), SweepResult(200, 2, 10, 0, 0, None, None, None),
+                    SweepResult(200, 0, 100, 0, 9, 85.0, 15.0, 10.0)]
+    self.assertEqual(paretoOptimalResults(sweepResults), [sweepResults[4], sweepResults[0]])
+
+    self.delayDisplay('ParameterSweep test passed!')
+
+  def test_SkullMarker_FrameGate(self):
+    self.delayDisplay("Starting FrameGate test")
+
+    def ijkToRas(translationMm=0.0, rotationDeg=0.0):
+      # 0.2 mm pixels, rotated about the image normal
+      angle = math.radians(rotationDeg)
+      matrix = np.eye(4)
+      matrix[:2, :2] = [[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]]
+      matrix[:3, :3] = matrix[:3, :3].dot(np.diag([0.2, 0.2, 1.0]))
+      matrix[:3, 3] = [translationMm, 0.0, 0.0]
+      return matrix
+    randomFrames = np.random.RandomState(7)
+    def newFrame():
+      return randomFrames.randint(0, 255, (32, 32)).astype(np.uint8)
+
+    # Every frame is processed while the gate is disabled
+    logic = SkullMarkerLogic()
+    frame = newFrame()
+    self.assertTrue(logic.isFrameChanged(frame, ijkToRas()))
+    self.assertTrue(logic.isFrameChanged(frame, ijkToRas()))
+
+    logic.setFrameGate(True, minimumTranslationMm=0.5, minimumRotationDeg=0.5)
+    self.assertTrue(logic.isFrameChanged(frame, ijkToRas()))
+
+    # Repeated frames are skipped, also if they only differ in pixels left out of the downsampled hash
+    self.assertFalse(logic.isFrameChanged(frame, ijkToRas(translationMm=10.0)))
+    changedFrame = frame.copy()
+    changedFrame[1, 1] += 1
+    self.assertFalse(logic.isFrameChanged(changedFrame, ijkToRas(translationMm=10.0)))
+    self.assertEqual(logic.skippedFrames, 2)
+
+    # New frames are skipped until the probe moved or rotated enough since the last processed frame
+    self.assertFalse(logic.isFrameChanged(newFrame(), ijkToRas(translationMm=0.3)))
+    self.assertFalse(logic.isFrameChanged(newFrame(), ijkToRas(translationMm=0.3, rotationDeg=0.3)))
+    self.assertTrue(logic.isFrameChanged(newFrame(), ijkToRas(translationMm=0.6)))
+    self.assertFalse(logic.isFrameChanged(newFrame(), ijkToRas(translationMm=0.6, rotationDeg=0.4)))
+    self.assertTrue(logic.isFrameChanged(newFrame(), ijkToRas(translationMm=0.6, rotationDeg=1.0)))
+    self.assertFalse(logic.isFrameChanged(newFrame(), ijkToRas(translationMm=0.6, rotationDeg=0.8)))
+    self.assertEqual(logic.skippedFrames, 6)
+
+    # Without duplicate checks, a repeated frame is processed if the probe moved
+    logic.setFrameGate(True, minimumTranslationMm=0.5, minimumRotationDeg=0.5, skipDuplicateFrames=False)
+    frame = newFrame()
+    self.assertTrue(logic.isFrameChanged(frame, ijkToRas(translationMm=2.0)))
+    self.assertTrue(logic.isFrameChanged(frame, ijkToRas(translationMm=3.0)))
+
+    # Resetting forgets the previous frames
+    logic.setFrameGate(True, minimumTranslationMm=0.5, minimumRotationDeg=0.5)
+    self.assertFalse(logic.isFrameChanged(frame, ijkToRas(translationMm=3.0)))
+    logic.resetFrameGate()
+    self.assertEqual(logic.skippedFrames, 0)
+    self.assertTrue(logic.isFrameChanged(frame, ijkToRas(translationMm=3.0)))
+    self.assertFalse(logic.isFrameChanged(frame, ijkToRas(translationMm=3.0)))
+    self.assertEqual(logic.skippedFrames, 1)
+
+    self.delayDisplay('FrameGate test passed!')
+
+  def test_SkullMarker_ProcessSequence(self):
+    self.delayDisplay("Starting ProcessSequence test")
+    import csv, shutil, tempfile
+    from USGeometryLib import MetaImageSequence, ScanlineGeometry, readScanConversionGeometry
+
+    testDataPath = os.path.join(os.path.dirname(__file__), '..', 'USGeometry', 'Testing', 'Data', 'Linear')
+    sequenceFile = os.path.join(testDataPath, 'BoneUltrasound_L14_Trimmed.mha')
+    configFile = os.path.join(testDataPath, 'BoneUltrasound_L14_config.xml')
+    logic = SkullMarkerLogic()
+    logic.setMinMaxDepth(2, 10)
+    logic.setThreshold(200)
+    logic.setMinimumDistanceBetween(2)
+    points = logic.processSequence(sequenceFile, configFile)
+    self.assertEqual(points.shape, (9, 4))
+
+    # The same points are accepted when the frames are processed one at a time like live frames
+    logic.usGeometryLogic = ScanlineGeometry(readScanConversionGeometry(configFile))
+    logic.computeFiducialScanlines(logic.usGeometryLogic.numberOfScanlines)
+    sequence = MetaImageSequence(sequenceFile)
+    imageToReference = sequenceImageToReference(sequence, configFile)
+    framePoints = []
+    for frameIndex, frame in enumerate(sequence.iterFrames()):
+      for point in logic.acceptedBoneSurfacePoints(frame, imageToReference[frameIndex]):
+        framePoints.append(list(point) + [frameIndex])
+    self.assertTrue(np.allclose(points, framePoints))
+
+    # The command line writes the point cloud as Slicer markups or comma separated values
+    outputDirectory = tempfile.mkdtemp()
+    try:
+      markupsFile = os.path.join(outputDirectory, 'Points.fcsv')
+      self.assertEqual(main([sequenceFile, configFile, markupsFile]), 0)
+      with open(markupsFile) as markupsStream:
+        rows = [row for row in csv.reader(markupsStream) if not row[0].startswith('#')]
+      self.assertEqual(len(rows), len(points))
+      self.assertTrue(np.allclose([[float(value) for value in row[1:4]] for row in rows], points[:, :3]))
+      self.assertEqual([row[12] for row in rows], ['frame {0}'.format(int(frameIndex)) for frameIndex in points[:, 3]])
+
+      pointsFile = os.path.join(outputDirectory, 'Points.csv')
+      self.assertEqual(main([sequenceFile, configFile, pointsFile, '--minimum-distance', '0']), 0)
+      with open(pointsFile) as pointsStream:
+        rows = list(csv.reader(pointsStream))
+      self.assertEqual(rows[0], ['x', 'y', 'z', 'frame'])
+      self.assertGreater(len(rows) - 1, len(points))
+    finally:
+      shutil.rmtree(outputDirectory)
+
+    self.delayDisplay('ProcessSequence test passed!')
+
+
+def main(argv):
+  '''
+  Marks bone surface points on a recorded sequence without the module GUI, e.g.
+  Slicer --no-main-window --python-script SkullMarker.py Recording.mha PlusConfig.xml Points.fcsv
+  '''
+  import argparse
+  parser = argparse.ArgumentParser(description='Mark bone surface points on a recorded ultrasound sequence.')
+  parser.add_argument('sequenceFile', help='PLUS sequence .mha file')
+  parser.add_argument('configFile', help='PLUS configuration file with the ScanConversion element')
+  parser.add_argument('outputFile', help='Output point cloud, .fcsv for Slicer markups or comma separated values otherwise')
+  parser.add_argument('--scanlines', type=int, default=None, help='Number of scanlines to search (default: all)')
+  parser.add_argument('--threshold', type=float, default=200, help='Bone surface threshold')
+  parser.add_argument('--starting-depth', type=float, default=2, help='Starting fiducial depth in mm')
+  parser.add_argument('--ending-depth', type=float, default=10, help='Ending fiducial depth in mm')
+  parser.add_argument('--minimum-distance', type=float, default=2, help='Minimum distance between points in mm')
+  args = parser.parse_args(argv)
+
+  logic = SkullMarkerLogic()
+  logic.setMinMaxDepth(args.starting_depth, args.ending_depth)
+  logic.setThreshold(args.threshold)
+  logic.setMinimumDistanceBetween(args.minimum_distance)
+  points = logic.processSequence(args.sequenceFile, args.configFile, args.scanlines)
+  writePointCloud(points, args.outputFile)
+  logging.info('Wrote {0} bone surface points to {1}'.format(len(points), args.outputFile))
+  return 0
+
+
+if __name__ == '__main__':
+  import sys
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,154 @@
+import math
+import numpy as np
+
+#
+# Bone surface detection
+#
+
+boneSurfaceNeighborhood = 5 # Pixels needed above and below a candidate for the artifact and ridge checks
+
+def boneSurfaceCandidateChecks(profiles, firstCandidate, lastCandidate):
+  '''
+  Evaluates the threshold independent bone surface checks of a range of candidate depths. A candidate is not an
+  isolated artifact (the 3 pixel averages above and below are not both darker than 40% of it), and it is a ridge
+  (brighter than the pixels 5 above and 5 below).
+  :param profiles: Integer intensities with depth along the last axis.
+  :param firstCandidate: First candidate depth pixel, at least boneSurfaceNeighborhood.
+  :param lastCandidate: Depth pixel after the last candidate, at most boneSurfaceNeighborhood from the end of the profiles.
+  :return: [candidateValues, candidateChecks], arrays of the candidate depths.
+  '''
+  def shifted(offset):
+    return profiles[..., firstCandidate + offset:lastCandidate + offset]
+
+  candidateValues = shifted(0)
+
+  # Check for artifact
+  # ***Note: currently testing w/ magic numbers***
+  pixelAboveAverage = (2 * shifted(-3) + shifted(-4) + shifted(-5)) // 3
+  pixelBelowAverage = (2 * shifted(3) + shifted(4) + shifted(5)) // 3
+  cutoff = candidateValues * 0.40
+  pointIsNotArtifact = ~((pixelAboveAverage < cutoff) & (pixelBelowAverage < cutoff))
+
+  # Check for intensity increase/decrease (ie ridge), the summed differences over 5 pixels reduce to the end pixels
+  pointIsRidge = (candidateValues > shifted(-boneSurfaceNeighborhood)) & (candidateValues > shifted(boneSurfaceNeighborhood))
+
+  return [candidateValues, pointIsNotArtifact & pointIsRidge]
+
+def detectBoneSurfaceDepths(scanlineProfiles, startingDepthPixel, endingDepthPixel, threshold):
+  '''
+  Finds the deepest bone surface point along every scanline profile at once.
+  A depth qualifies when its intensity is above threshold and it passes boneSurfaceCandidateChecks.
+  :param scanlineProfiles: Intensities with depth along the last axis, e.g. (scanlines, depth) or (frames, scanlines, depth).
+  :param startingDepthPixel: First depth pixel that may be a bone surface point.
+  :param endingDepthPixel: Depth pixel where the search stops (exclusive).
+  :param threshold: Minimum intensity of bone surface points.
+  :return: Integer array with the shape of scanlineProfiles without the last axis, holding the depth pixel of
+    the deepest bone surface point, or -1 where there is none.
+  '''
+  profiles = np.asarray(scanlineProfiles).astype(np.int32)
+  firstCandidate = max(int(startingDepthPixel), boneSurfaceNeighborhood)
+  lastCandidate = min(int(endingDepthPixel), profiles.shape[-1] - boneSurfaceNeighborhood) # Exclusive
+  if lastCandidate <= firstCandidate:
+    return np.full(profiles.shape[:-1], -1, dtype=int)
+
+  [candidateValues, candidateChecks] = boneSurfaceCandidateChecks(profiles, firstCandidate, lastCandidate)
+  qualifying = (candidateValues > threshold) & candidateChecks
+
+  # Keep the deepest qualifying candidate
+  numberOfCandidates = qualifying.shape[-1]
+  deepestCandidate = numberOfCandidates - 1 - np.argmax(qualifying[..., ::-1], axis=-1)
+  return np.where(qualifying.any(axis=-1), firstCandidate + deepestCandidate, -1)
+
+#
+# FiducialPointGrid
+#
+
+class FiducialPointGrid(object):
+  """Collected fiducial points with a voxel grid index for minimum spacing checks.
+  Grid cells are as wide as the minimum distance, so every point closer than that to a
+  new point is in the 3x3x3 block of cells around it. Checks and inserts take constant
+  time regardless of how many points have been collected.
+  """
+
+  def __init__(self, minDistance, initialCapacity=1024):
+    self.minDistance = float(minDistance)
+    self.cellSize = self.minDistance if self.minDistance > 0 else 1.0
+    self.points = np.empty((initialCapacity, 3))
+    self.numberOfPoints = 0
+    self.cells = {} # Cell index -> indices of the points in the cell
+
+  def cellIndex(self, point):
+    return (int(math.floor(point[0] / self.cellSize)),
+            int(math.floor(point[1] / self.cellSize)),
+            int(math.floor(point[2] / self.cellSize)))
+
+  def isTooClose(self, point):
+    '''
+    :param point: RAS coordinates of the candidate point.
+    :return: True if a collected point is closer than the minimum distance.
+    '''
+    if self.minDistance <= 0:
+      return False
+    minDistanceSquared = self.minDistance * self.minDistance
+    [i, j, k] = self.cellIndex(point)
+    for di in (-1, 0, 1):
+      for dj in (-1, 0, 1):
+        for dk in (-1, 0, 1):
+          for pointIndex in self.cells.get((i + di, j + dj, k + dk), ()):
+            currentPoint = self.points[pointIndex]
+            distanceSquared = ((currentPoint[0] - point[0]) ** 2 + (currentPoint[1] - point[1]) ** 2 + (currentPoint[2] - point[2]) ** 2)
+            if distanceSquared < minDistanceSquared:
+              return True
+    return False
+
+  def insert(self, point):
+    if self.numberOfPoints == len(self.points):
+      # Grow the buffer geometrically so that inserts stay amortized constant time
+      grownPoints = np.empty((2 * len(self.points), 3))
+      grownPoints[:self.numberOfPoints] = self.points[:self.numberOfPoints]
+      self.points = grownPoints
+    self.points[self.numberOfPoints] = point[:3]
+    self.cells.setdefault(self.cellIndex(point), []).append(self.numberOfPoints)
+    self.numberOfPoints += 1
+
+  def getPoints(self):
+    '''
+    :return: (numberOfPoints, 3) view of the collected points.
+    '''
+    return self.points[:self.numberOfPoints]
+
+#
+# Fiducial scanlines
+#
+
+def fiducialScanlineNumbers(numberOfScanlines, scanlineNumber):
+  '''
+  Chooses scanlines evenly spread around the middle scanline for bone surface detection.
+  :param numberOfScanlines: Number of scanlines of the transducer geometry.
+  :param scanlineNumber: Number of scanlines to choose.
+  :return: List of (possibly fractional) scanline numbers, middle scanline first, then alternating right and left of it.
+  '''
+  # Find the middle scanline which will always be used
+  midScanlineNumber = (numberOfScanlines - 1) / 2.0
+  scanlineNumbers = [midScanlineNumber]
+
+  # Compute the interval between scanlines for even spacing
+  scanlinesPerHalf = scanlineNumber // 2  # How many scanlines there will be per half
+  scanlineInterval = 1
+  if (scanlinesPerHalf > 0):  # If only 1 scanline there will not be any interval since only middle scanline is used
+    scanlineInterval = midScanlineNumber / scanlinesPerHalf  # Number of scanlines to move between each scanline used for fiducials
+
+  # If there is an even number of scanlines an extra scanline will need to be added after loop to make up for offset
+  evenNumberOfScanlines = False
+  if (scanlineNumber % 2 == 0):
+    scanlinesPerHalf -= 1  # Decrease by one otherwise loop would result in an extra scanline
+    evenNumberOfScanlines = True
+  for i in range(scanlinesPerHalf):
+    scanlineNumbers.append(midScanlineNumber + ((i + 1) * scanlineInterval)) # Right of middle
+    scanlineNumbers.append(midScanlineNumber - ((i + 1) * scanlineInterval)) # Left of middle
+
+  # If there was an even number of scanlines, add the extra scanline
+  if (evenNumberOfScanlines):
+    scanlineNumbers.append(midScanlineNumber + ((scanlinesPerHalf + 1) * scanlineInterval))  # Added to right arbitrarily
+
+  return scanlineNumbers
@@ -0,0 +1,253 @@
+'''
+Finds bone surface detection parameters of SkullMarker offline, on a recorded sequence with manual segmentations, e.g.
+
+  python -m SkullMarkerLib.ParameterSweep sequence.mha config.xml TestManualSegmentations --csv sweep.csv
+
+Every combination of thresholds, depth windows and minimum distances is scored with the USGeometry segmentation
+metrics, and the Pareto-optimal settings are printed.
+'''
+import os
+import csv
+import glob
+import json
+import argparse
+import itertools
+import collections
+import numpy as np
+
+from USGeometryLib import MetaImageSequence
+from USGeometryLib.ScanConversion import readScanConversionGeometry
+from USGeometryLib.ScanlineGeometry import ScanlineGeometry, ScanlineSampler
+from USGeometryLib.SparseLabels import SparseLabelVolume, sumSparseSegmentationFiles
+from USGeometryLib.SegmentationMetrics import computeScanlineStatistics, evaluateScanlineStatistics
+from .BoneSurfaceDetection import boneSurfaceNeighborhood, boneSurfaceCandidateChecks, fiducialScanlineNumbers
+from .RecordedSequences import sequenceImageToReference, readScanlineProfiles
+
+#
+# ParameterSweep
+#
+
+SweepResult = collections.namedtuple('SweepResult', [
+  'threshold', 'minDepthMm', 'maxDepthMm', 'minDistance', # Detection parameters
+  'numberOfPoints', # Accepted bone surface points
+  'truePositive', 'falsePositive', 'falseNegative']) # USGeometry metric percentages, None without points to compare
+
+def boneSurfaceCandidates(scanlineProfiles):
+  '''
+  Evaluates the threshold independent bone surface checks of detectBoneSurfaceDepths at every depth.
+  :param scanlineProfiles: Intensities with depth along the last axis.
+  :return: [candidateValues, candidateChecks], arrays with the shape of scanlineProfiles. Depths without
+    enough neighbors for the checks are False in candidateChecks.
+  '''
+  profiles = np.asarray(scanlineProfiles).astype(np.int32)
+  numberOfDepths = profiles.shape[-1]
+  candidateChecks = np.zeros(profiles.shape, dtype=bool)
+  if numberOfDepths <= 2 * boneSurfaceNeighborhood:
+    return [profiles, candidateChecks]
+  candidateChecks[..., boneSurfaceNeighborhood:numberOfDepths - boneSurfaceNeighborhood] = boneSurfaceCandidateChecks(
+    profiles, boneSurfaceNeighborhood, numberOfDepths - boneSurfaceNeighborhood)[1]
+  return [profiles, candidateChecks]
+
+def deepestQualifyingDepths(candidateValues, candidateChecks, threshold):
+  '''
+  :param candidateValues, candidateChecks: Results of boneSurfaceCandidates.
+  :return: Integer array with the shape of candidateValues, holding the deepest depth at or above every depth that
+    qualifies as bone surface with the threshold, or -1 where there is none. Any depth window is then a lookup.
+  '''
+  qualifying = candidateChecks & (candidateValues > threshold)
+  depthIndices = np.arange(qualifying.shape[-1])
+  return np.maximum.accumulate(np.where(qualifying, depthIndices, -1), axis=-1)
+
+def windowBoneSurfaceDepths(deepestQualifying, startingDepthPixel, endingDepthPixel):
+  '''
+  :param deepestQualifying: Result of deepestQualifyingDepths.
+  :return: The result of detectBoneSurfaceDepths with the same depth window and threshold.
+  '''
+  endingDepthPixel = min(int(endingDepthPixel), deepestQualifying.shape[-1])
+  if endingDepthPixel <= 0:
+    return np.full(deepestQualifying.shape[:-1], -1, dtype=int)
+  boneSurfaceDepths = deepestQualifying[..., endingDepthPixel - 1]
+  return np.where(boneSurfaceDepths >= int(startingDepthPixel), boneSurfaceDepths, -1)
+
+def closePointPairs(points, maximumDistance):
+  '''
+  Finds all pairs of points closer than a distance at once, with a grid of cells as wide as the distance.
+  :param points: (numberOfPoints, 3) array.
+  :return: [firstIndices, secondIndices, distances] of the pairs, firstIndices < secondIndices.
+  '''
+  points = np.asarray(points, dtype=float)
+  numberOfPoints = len(points)
+  if maximumDistance <= 0 or numberOfPoints < 2:
+    return [np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)]
+  cells = np.floor(points / maximumDistance).astype(np.int64)
+  cells -= cells.min(axis=0) - 1 # Neighbor cells of every point have nonnegative indices
+  gridShape = tuple(cells.max(axis=0) + 2)
+  order = np.argsort(np.ravel_multi_index(cells.T, gridShape), kind='mergesort')
+  sortedKeys = np.ravel_multi_index(cells[order].T, gridShape)
+  [firstIndices, secondIndices] = [[], []]
+  for offset in itertools.product((-1, 0, 1), repeat=3):
+    neighborKeys = np.ravel_multi_index((cells + offset).T, gridShape)
+    first = np.searchsorted(sortedKeys, neighborKeys, side='left')
+    counts = np.searchsorted(sortedKeys, neighborKeys, side='right') - first
+    # Sorted positions of the points in the neighbor cell of every point
+    positions = np.arange(counts.sum()) + np.repeat(first - np.cumsum(counts) + counts, counts)
+    pointIndices = np.repeat(np.arange(numberOfPoints), counts)
+    neighborIndices = order[positions]
+    ordered = pointIndices < neighborIndices # Every pair is found from both of its points
+    firstIndices.append(pointIndices[ordered])
+    secondIndices.append(neighborIndices[ordered])
+  firstIndices = np.concatenate(firstIndices)
+  secondIndices = np.concatenate(secondIndices)
+  distances = np.sqrt(((points[firstIndices] - points[secondIndices]) ** 2).sum(axis=1))
+  close = distances < maximumDistance
+  return [firstIndices[close], secondIndices[close], distances[close]]
+
+def minimumDistanceFilter(numberOfPoints, pointPairs, minDistance):
+  '''
+  Keeps the points that FiducialPointGrid accepts when they are inserted in order: a point is accepted if no
+  accepted point before it is closer than minDistance.
+  :param pointPairs: Result of closePointPairs with a distance of at least minDistance.
+  :return: Boolean array of the accepted points.
+  '''
+  accepted = np.ones(numberOfPoints, dtype=bool)
+  if minDistance <= 0:
+    return accepted
+  [firstIndices, secondIndices, distances] = pointPairs
+  close = distances < minDistance
+  order = np.argsort(secondIndices[close], kind='mergesort')
+  earlierIndices = firstIndices[close][order]
+  [dependentPoints, starts] = np.unique(secondIndices[close][order], return_index=True)
+  ends = np.append(starts[1:], len(earlierIndices))
+  # Whether a point is accepted depends on which earlier points were, so only the points with close earlier
+  # points are decided one at a time
+  for pointIndex, start, end in zip(dependentPoints, starts, ends):
+    if accepted[earlierIndices[start:end]].any():
+      accepted[pointIndex] = False
+  return accepted
+
+def sweepDetectionParameters(sequenceFile, configFile, groundTruthFiles, thresholds, depthWindowsMm, minDistances,
+                             falseNegativeDistance=2.0, scanlineNumber=None):
+  '''
+  Evaluates bone surface detection of a recorded sequence for every combination of parameters, against manual
+  segmentations of the same sequence. Scanline profiles, candidate checks and ground truth statistics are computed once;
+  each threshold then takes one pass over the profiles that serves all depth windows, and the close point pairs of
+  each depth window serve all minimum distances. Detected points are scored like an algorithm segmentation by USGeometry.
+  :param sequenceFile: Path of the PLUS sequence .mha file.
+  :param configFile: Path of the PLUS configuration file of the recording.
+  :param groundTruthFiles: Manual segmentation files of the sequence, summed as ground truth.
+  :param thresholds: Bone surface thresholds to evaluate.
+  :param depthWindowsMm: (minDepthMm, maxDepthMm) pairs to evaluate.
+  :param minDistances: Minimum distances between points in mm to evaluate.
+  :param falseNegativeDistance: Distance in mm used by the metrics.
+  :param scanlineNumber: Number of scanlines to search, all scanlines of the geometry by default.
+  :return: [results, paretoResults], lists of SweepResult. paretoResults are the settings that no other setting beats
+    in both true positive and false negative rate, sorted by false negative rate.
+  '''
+  sequence = MetaImageSequence(sequenceFile)
+  imageToReference = sequenceImageToReference(sequence, configFile)
+  validFrames = np.isfinite(imageToReference).all(axis=(1, 2))
+  scanlineGeometry = ScanlineGeometry(readScanConversionGeometry(configFile))
+  scanlineGeometry.checkImageDimensions((sequence.frameShape[1], sequence.frameShape[0]))
+  lookupTable = scanlineGeometry.getLookupTable()
+  if scanlineNumber is None:
+    scanlineNumber = scanlineGeometry.numberOfScanlines
+  [startPoints, endPoints] = scanlineGeometry.computeScanlineEndPoints(fiducialScanlineNumbers(scanlineGeometry.numberOfScanlines, scanlineNumber))
+  scanlineSampler = ScanlineSampler(startPoints, endPoints, scanlineGeometry.outputImageSizePixel[:2], scanlineGeometry.outputImageSpacing)
+
+  # Ground truth statistics without algorithm points, algorithm samples are filled in for every setting
+  groundTruth = sumSparseSegmentationFiles(list(groundTruthFiles))
+  volumeShape = (sequence.numberOfFrames,) + sequence.frameShape
+  if groundTruth.shape != volumeShape:
+    raise ValueError("Ground truth size {} does not match the sequence size {}".format(groundTruth.shape, volumeShape))
+  statistics = computeScanlineStatistics(groundTruth, SparseLabelVolume(volumeShape, [], np.zeros(0, dtype=np.uint8)),
+    lookupTable, scanlineGeometry.outputImageSpacing)
+
+  def scorePoints(frameIndices, pixels):
+    # Label map semantics: every pixel counts once per frame, and once for every scanline sample on it
+    pointKeys = np.unique(frameIndices * (volumeShape[1] * volumeShape[2]) + pixels[:, 1] * volumeShape[2] + pixels[:, 0])
+    [frames, flatPixels] = np.divmod(pointKeys, volumeShape[1] * volumeShape[2])
+    [pointIndices, sampleScanlines, sampleNumbers] = lookupTable.samplesAtPixels(flatPixels)
+    sampleFrames = frames[pointIndices]
+    sampleX = lookupTable.sampleIndices[sampleScanlines, sampleNumbers, 0]
+    sampleY = lookupTable.sampleIndices[sampleScanlines, sampleNumbers, 1]
+    distances = np.sqrt((sampleX - statistics.xMean[sampleFrames, sampleScanlines]) ** 2 + (sampleY - statistics.yMean[sampleFrames, sampleScanlines]) ** 2)
+    return evaluateScanlineStatistics(statistics._replace(algorithmFrames=sampleFrames, algorithmScanlines=sampleScanlines,
+      algorithmDistances=distances), falseNegativeDistance)
+
+  # Scanline profiles of all frames, (frames, scanlines, depth)
+  scanlineProfiles = readScanlineProfiles(sequence, scanlineSampler)
+  [candidateValues, candidateChecks] = boneSurfaceCandidates(scanlineProfiles)
+
+  results = []
+  for threshold in thresholds:
+    deepestQualifying = deepestQualifyingDepths(candidateValues, candidateChecks, threshold)
+    for [minDepthMm, maxDepthMm] in depthWindowsMm:
+      startingDepthPixel = int(minDepthMm / scanlineGeometry.outputImageSpacing[1])
+      endingDepthPixel = int(maxDepthMm / scanlineGeometry.outputImageSpacing[1])
+      boneSurfaceDepths = windowBoneSurfaceDepths(deepestQualifying, startingDepthPixel, endingDepthPixel)
+
+      [frameIndices, scanlineIndices] = np.nonzero((boneSurfaceDepths >= 0) & validFrames[:, np.newaxis])
+      boneSurfacePixels = scanlineSampler.pixelPositions(scanlineIndices, boneSurfaceDepths[frameIndices, scanlineIndices])
+      numberOfPoints = len(frameIndices)
+      boneSurfacePoints = np.column_stack([boneSurfacePixels, np.zeros(numberOfPoints), np.ones(numberOfPoints)])
+      referencePoints = np.einsum('nij,nj->ni', imageToReference[frameIndices], boneSurfacePoints)[:, :3]
+
+      pointPairs = closePointPairs(referencePoints, max(minDistances))
+      for minDistance in minDistances:
+        accepted = minimumDistanceFilter(numberOfPoints, pointPairs, minDistance)
+        metrics = scorePoints(frameIndices[accepted], boneSurfacePixels[accepted])
+        results.append(SweepResult(threshold, minDepthMm, maxDepthMm, minDistance, int(accepted.sum()),
+          metrics.truePositive, metrics.falsePositive, metrics.falseNegative))
+
+  return [results, paretoOptimalResults(results)]
+
+def paretoOptimalResults(results):
+  '''
+  :param results: SweepResult list.
+  :return: Results with metrics that no other result beats in true positive rate without a worse false
+    negative rate (or the other way around), sorted by false negative rate.
+  '''
+  scored = sorted([result for result in results if result.truePositive is not None],
+                  key=lambda result: (result.falseNegative, -result.truePositive))
+  paretoResults = []
+  bestTruePositive = None
+  for result in scored:
+    if bestTruePositive is None or result.truePositive > bestTruePositive:
+      paretoResults.append(result)
+      bestTruePositive = result.truePositive
+  return paretoResults
+
+def writeSweepResultsCsv(results, outputFile):
+  with open(outputFile, 'w') as outputStream:
+    writer = csv.writer(outputStream, lineterminator='\n')
+    writer.writerow(SweepResult._fields)
+    for result in results:
+      writer.writerow(result)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Sweep SkullMarker bone surface detection parameters on a recorded sequence.')
+  parser.add_argument('sequenceFile', help='PLUS sequence .mha file')
+  parser.add_argument('configFile', help='PLUS configuration file of the recording')
+  parser.add_argument('manualSegmentations', help='Directory of manual segmentation .mha files of the sequence')
+  parser.add_argument('--thresholds', type=float, nargs='+', default=[100, 125, 150, 175, 200, 225, 250], help='Bone surface thresholds')
+  parser.add_argument('--starting-depths', type=float, nargs='+', default=[2], help='Depths in mm where the search starts')
+  parser.add_argument('--ending-depths', type=float, nargs='+', default=[10, 20, 40, 60], help='Depths in mm where the search ends')
+  parser.add_argument('--minimum-distances', type=float, nargs='+', default=[0, 1, 2, 4], help='Minimum distances between points in mm')
+  parser.add_argument('--false-negative-distance', type=float, default=2.0, help='False negative distance in mm')
+  parser.add_argument('--scanlines', type=int, default=None, help='Number of scanlines to search (default: all)')
+  parser.add_argument('--csv', default=None, help='Output CSV file of every evaluated setting')
+  args = parser.parse_args(argv)
+
+  depthWindowsMm = [(startingDepth, endingDepth) for startingDepth in args.starting_depths
+                    for endingDepth in args.ending_depths if endingDepth > startingDepth]
+  groundTruthFiles = sorted(glob.glob(os.path.join(args.manualSegmentations, '*.mha')))
+  [results, paretoResults] = sweepDetectionParameters(args.sequenceFile, args.configFile, groundTruthFiles,
+    args.thresholds, depthWindowsMm, args.minimum_distances, args.false_negative_distance, args.scanlines)
+  if args.csv:
+    writeSweepResultsCsv(results, args.csv)
+  print(json.dumps([result._asdict() for result in paretoResults], indent=2))
+  return 0
+
+if __name__ == '__main__':
+  import sys
+  sys.exit(main())
@@ -0,0 +1,125 @@
+import numpy as np
+
+from USGeometryLib import MetaImageSequence
+from USGeometryLib.ScanConversion import readScanConversionGeometry, readConfigTransform
+from USGeometryLib.ScanlineGeometry import ScanlineGeometry, ScanlineSampler
+from .BoneSurfaceDetection import detectBoneSurfaceDepths, FiducialPointGrid, fiducialScanlineNumbers
+
+#
+# Recorded sequences
+#
+
+def invertRigidTransforms(transforms):
+  '''
+  :param transforms: (..., 4, 4) array of rigid transforms.
+  :return: Inverse transforms, NaN matrices stay NaN.
+  '''
+  inverses = np.zeros_like(transforms)
+  rotationsTransposed = np.swapaxes(transforms[..., :3, :3], -1, -2)
+  inverses[..., :3, :3] = rotationsTransposed
+  inverses[..., :3, 3] = -np.einsum('...ij,...j->...i', rotationsTransposed, transforms[..., :3, 3])
+  inverses[..., 3, 3] = 1.0
+  return inverses
+
+
+def sequenceImageToReference(sequence, configFile):
+  '''
+  Computes the image to reference transform of every frame, either embedded in the sequence
+  or as ReferenceToTracker^-1 * ProbeToTracker * ImageToProbe, with ImageToProbe read from the config file.
+  When the sequence has no reference, tracker coordinates are used.
+  :param sequence: USGeometryLib.MetaImageSequence
+  :return: (frames, 4, 4) array, NaN for frames without valid transforms.
+  '''
+  frameTransforms = dict((transformName, sequence.getTransforms(transformName)) for transformName in sequence.transformNames())
+  if 'ImageToReference' in frameTransforms:
+    return frameTransforms['ImageToReference']
+  imageToProbe = readConfigTransform(configFile, 'Image', 'Probe')
+  if imageToProbe is None or 'ProbeToTracker' not in frameTransforms:
+    raise ValueError('Sequence has neither ImageToReference nor ProbeToTracker transforms with an ImageToProbe calibration')
+  imageToTracker = np.einsum('fij,jk->fik', frameTransforms['ProbeToTracker'], imageToProbe)
+  if 'ReferenceToTracker' not in frameTransforms:
+    return imageToTracker
+  return np.einsum('fij,fjk->fik', invertRigidTransforms(frameTransforms['ReferenceToTracker']), imageToTracker)
+
+
+def writePointCloud(points, outputFile):
+  '''
+  Writes points as a Slicer markups fiducial file if outputFile ends with .fcsv, as comma separated values otherwise.
+  :param points: (numberOfPoints, 4) array of x, y, z and frame index.
+  '''
+  with open(outputFile, 'w') as outputStream:
+    if outputFile.lower().endswith('.fcsv'):
+      outputStream.write('# Markups fiducial file version = 4.6\n')
+      outputStream.write('# CoordinateSystem = 0\n')
+      outputStream.write('# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID\n')
+      for pointIndex, [x, y, z, frameIndex] in enumerate(points):
+        outputStream.write('vtkMRMLMarkupsFiducialNode_{0},{1},{2},{3},0,0,0,1,1,1,0,F-{4},frame {5},\n'.format(pointIndex, x, y, z, pointIndex + 1, int(frameIndex)))
+    else:
+      outputStream.write('x,y,z,frame\n')
+      for [x, y, z, frameIndex] in points:
+        outputStream.write('{0},{1},{2},{3}\n'.format(x, y, z, int(frameIndex)))
+
+
+def readScanlineProfiles(sequence, scanlineSampler):
+  '''
+  Only the scanline samples of each frame are kept, frames are streamed from the file.
+  :param sequence: USGeometryLib.MetaImageSequence
+  :param scanlineSampler: USGeometryLib.ScanlineSampler of the scanlines.
+  :return: (frames, scanlines, depth) array of intensities.
+  '''
+  scanlineProfiles = None
+  for frameIndex, frame in enumerate(sequence.iterFrames()):
+    frameProfiles = scanlineSampler.sample(frame)
+    if scanlineProfiles is None:
+      scanlineProfiles = np.empty((sequence.numberOfFrames,) + frameProfiles.shape, dtype=frameProfiles.dtype)
+    scanlineProfiles[frameIndex] = frameProfiles
+  return scanlineProfiles
+
+
+def detectSequenceBoneSurfacePoints(sequenceFile, configFile, scanlineNumber=None, minDepthMm=2.0, maxDepthMm=10.0, threshold=200, minDistance=2.0):
+  '''
+  Marks bone surface points on all frames of a recorded sequence at once. Points are in the reference
+  coordinate frame of the recording (tracker if the recording has no reference).
+  :param sequenceFile: Path of the PLUS sequence .mha file.
+  :param configFile: Path of the PLUS configuration file of the recording.
+  :param scanlineNumber: Number of scanlines to search, all scanlines of the geometry by default.
+  :param minDepthMm: Depth where the search for bone surface starts.
+  :param maxDepthMm: Depth where the search for bone surface ends.
+  :param threshold: Minimum intensity of bone surface points.
+  :param minDistance: Minimum distance between accepted points in mm.
+  :return: (numberOfPoints, 4) array of accepted points as x, y, z and frame index.
+  :raises ValueError: if the sequence does not match the configuration, or has no usable transforms.
+  '''
+  sequence = MetaImageSequence(sequenceFile)
+  imageToReference = sequenceImageToReference(sequence, configFile)
+
+  scanlineGeometry = ScanlineGeometry(readScanConversionGeometry(configFile))
+  scanlineGeometry.checkImageDimensions((sequence.frameShape[1], sequence.frameShape[0]))
+  if scanlineNumber is None:
+    scanlineNumber = scanlineGeometry.numberOfScanlines
+  [startPoints, endPoints] = scanlineGeometry.computeScanlineEndPoints(fiducialScanlineNumbers(scanlineGeometry.numberOfScanlines, scanlineNumber))
+
+  # Fiducials for bone surface will be placed between these two values
+  startingDepthPixel = int(minDepthMm / scanlineGeometry.outputImageSpacing[1])
+  endingDepthPixel = int(maxDepthMm / scanlineGeometry.outputImageSpacing[1])
+
+  # Bone surface depths of all scanlines on all frames, (frames, scanlines)
+  scanlineSampler = ScanlineSampler(startPoints, endPoints, scanlineGeometry.outputImageSizePixel[:2], scanlineGeometry.outputImageSpacing)
+  scanlineProfiles = readScanlineProfiles(sequence, scanlineSampler)
+  boneSurfaceDepths = detectBoneSurfaceDepths(scanlineProfiles, startingDepthPixel, endingDepthPixel, threshold)
+
+  validFrames = np.isfinite(imageToReference).all(axis=(1, 2))
+  [frameIndices, scanlineIndices] = np.nonzero((boneSurfaceDepths >= 0) & validFrames[:, np.newaxis])
+  numberOfPoints = len(frameIndices)
+  boneSurfacePixels = scanlineSampler.pixelPositions(scanlineIndices, boneSurfaceDepths[frameIndices, scanlineIndices])
+  boneSurfacePoints = np.column_stack([boneSurfacePixels, np.zeros(numberOfPoints), np.ones(numberOfPoints)])
+  referencePoints = np.einsum('nij,nj->ni', imageToReference[frameIndices], boneSurfacePoints)[:, :3]
+
+  # Minimum distance filtering depends on the order of points, so it follows the frames
+  fiducialPoints = FiducialPointGrid(minDistance)
+  acceptedPoints = []
+  for referencePoint, frameIndex in zip(referencePoints, frameIndices):
+    if not fiducialPoints.isTooClose(referencePoint):
+      fiducialPoints.insert(referencePoint)
+      acceptedPoints.append([referencePoint[0], referencePoint[1], referencePoint[2], frameIndex])
+  return np.reshape(np.array(acceptedPoints, dtype=float), (-1, 4))
@@ -0,0 +1,3 @@
+from .BoneSurfaceDetection import detectBoneSurfaceDepths, FiducialPointGrid, fiducialScanlineNumbers
+from .RecordedSequences import invertRigidTransforms, sequenceImageToReference, writePointCloud, readScanlineProfiles, detectSequenceBoneSurfacePoints
+from .ParameterSweep import SweepResult, sweepDetectionParameters, paretoOptimalResults
@@ -0,0 +1,169 @@
+'''
+Benchmarks of the USGeometry and SkullMarker hot paths on the test data in USGeometry/Testing/Data.
+Runs without the main window and writes the results as JSON, so they can be compared between releases:
+
+  Slicer --no-main-window --python-script USGeometryBenchmark.py --output results.json
+
+It is also registered as a test with one repeat (ctest -R USGeometryBenchmark), which checks that every benchmark runs.
+
+Every result records the median and minimum time of the repeats, frames per second where the benchmark
+processes frames, and the peak memory allocated by Python and numpy during one run.
+'''
+import os, sys, glob, json, time, platform, argparse, logging
+import numpy
+
+modulesDirectory = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+for moduleName in ['USGeometry', 'SkullMarker']:
+  if os.path.join(modulesDirectory, moduleName) not in sys.path:
+    sys.path.append(os.path.join(modulesDirectory, moduleName))
+
+import vtk, qt, slicer
+import USGeometry, SkullMarker
+from USGeometryLib import MetaImageSequence
+from USGeometryLib.ScanlineGeometry import resampleScanlines
+from USGeometryLib.SegmentationMerging import sumSegmentationFiles
+
+testDataPath = os.path.join(modulesDirectory, 'USGeometry', 'Testing', 'Data')
+
+datasets = {
+  'Curvilinear': {
+    'configFile': os.path.join(testDataPath, 'Curvilinear', 'SpineUltrasound-Lumbar-C5_config.xml'),
+    'sequenceFile': os.path.join(testDataPath, 'Curvilinear', 'SpineUltrasound-Lumbar-C5-Trimmed.mha'),
+    'segmentationsDirectory': os.path.join(testDataPath, 'Curvilinear', 'TestManualSegmentations'),
+    },
+  'Linear': {
+    'configFile': os.path.join(testDataPath, 'Linear', 'BoneUltrasound_L14_config.xml'),
+    'sequenceFile': os.path.join(testDataPath, 'Linear', 'BoneUltrasound_L14_Trimmed.mha'),
+    'segmentationsDirectory': os.path.join(testDataPath, 'Linear', 'TestManualSegmentations'),
+    },
+  }
+
+def measure(name, function, numberOfFrames=None, repeats=5, setUp=None):
+  '''
+  Times function, first run is a warm up that also measures peak memory.
+  :param setUp: Called without arguments before every run and not timed, e.g. to clear caches that function would reuse.
+  :return: Result dictionary.
+  '''
+  try:
+    import tracemalloc
+  except ImportError:
+    tracemalloc = None
+  if setUp is not None:
+    setUp()
+  if tracemalloc is not None:
+    tracemalloc.start()
+  function()
+  peakMemoryBytes = None
+  if tracemalloc is not None:
+    peakMemoryBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+  durations = []
+  for repeat in range(repeats):
+    if setUp is not None:
+      setUp()
+    startTime = time.time()
+    function()
+    durations.append(time.time() - startTime)
+  medianSeconds = float(numpy.median(durations))
+  result = {
+    'name': name,
+    'repeats': repeats,
+    'medianSeconds': medianSeconds,
+    'minSeconds': min(durations),
+    'peakMemoryBytes': peakMemoryBytes,
+    }
+  if numberOfFrames is not None:
+    result['frames'] = numberOfFrames
+    result['framesPerSecond'] = numberOfFrames / medianSeconds if medianSeconds > 0 else None
+  logging.info('{0}: {1:.4f} s'.format(name, medianSeconds))
+  return result
+
+def benchmarkDataset(datasetName, dataset, repeats):
+  results = []
+  prefix = datasetName + '.'
+  configFile = dataset['configFile']
+  sequence = MetaImageSequence(dataset['sequenceFile'])
+  numberOfFrames = sequence.numberOfFrames
+  segmentationFiles = sorted(glob.glob(os.path.join(dataset['segmentationsDirectory'], '*.mha')))
+
+  results.append(measure(prefix + 'parseConfig', lambda: USGeometry.parseScanConversionGeometry(configFile), repeats=repeats))
+  results.append(measure(prefix + 'readSequence', lambda: MetaImageSequence(dataset['sequenceFile']).getFrames().sum(), numberOfFrames, repeats))
+
+  volumeNode = slicer.util.loadVolume(dataset['sequenceFile'], returnNode=True)[1]
+  logic = USGeometry.USGeometryLogic()
+  logic.setup(configFile, volumeNode)
+  results.append(measure(prefix + 'scanlineLookupTable', logic.createScanlineLookupTable, repeats=repeats))
+  volumeArray = slicer.util.array(volumeNode.GetID())
+  results.append(measure(prefix + 'resampleScanlines', lambda: resampleScanlines(volumeArray, logic.lookupTable), numberOfFrames, repeats))
+
+  scanlineNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+  results.append(measure(prefix + 'createScanlines', lambda: logic.createScanlines(scanlineNode), numberOfFrames, repeats))
+
+  mergedNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+  results.append(measure(prefix + 'sumSegmentationFiles', lambda: sumSegmentationFiles(segmentationFiles), numberOfFrames, repeats))
+  results.append(measure(prefix + 'sumManualSegmentations', lambda: logic.sumManualSegmentations(dataset['segmentationsDirectory'], mergedNode), numberOfFrames, repeats))
+
+  # The first rater's segmentation stands in for an algorithm segmentation
+  algorithmNode = slicer.util.loadLabelVolume(segmentationFiles[0], returnNode=True)[1]
+  outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+  metricLabels = [qt.QLabel(), qt.QLabel(), qt.QLabel()]
+  def clearScanlineStatistics():
+    # Otherwise every run after the warm up returns the cached statistics without sampling the scanlines
+    logic.scanlineStatisticsKey = None
+    logic.scanlineGroundTruthKey = None
+  results.append(measure(prefix + 'computeMergedSegmentationMetrics',
+    lambda: logic.computeMergedSegmentationMetrics(mergedNode, outputNode, algorithmNode, 2.0, *metricLabels), numberOfFrames, repeats,
+    setUp=clearScanlineStatistics))
+
+  # SkullMarker detection frame by frame as on live images, and on the whole recording at once
+  skullMarkerLogic = SkullMarker.SkullMarkerLogic()
+  skullMarkerLogic.setMinMaxDepth(2, 60)
+  skullMarkerLogic.setMinimumDistanceBetween(2)
+  skullMarkerLogic.usGeometryLogic = logic
+  skullMarkerLogic.computeFiducialScanlines(logic.numberOfScanlines)
+  frames = sequence.getFrames()
+  ijkToRas = numpy.eye(4)
+  def detectFrames():
+    skullMarkerLogic.fiducialPoints = None
+    for frame in frames:
+      skullMarkerLogic.acceptedBoneSurfacePoints(frame, ijkToRas)
+  results.append(measure(prefix + 'skullMarkerLiveDetection', detectFrames, numberOfFrames, repeats))
+  results.append(measure(prefix + 'skullMarkerProcessSequence',
+    lambda: skullMarkerLogic.processSequence(dataset['sequenceFile'], configFile), numberOfFrames, repeats))
+
+  slicer.mrmlScene.Clear(0)
+  return results
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Benchmark USGeometry and SkullMarker on the bundled test data.')
+  parser.add_argument('--output', default=None, help='JSON results file, printed to the standard output by default')
+  parser.add_argument('--repeats', type=int, default=5, help='Timed runs of each benchmark')
+  parser.add_argument('--dataset', choices=sorted(datasets.keys()), action='append', help='Datasets to run, all by default')
+  args = parser.parse_args(argv)
+
+  results = []
+  for datasetName in args.dataset or sorted(datasets.keys()):
+    results.extend(benchmarkDataset(datasetName, datasets[datasetName], args.repeats))
+
+  report = {
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'platform': platform.platform(),
+    'python': platform.python_version(),
+    'numpy': numpy.__version__,
+    'vtk': vtk.vtkVersion.GetVTKVersion(),
+    'slicer': slicer.app.applicationVersion,
+    'benchmarks': results,
+    }
+  if args.output:
+    with open(args.output, 'w') as outputFile:
+      json.dump(report, outputFile, indent=2)
+  else:
+    print(json.dumps(report, indent=2))
+  return 0
+
+if __name__ == '__main__':
+  exitCode = main(sys.argv[1:])
+  if hasattr(slicer.app, 'exit'):
+    slicer.app.exit(exitCode)
+  sys.exit(exitCode)
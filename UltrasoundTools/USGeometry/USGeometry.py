@@ -4,6 +4,13 @@ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import numpy, math
+from USGeometryLib.ScanConversion import ScanConversionGeometry, readScanConversionGeometry, parseScanConversionGeometry, readConfigTransform
+from USGeometryLib.ScanlineGeometry import ScanlineGeometry, ScanlineLookupTable, getScanlineLookupTable, rasterizeScanlines, sampleScanlines, resampleScanlines
+from USGeometryLib.SegmentationMetrics import computeScanlineGroundTruth, computeScanlineStatistics, evaluateScanlineStatistics, computeMetricsCurve, metricsLabelMap
+from USGeometryLib.ArrayDiskCache import ArrayDiskCache, cachedSumSegmentationFiles, cachedResampleScanlines
+from USGeometryLib.SparseLabels import SparseLabelVolume
+from USGeometryLib.Profiling import Profiler, profiledMethod
+from USGeometryLib.MetricsTable import computeScanlineMetricsTable, computeFrameMetricsTable, logMetricsTable, saveMetricsTable
 
 #
 # USGeometry
@@ -36,6 +43,10 @@ class USGeometryWidget(ScriptedLoadableModuleWidget):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleWidget.__init__(self, parent)
+    self.logic = USGeometryLogic()
+
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
 
@@ -128,11 +139,19 @@ class USGeometryWidget(ScriptedLoadableModuleWidget):
     self.falseNegativeDistance.setMinimum(0)
     self.falseNegativeDistance.setSuffix(" mm")
 
+    #
+    # Draw region lines
+    #
+    self.regionLinesCheckBox = qt.QCheckBox()
+    self.regionLinesCheckBox.checked = False
+    self.regionLinesCheckBox.setToolTip("Draw the false negative and acceptable regions in the output segmentation as lines along the scanlines, instead of only their edge points.")
+
     #
     # Parameters group box
     #
     self.inputParametersLayout = qt.QFormLayout()
     self.inputParametersLayout.addRow("False negative distance: ", self.falseNegativeDistance)
+    self.inputParametersLayout.addRow("Draw region lines: ", self.regionLinesCheckBox)
     self.parametersGroupBox = qt.QGroupBox()
     self.parametersGroupBox.setTitle("Parameters")
     self.parametersGroupBox.setLayout(self.inputParametersLayout)
@@ -256,10 +275,16 @@ class USGeometryWidget(ScriptedLoadableModuleWidget):
     self.computeMetricsButton.toolTip = "Compute the true positive and false negative metrics of a segmentation"
     self.computeMetricsButton.enabled = False
 
+    # Button for saving the per-frame and per-scanline metrics
+    self.exportMetricsTablesButton = qt.QPushButton("Export Metrics Tables")
+    self.exportMetricsTablesButton.toolTip = "Save the metrics of every frame and every scanline of the last computation as .csv or .npz tables"
+    self.exportMetricsTablesButton.enabled = False
+
     # Add buttongs to functions section
     functionsFormLayout.addWidget(self.createScanlinesButton)
     functionsFormLayout.addWidget(self.createMergedManualSegmentationButton)
     functionsFormLayout.addWidget(self.computeMetricsButton)
+    functionsFormLayout.addWidget(self.exportMetricsTablesButton)
 
     # Connections
 
@@ -292,6 +317,8 @@ class USGeometryWidget(ScriptedLoadableModuleWidget):
     self.createScanlinesButton.connect('clicked(bool)', self.onCreateScanlinesButton)
     # Compute metrics
     self.computeMetricsButton.connect('clicked(bool)', self.onComputeMetricsButton)
+    # Export metrics tables
+    self.exportMetricsTablesButton.connect('clicked(bool)', self.onExportMetricsTablesButton)
 
     # Add vertical spacer
     self.layout.addStretch(1)
@@ -337,16 +364,22 @@ class USGeometryWidget(ScriptedLoadableModuleWidget):
     self.directory.setText(directoryName)
 
   def onCreateScanlinesButton(self):
-    logic = USGeometryLogic(self.configFile.text, self.inputSelector.currentNode())
-    logic.createScanlines(self.scanlines.currentNode())
+    self.logic.setup(self.configFile.text, self.inputSelector.currentNode())
+    self.logic.createScanlines(self.scanlines.currentNode())
 
   def onCreateMergedManualSegmentationButton(self):
-    logic = USGeometryLogic(self.configFile.text, self.inputSelector.currentNode())
-    logic.sumManualSegmentations(self.directory.text, self.mergedManualSegmentations.currentNode())
+    self.logic.setup(self.configFile.text, self.inputSelector.currentNode())
+    self.logic.sumManualSegmentations(self.directory.text, self.mergedManualSegmentations.currentNode())
 
   def onComputeMetricsButton(self):
-    logic = USGeometryLogic(self.configFile.text, self.inputSelector.currentNode())
-    logic.computeMergedSegmentationMetrics(self.mergedManualSegmentations.currentNode(), self.outputSegmentation.currentNode(), self.algorithmSegmentation.currentNode(), self.falseNegativeDistance.value, self.truePositiveMetric, self.falseNegativeMetric, self.falsePositiveMetric)
+    self.logic.setup(self.configFile.text, self.inputSelector.currentNode())
+    self.logic.computeMergedSegmentationMetrics(self.mergedManualSegmentations.currentNode(), self.outputSegmentation.currentNode(), self.algorithmSegmentation.currentNode(), self.falseNegativeDistance.value, self.truePositiveMetric, self.falseNegativeMetric, self.falsePositiveMetric, self.regionLinesCheckBox.checked)
+    self.exportMetricsTablesButton.enabled = self.logic.metricsTables is not None
+
+  def onExportMetricsTablesButton(self):
+    fileName = qt.QFileDialog().getSaveFileName(None, "Export metrics tables", "metrics.csv", "CSV files (*.csv);;NumPy archives (*.npz)")
+    if fileName:
+      self.logic.exportMetricsTables(fileName)
 
 #
 # USGeometryLogic
@@ -367,7 +400,19 @@ class USGeometryLogic(ScriptedLoadableModuleLogic):
     self.ijkToRas = None
     self.rasToIjk = None
     self.scanlines = []
-
+    self.lookupTable = None
+    self.sampleIndices = None
+    self.scanlineStatisticsKey = None
+    self.scanlineStatistics = None
+    self.scanlineGroundTruthKey = None
+    self.scanlineGroundTruth = None
+    self.resampledScanlinesKey = None
+    self.resampledScanlines = None
+    self.arrayCache = None
+    self.metricsTables = None # [frame table, scanline table] of the last computed metrics
+    self.profiler = Profiler() # Stage timers, disabled until profiler.setEnabled(True)
+
+  @profiledMethod('setup')
   def setup(self, configFile, inputVolume):
     '''
     Computes parameters from config file.
@@ -380,431 +425,314 @@ class USGeometryLogic(ScriptedLoadableModuleLogic):
     self.ijkToRas = vtk.vtkMatrix4x4()
     self.inputVolume.GetRASToIJKMatrix(self.rasToIjk)
     self.inputVolume.GetIJKToRASMatrix(self.ijkToRas)
+    return self.setupGeometry(configFile, self.inputVolume.GetImageData().GetDimensions())
+
+  def setupGeometry(self, configFile, volumeDimensions):
+    '''
+    Computes parameters from config file without needing a volume node, e.g. for recordings read from disk.
+    :param configFile:
+    :param volumeDimensions: Image size in pixels, the first two values are checked against the config file.
+    :return: True if numbers in config file pass validity check, False otherwise.
+    '''
     self.scanlines = []
-    from xml.dom import minidom
+    self.lookupTable = None
+    self.sampleIndices = None
     # Make sure the specified configuration file exists
     if not os.path.exists(configFile):
       errorMessage = "Configuration file doesn't exist."
       slicer.util.errorDisplay(errorMessage)
       raise ValueError(errorMessage)
-    parser = minidom.parse(configFile)
-    scanConversionElement = parser.getElementsByTagName("ScanConversion")
-    # Check that that 1 ScanConversion element exists
-    if (len(scanConversionElement) < 1):
-      errorMessage = "Could not find ScanConversion element in configuration file!"
-      slicer.util.errorDisplay(errorMessage)
-      raise ValueError(errorMessage)
-    elif (len(scanConversionElement) > 1):
-      errorMessage = "Found multiple ScanConversion elements in configuration file!"
-      slicer.util.errorDisplay(errorMessage)
-      raise ValueError(errorMessage)
-
-    scanConversionElement = scanConversionElement[0]
-
-    # Values common to both linear and curvilinear
-    self.transducerGeometry = (scanConversionElement.attributes['TransducerGeometry'].value).upper()
-
-    # Verify proper transducer geometry
-    if (self.transducerGeometry != "CURVILINEAR" and self.transducerGeometry != "LINEAR"):
-      errorMessage = "TransducerGeometry must be either CURVILINEAR or LINEAR"
-      slicer.util.errorDisplay(errorMessage)
-      raise ValueError(errorMessage)
-    self.outputImageSizePixel = scanConversionElement.attributes['OutputImageSizePixel'].value
-    self.outputImageSizePixel = map(int, self.outputImageSizePixel.split(" "))
-    volumeDimensions = self.inputVolume.GetImageData().GetDimensions()
+    try:
+      with self.profiler.timer('setup.readConfig'):
+        self.scanConversionGeometry = readScanConversionGeometry(configFile)
+    except ValueError as error:
+      slicer.util.errorDisplay(str(error))
+      raise
+
+    try:
+      self.scanlineGeometry = ScanlineGeometry(self.scanConversionGeometry)
+    except ValueError as error:
+      logging.error(str(error))
+      return False
+    for name in ScanlineGeometry.parameterNames:
+      setattr(self, name, getattr(self.scanlineGeometry, name))
 
     # Check that the corresponding input volume has same image slice dimensions as
     # specified in the configuration file
-    if (self.outputImageSizePixel[0] != volumeDimensions[0]
-        or self.outputImageSizePixel[1] != volumeDimensions[1]):
-      errorMessage = "Input volume size does not correspond to size specified in configuration file.\n " \
-                     "Input volume slice: [{} {}]\n" \
-                     "Configuration file slice: [{} {}]".format(volumeDimensions[0], volumeDimensions[1], self.outputImageSizePixel[0], self.outputImageSizePixel[1])
-      slicer.util.errorDisplay(errorMessage)
-      raise ValueError(errorMessage)
+    try:
+      self.scanlineGeometry.checkImageDimensions(volumeDimensions)
+    except ValueError as error:
+      slicer.util.errorDisplay(str(error))
+      raise
 
-    self.transducerCenterPixel = scanConversionElement.attributes['TransducerCenterPixel'].value
-    self.transducerCenterPixel = map(int, self.transducerCenterPixel.split(" "))
-    self.numberOfScanlines = int(scanConversionElement.attributes['NumberOfScanLines'].value)
-    if (self.numberOfScanlines < 0):
-      errorMessage = "NumberOfScanLines: {} cannot be less than 0".format(self.numberOfScanlines)
-      slicer.util.errorDisplay(errorMessage)
-      raise ValueError(errorMessage)
-    self.outputImageSpacing = scanConversionElement.attributes['OutputImageSpacingMmPerPixel'].value
-    self.outputImageSpacing = map(float, self.outputImageSpacing.split(" "))
-    self.numberOfSamplesPerScanline = int(scanConversionElement.attributes['NumberOfSamplesPerScanLine'].value)
-
-    # Values just for curvilinear
-    if (self.transducerGeometry == "CURVILINEAR"):
-      self.thetaStartDeg = float(scanConversionElement.attributes['ThetaStartDeg'].value)
-      self.thetaStopDeg = float(scanConversionElement.attributes['ThetaStopDeg'].value)
-      self.radiusStartMm = float(scanConversionElement.attributes['RadiusStartMm'].value)
-      self.radiusStopMm = float(scanConversionElement.attributes['RadiusStopMm'].value)
-      self.totalDeg = abs(self.thetaStopDeg - self.thetaStartDeg)
-      self.degreesPerScanline = self.totalDeg / self.numberOfScanlines
-      self.circleCenter = [self.transducerCenterPixel[0], self.transducerCenterPixel[1] - self.radiusStartMm/self.outputImageSpacing[1]]
-    # Values just for linear
-    elif (self.transducerGeometry == "LINEAR"):
-      self.transducerWidthMm = float(scanConversionElement.attributes['TransducerWidthMm'].value)
-      self.imagingDepthMm = float(scanConversionElement.attributes['ImagingDepthMm'].value)
-      if int(self.transducerWidthMm / self.outputImageSpacing[0]) > self.outputImageSizePixel[0]:
-        newTransducerWidthMm = int(self.outputImageSizePixel[0] * self.outputImageSpacing[0])
-        logging.error('Transducer width: ' + str( int(self.transducerWidthMm / self.outputImageSpacing[0]) ) +
-                      ' px does not fit in output image width: ' + str( self.outputImageSizePixel[0] ) + ' px! ' +
-                      ' Try using transducer width of ' + str( newTransducerWidthMm ) + ' mm.')
-        return False
-      self.transducerWidthPixel = int(self.transducerWidthMm / self.outputImageSpacing[0])
-      self.topLeftPixel = [int(self.transducerCenterPixel[0] - 0.5 * self.transducerWidthPixel), self.transducerCenterPixel[1]]
-      # There are (numberOfScanlines - 1) spaces between first and last scanline
-      self.scanlineSpacingPixels = float(self.transducerWidthPixel - 1) / (self.numberOfScanlines - 1)
-      if int(self.imagingDepthMm / self.outputImageSpacing[1]) > self.outputImageSizePixel[1]:
-        newDepthMm = self.outputImageSizePixel[1] * self.outputImageSpacing[1]
-        logging.error('Imaging depth: ' + str(self.imagingDepthMm) + ' mm does not fit in output image size!' +
-                      ' Try using imaging depth of ' + str(newDepthMm) + ' mm or smaller.')
-        return False
-      self.scanlineLengthPixels = int(self.imagingDepthMm / self.outputImageSpacing[1])
+    # Scanline geometry is only computed the first time this probe and image size is set up
+    with self.profiler.timer('setup.lookupTable'):
+      self.lookupTable = getScanlineLookupTable(self.scanConversionGeometry, self.createScanlineLookupTable)
+    self.sampleIndices = self.lookupTable.sampleIndices
 
     # Create the scanlines
-    for i in range(self.numberOfScanlines):
-      [start, end] = self.scanlineEndPoints(i)
-      currentScanline = Scanline(start, end)
+    for start, end in zip(self.lookupTable.startPoints, self.lookupTable.endPoints):
+      currentScanline = Scanline(list(start), list(end))
       self.scanlines.append(currentScanline)
 
     return True
 
+  def createScanlineLookupTable(self):
+    [startPoints, endPoints] = self.computeScanlineEndPoints(numpy.arange(self.numberOfScanlines))
+    return ScanlineLookupTable(startPoints, endPoints, self.numberOfSamplesPerScanline, self.outputImageSizePixel[:2])
+
 
   def scanlineEndPoints(self, scanline):
-    import math
-    # Compute curvilinear xy values
-    if (self.transducerGeometry == "CURVILINEAR"):
-
-      # Compute angle for desired scanline
-      angle = self.thetaStartDeg + scanline * self.degreesPerScanline
-      angleRadians = math.pi * angle / 180
-
-      # Compute the starting point
-      startScanlineX = self.circleCenter[0] + math.sin(angleRadians) * self.radiusStartMm / self.outputImageSpacing[0]
-      startScanlineY = self.circleCenter[1] + math.cos(angleRadians) * self.radiusStartMm / self.outputImageSpacing[1]
-
-      # Compute the ending point
-      endScanlineX = self.circleCenter[0] + math.sin(angleRadians) * self.radiusStopMm / self.outputImageSpacing[0]
-      endScanlineY = self.circleCenter[1] + math.cos(angleRadians) * self.radiusStopMm / self.outputImageSpacing[1]
-
-    # Compute linear xy values
-    elif (self.transducerGeometry == "LINEAR"):
-      # Compute the starting point
-      startScanlineX = self.topLeftPixel[0] + scanline * self.scanlineSpacingPixels
-      startScanlineY = self.topLeftPixel[1]
-
-      # Compute the end point
-      endScanlineX = startScanlineX # Vertical line so same 'x' value
-      endScanlineY = self.topLeftPixel[1] + self.scanlineLengthPixels
-    else:
-      # ERROR: should not reach here
-      print("Error in scanlineEndPoints")
+    [startPoints, endPoints] = self.computeScanlineEndPoints([scanline])
+    return [list(startPoints[0]), list(endPoints[0])]
 
-    # Verify acceptable starting point for scanline
-    if (startScanlineX < 0 or startScanlineX > self.outputImageSizePixel[0]-1):
-      errorMessage = "Scanline starting point X value: {} out of bounds!".format(startScanlineX)
-      logging.error(errorMessage)
-      slicer.util.errorDisplay(errorMessage)
-      raise ValueError(errorMessage)
-    if (startScanlineY < 0 or startScanlineY > self.outputImageSizePixel[1]-1):
-      errorMessage = "Scanline starting point Y value: {} out of bounds!".format(startScanlineY)
-      slicer.util.errorDisplay(errorMessage)
-      raise ValueError(errorMessage)
-    # Verify acceptable ending point for scanline
-    if (endScanlineX < 0 or endScanlineX > self.outputImageSizePixel[0]-1):
-      errorMessage = "Scanline ending point X value: {} out of bounds!".format(endScanlineX)
-      slicer.util.errorDisplay(errorMessage)
-      raise ValueError(errorMessage)
-    if (endScanlineY < 0 or endScanlineY > self.outputImageSizePixel[1]-1):
-      errorMessage = "Scanline ending point Y value: {} out of bounds!".format(endScanlineY)
-      slicer.util.errorDisplay(errorMessage)
-      raise ValueError(errorMessage)
+  def computeScanlineEndPoints(self, scanlineNumbers):
+    '''
+    Computes the end points of several scanlines at once.
+    :param scanlineNumbers: Sequence of (possibly fractional) scanline numbers.
+    :return: [startPoints, endPoints], both (len(scanlineNumbers), 2) arrays of pixel coordinates.
+    '''
+    try:
+      return self.scanlineGeometry.computeScanlineEndPoints(scanlineNumbers)
+    except ValueError as error:
+      logging.error(str(error))
+      slicer.util.errorDisplay(str(error))
+      raise
+
+  def sampleScanlines(self, volumeArray):
+    '''
+    Gathers the scanline samples of every frame in a single indexing operation.
+    :param volumeArray: Volume voxels as a (frames, rows, columns) array, e.g. from slicer.util.array.
+    :return: Array of shape (frames, numberOfScanlines, numberOfSamplesPerScanline + 1).
+    '''
+    return sampleScanlines(volumeArray, self.sampleIndices)
 
-    # Combine XY values and return
-    startScanline = [startScanlineX, startScanlineY]
-    endScanline = [endScanlineX, endScanlineY]
+  def setArrayCacheDirectory(self, cacheDirectory, maximumSizeBytes=4 << 30):
+    '''
+    Keeps merged manual segmentations and resampled scanlines on disk between sessions.
+    :param cacheDirectory: Cache directory, or None to not cache arrays on disk.
+    :param maximumSizeBytes: Least recently used arrays are removed beyond this total size.
+    '''
+    self.arrayCache = ArrayDiskCache(cacheDirectory, maximumSizeBytes) if cacheDirectory else None
 
-    return [startScanline, endScanline]
+  def unmodifiedVolumeFile(self, volumeNode):
+    '''
+    :return: File the volume was loaded from, or None if there is none or the volume was modified since.
+    '''
+    storageNode = volumeNode.GetStorageNode()
+    if storageNode is None or volumeNode.GetModifiedSinceRead():
+      return None
+    fileName = storageNode.GetFileName()
+    return fileName if fileName and os.path.isfile(fileName) else None
 
+  def getResampledScanlines(self, volumeNode):
+    '''
+    Bilinearly interpolated scanline samples of every frame, kept until the geometry or the volume is modified.
+    With an array cache directory, volumes loaded from .mha files are resampled only once across sessions.
+    :param volumeNode: Scan converted ultrasound volume.
+    :return: float32 array of shape (frames, numberOfScanlines, numberOfSamplesPerScanline + 1).
+    '''
+    resampledKey = (self.scanConversionGeometry, volumeNode.GetID(), volumeNode.GetMTime(), volumeNode.GetImageData().GetMTime())
+    if resampledKey != self.resampledScanlinesKey:
+      # Drop the previous result first, so that two volumes are not held in memory at once
+      self.resampledScanlines = None
+      volumeFile = self.unmodifiedVolumeFile(volumeNode) if self.arrayCache is not None else None
+      if volumeFile is not None and volumeFile.lower().endswith('.mha'):
+        self.resampledScanlines = cachedResampleScanlines(self.arrayCache, volumeFile, self.scanConversionGeometry, self.lookupTable)
+      else:
+        self.resampledScanlines = resampleScanlines(slicer.util.array(volumeNode.GetID()), self.lookupTable)
+        self.resampledScanlines.flags.writeable = False
+      self.resampledScanlinesKey = resampledKey
+    return self.resampledScanlines
 
   def euclidean_distance(self,point1,point2):
       return math.sqrt((point2[0] - point1[0]) ** 2 + (point2[1] - point1[1]) ** 2 + (point2[2] - point1[2]) ** 2)
 
-  def sumManualSegmentations(self, manualSegmentationsDirectory, mergedVolume):
-    # Get the manual segmentations and create a single summed image
+  def sparseLabelsFromVolume(self, volumeNode):
+    '''
+    :return: SparseLabelVolume of the voxels of a label map node.
+    '''
+    return SparseLabelVolume.fromDense(slicer.util.array(volumeNode.GetID()))
+
+  def setVolumeFromSparseLabels(self, volumeNode, labels):
+    '''
+    Stores a SparseLabelVolume in a volume node with the geometry of the input volume. The dense image is only made here.
+    '''
+    from vtk.util import numpy_support
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(labels.shape[::-1])
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(labels.toDense().ravel(), deep=True))
+    volumeNode.SetRASToIJKMatrix(self.rasToIjk)
+    volumeNode.SetIJKToRASMatrix(self.ijkToRas)
+    volumeNode.SetAndObserveImageData(imageData)
+
+  @profiledMethod('sumManualSegmentations')
+  def sumManualSegmentations(self, manualSegmentationsDirectory, mergedVolume, numberOfWorkers=None):
+    '''
+    Sums the manual segmentation .mha files of a directory into a single image. Files are decoded in parallel.
+    The summed image has the scalar type of the segmentations if the sum fits in it, otherwise the smallest
+    integer type wide enough for the number of raters. Only the labeled voxels are
+    kept while merging and in the array cache directory, so the same files are only summed once across sessions.
+    :param manualSegmentationsDirectory: Directory of the manual segmentation files.
+    :param mergedVolume: Volume node to store the summed image in.
+    :param numberOfWorkers: Number of files decoded at a time, the number of processors by default.
+    '''
     import glob
-    manualSegmentationFilenames = glob.glob(manualSegmentationsDirectory+"/*.mha")
-
-    # Get the first image which each successive image will be added to
-    reader = vtk.vtkMetaImageReader()
-    reader.SetFileName(manualSegmentationFilenames[0])
-    reader.Update()
-    summedImage = vtk.vtkImageData()
-    summedImage.SetExtent(reader.GetOutput().GetExtent())
-    summedImage.AllocateScalars(vtk.VTK_UNSIGNED_CHAR,1)
-    summedImage.ShallowCopy(reader.GetOutput())
-
-    # Initialize filter to add images together
-    mathFilter = vtk.vtkImageMathematics()
-
-    # Iterate list and add each new image
-    for currentFile in manualSegmentationFilenames[1:]:
-      # Get new image
-      reader.SetFileName(currentFile)
-      reader.Update()
-
-      # Add it to existing summation
-      mathFilter.SetInput1Data(summedImage)
-      mathFilter.SetInput2Data(reader.GetOutput())
-      mathFilter.Update()
-
-      # Get new summation
-      summedImage.ShallowCopy(mathFilter.GetOutput())
+    manualSegmentationFilenames = sorted(glob.glob(os.path.join(manualSegmentationsDirectory, "*.mha")))
+
+    # Validate the image size of every file before decoding any of them
+    try:
+      with self.profiler.timer('sumManualSegmentations.merge'):
+        summedLabels = cachedSumSegmentationFiles(self.arrayCache, manualSegmentationFilenames, numberOfWorkers, sparse=True)
+    except ValueError as error:
+      slicer.util.errorDisplay(str(error))
+      raise
+    inputDimensions = self.inputVolume.GetImageData().GetDimensions()
+    if summedLabels.shape != (inputDimensions[2], inputDimensions[1], inputDimensions[0]):
+      errorMessage = "Manual segmentation size {} does not match the input volume size {}".format(summedLabels.shape[::-1], inputDimensions)
+      slicer.util.errorDisplay(errorMessage)
+      raise ValueError(errorMessage)
 
     # Add summed image to slicer scene
-    mergedVolume.SetRASToIJKMatrix(self.rasToIjk)
-    mergedVolume.SetIJKToRASMatrix(self.ijkToRas)
-    mergedVolume.SetAndObserveImageData(summedImage)
+    with self.profiler.timer('sumManualSegmentations.toScene'):
+      self.setVolumeFromSparseLabels(mergedVolume, summedLabels)
 
+  def scanlineMask(self, numberOfFrames=None):
+    '''
+    :param numberOfFrames: If given, the mask is repeated along frames as a read-only view, without copying it.
+    :return: Scanline label image as a (rows, columns) array, or (numberOfFrames, rows, columns) view.
+    '''
+    if numberOfFrames is None:
+      return self.lookupTable.scanlineMask
+    return numpy.broadcast_to(self.lookupTable.scanlineMask, (numberOfFrames,) + self.lookupTable.scanlineMask.shape)
+
+  @profiledMethod('createScanlines')
   def createScanlines(self, scanlineVolume):
+    from vtk.util import numpy_support
     imgDim = self.inputVolume.GetImageData().GetDimensions()
-    drawFilter = vtk.vtkImageCanvasSource2D()
-    drawFilter.SetExtent(0,imgDim[0]-1,0,imgDim[1]-1,0,0)
-    drawFilter.SetScalarTypeToUnsignedChar()
-    drawFilter.SetDrawColor(0) # Color for background
-    drawFilter.FillBox(0,imgDim[0]-1,0,imgDim[1]-1) # Initialize background
-    drawFilter.SetDrawColor(1) # Color for scanlines
-    # Draw each scanline
-    for i in range(self.numberOfScanlines):
-      drawFilter.FillTube(int(self.scanlines[i].startPoint[0]),int(self.scanlines[i].startPoint[1]),int(self.scanlines[i].endPoint[0]),int(self.scanlines[i].endPoint[1]),0.5)
-    drawFilter.Update()
 
-    # Copy scanline slice to match the Z-dimension of input US volume
-    numOfSlices = imgDim[2]
-    imageAppendFilter = vtk.vtkImageAppend()
-    imageAppendFilter.SetAppendAxis(2)
-    for _ in range(numOfSlices):
-      imageAppendFilter.AddInputData(drawFilter.GetOutput())
-    imageAppendFilter.Update()
+    # Scanline slice repeated to match the Z-dimension of input US volume, copied once into the volume scalars
+    scanlineImage = vtk.vtkImageData()
+    scanlineImage.SetDimensions(imgDim)
+    scanlineImage.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    scanlineArray = numpy_support.vtk_to_numpy(scanlineImage.GetPointData().GetScalars())
+    scanlineArray.reshape(imgDim[2], imgDim[1], imgDim[0])[:] = self.scanlineMask(imgDim[2])
 
     # Set scanline imagedata
     scanlineVolume.SetIJKToRASMatrix(self.ijkToRas)
     scanlineVolume.SetRASToIJKMatrix(self.rasToIjk)
-    scanlineVolume.SetAndObserveImageData(imageAppendFilter.GetOutput())
+    scanlineVolume.SetAndObserveImageData(scanlineImage)
+
+  def getScanlineStatistics(self, summedImage, algorithmSegmentation):
+    '''
+    Ground truth statistics and algorithm sample distances of every scanline, which do not depend on the
+    false negative distance. They are kept until the geometry or either input image is modified.
+    :return: USGeometryLib.SegmentationMetrics.ScanlineStatistics
+    '''
+    groundTruthKey = (self.scanConversionGeometry, summedImage.GetID(), summedImage.GetMTime(), summedImage.GetImageData().GetMTime())
+    statisticsKey = groundTruthKey + (algorithmSegmentation.GetID(), algorithmSegmentation.GetMTime(), algorithmSegmentation.GetImageData().GetMTime())
+    if statisticsKey != self.scanlineStatisticsKey:
+      # The compact ground truth is kept separately, so comparing another algorithm does not sample the merged segmentations again
+      if groundTruthKey != self.scanlineGroundTruthKey:
+        self.scanlineGroundTruth = computeScanlineGroundTruth(self.sparseLabelsFromVolume(summedImage), self.lookupTable)
+        self.scanlineGroundTruthKey = groundTruthKey
+      self.scanlineStatistics = computeScanlineStatistics(None, self.sparseLabelsFromVolume(algorithmSegmentation),
+        self.lookupTable, self.outputImageSpacing, self.scanlineGroundTruth)
+      self.scanlineStatisticsKey = statisticsKey
+    return self.scanlineStatistics
+
+  def computeMetricsCurve(self, summedImage, algorithmSegmentation, falseNegativeDistances):
+    '''
+    Computes the metrics for many false negative distances, e.g. for an ROC-style curve. Scanlines are only sampled once.
+    :return: (len(falseNegativeDistances), 4) array of distance, true positive, false positive and false negative percentages.
+    '''
+    return computeMetricsCurve(self.getScanlineStatistics(summedImage, algorithmSegmentation), falseNegativeDistances)
+
+  @profiledMethod('computeMergedSegmentationMetrics')
+  def computeMergedSegmentationMetrics(self, summedImage, outputSegmentation, algorithmSegmentation, falseNegativeDistance, truePositiveOutput, falseNegativeOutput, falsePositiveOutput, regionLines=False):
+    '''
+    Computes the metrics of an algorithm segmentation, and draws the mean ground truth point and the region edges
+    of every scanline into the output segmentation.
+    :param regionLines: Draw the false negative and acceptable regions as lines along the scanlines.
+    :return: [true positive, false positive, false negative] percentages, or None if there are no points to compare.
+    '''
+    with self.profiler.timer('metrics.statistics'):
+      statistics = self.getScanlineStatistics(summedImage, algorithmSegmentation)
+    with self.profiler.timer('metrics.evaluate'):
+      metrics = evaluateScanlineStatistics(statistics, falseNegativeDistance)
+      scanlineTable = computeScanlineMetricsTable(statistics, metrics)
+      self.metricsTables = [computeFrameMetricsTable(scanlineTable, metrics.hasGroundTruth.shape[0]), scanlineTable]
+    logMetricsTable(self.metricsTables[0], 'frames')
+    logMetricsTable(scanlineTable, 'scanlines', selected=scanlineTable['hasGroundTruth'] | (scanlineTable['algorithmPoints'] > 0))
 
-  def computeMergedSegmentationMetrics(self, summedImage, outputSegmentation, algorithmSegmentation, falseNegativeDistance, truePositiveOutput, falseNegativeOutput, falsePositiveOutput):
-    imgDim = self.inputVolume.GetImageData().GetDimensions()
     summedImageData = summedImage.GetImageData()
-    algorithmSegmentationImageData = algorithmSegmentation.GetImageData()
     outputSegmentationImageData = vtk.vtkImageData()
     outputSegmentationImageData.SetExtent(summedImageData.GetExtent())
     outputSegmentationImageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR,1)
     outputSegmentation.SetAndObserveImageData(outputSegmentationImageData)
     outputSegmentation.SetRASToIJKMatrix(self.rasToIjk)
     outputSegmentation.SetIJKToRASMatrix(self.ijkToRas)
-    pixels = slicer.util.array(outputSegmentation.GetName())
-    pixels.fill(0) # Zero out the output segmentation label map
-
-    # Values for metric computations
-    totalAlgorithmSegmentationPoints = 0
-    pointsWithinAcceptableRegion = 0
-    pointsWithinRequiredRegion = 0
-    falsePositivePoints = 0
-    scanlinesWithSegmentation = 0
-
-    # Iterate each scanline
-    for i in range(self.numberOfScanlines):
-      [startScanline, endScanline] = self.scanlineEndPoints(i)
-      currentScanline = Scanline(startScanline, endScanline)
-      self.scanlines.append(currentScanline)
-      for z in range(imgDim[2]):
-        # Create the scanline line source
-        currentLine = vtk.vtkLineSource()
-        currentStartPoint = [startScanline[0], startScanline[1], z]
-        currentEndPoint = [endScanline[0], endScanline[1], z]
-        currentLine.SetPoint1(currentStartPoint)
-        currentLine.SetPoint2(currentEndPoint)
-        currentLine.SetResolution(self.numberOfSamplesPerScanline)
-        currentLine.Update()
-
-        # Compute the unit vector of the current scanline
-        denom = math.sqrt((currentEndPoint[0] - currentStartPoint[0])**2 + (currentEndPoint[1] - currentStartPoint[1])**2)
-        unitVector = [(currentEndPoint[0] - currentStartPoint[0])/denom, (currentEndPoint[1] - currentStartPoint[1])/denom]
-
-        # Compute the unit vector length in mm
-        unitVectorMM = [unitVector[0]*self.outputImageSpacing[0], unitVector[1]*self.outputImageSpacing[1]]
-        unitVectorLengthMM = math.sqrt(unitVectorMM[0]**2 + unitVectorMM[1]**2)
-
-        # Compute the factor unit vector needs to be multiplied by to get to false negative distance
-        unitVectorFactor = falseNegativeDistance / unitVectorLengthMM
-        linePoints = currentLine.GetOutput()
-        xVals = []
-        yVals = []
-        algorithmSegmentationPoints = []
-
-        # Iterate each point on line
-        for j in range(linePoints.GetNumberOfPoints()):
-          currentPoint = linePoints.GetPoint(j)
-          summedSegPoint = summedImageData.GetScalarComponentAsDouble(int(currentPoint[0]),int(currentPoint[1]),int(currentPoint[2]),0)
-          if (summedSegPoint > 0): # At least 1 ground truth at this point
-            # Add points current X/Y value N times where N is overlap count
-            xVals.extend([int(currentPoint[0]) for _ in range(int(summedSegPoint))])
-            yVals.extend([int(currentPoint[1]) for _ in range(int(summedSegPoint))])
-
-          algorithmSegPoint = algorithmSegmentationImageData.GetScalarComponentAsDouble(int(currentPoint[0]),int(currentPoint[1]),int(currentPoint[2]),0)
-          if (algorithmSegPoint > 0): # The algorithm identified point as bone
-            algorithmSegmentationPoints.append([int(currentPoint[0]),int(currentPoint[1]),int(currentPoint[2])])
-            totalAlgorithmSegmentationPoints += 1
-
-        if (len(xVals) > 0): # Scanline contains ground truth segmentation
-          scanlinesWithSegmentation += 1
-          # Compute mean point
-          xMean = sum(xVals)/len(xVals)
-          yMean = sum(yVals)/len(yVals)
-          outputSegmentationImageData.SetScalarComponentFromDouble(xMean,yMean,z,0,255)
-
-          # Compute region edges from standard deviation
-          euclideanDistances = []
-          for currentX, currentY in zip(xVals, yVals):
-            currentDistance = self.euclidean_distance([xMean,yMean,z],[currentX,currentY,z])
-            euclideanDistances.append(currentDistance)
-          std = numpy.std(euclideanDistances)
-          std += 1 # This is so that when calculating true positive point from the false negative point we only extend further (ie. std of 0 means the true positive point is at same point, and > 0 moves out from false negative point)
-
-          toleranceFactor = 5 # What should be used here?
-          falseNegativeRegionPoint1 = [xMean + unitVectorFactor * unitVector[0], yMean + unitVectorFactor * unitVector[1]]
-          falseNegativeRegionPoint2 = [xMean + -unitVectorFactor * unitVector[0], yMean + -unitVectorFactor * unitVector[1]]
-
-          truePositiveRegionPoint1 = [xMean + unitVectorFactor * std * unitVector[0], yMean + unitVectorFactor * std * unitVector[1]]
-          truePositiveRegionPoint2 = [xMean + -unitVectorFactor * std * unitVector[0], yMean + -unitVectorFactor * std * unitVector[1]]
-
-          # Add false negative region points to the output
-          outputSegmentationImageData.SetScalarComponentFromDouble(int(falseNegativeRegionPoint1[0]),int(falseNegativeRegionPoint1[1]),z,0,1)
-          outputSegmentationImageData.SetScalarComponentFromDouble(int(falseNegativeRegionPoint2[0]),int(falseNegativeRegionPoint2[1]),z,0,1)
-
-          # Add true positive region points to the output
-          outputSegmentationImageData.SetScalarComponentFromDouble(int(truePositiveRegionPoint1[0]),int(truePositiveRegionPoint1[1]),z,0,2)
-          outputSegmentationImageData.SetScalarComponentFromDouble(int(truePositiveRegionPoint2[0]),int(truePositiveRegionPoint2[1]),z,0,2)
-
-          # Compute algorithm segmentation point distances to acceptable region edge, can use either point as they are equal just opposite
-          acceptableDistance = self.euclidean_distance([xMean,yMean,z],[truePositiveRegionPoint1[0],truePositiveRegionPoint1[1],z])
-          falseNegativeRegionDistance = self.euclidean_distance([xMean,yMean,z],[falseNegativeRegionPoint1[0],falseNegativeRegionPoint1[1],z])
-          print("*****\nFalse negative region distance: {}".format(falseNegativeRegionDistance))
-          requiredRegionIdentified = False # For false negative metric
-          for currentPoint in algorithmSegmentationPoints:
-            currentDistance = self.euclidean_distance([xMean,yMean,z], currentPoint)
-            print("Current distance: {}".format(currentDistance))
-            if (currentDistance <= acceptableDistance):
-              pointsWithinAcceptableRegion += 1
-            else: # If not within acceptable distance it's a false positive
-              falsePositivePoints += 1
-            if (currentDistance < falseNegativeRegionDistance):
-              requiredRegionIdentified = True
-
-          if (requiredRegionIdentified):
-            pointsWithinRequiredRegion += 1
-        else: # No ground truth on this scanline:
-          if len(algorithmSegmentationPoints) > 0: # Algorithm identified bone
-            falsePositivePoints += len(algorithmSegmentationPoints) # All points are false positive
+    # Drawn directly into the image memory of the output node
+    with self.profiler.timer('metrics.labelMap'):
+      pixels = slicer.util.array(outputSegmentation.GetID())
+      metricsLabelMap(metrics, self.lookupTable.unitVectors, pixels.shape, regionLines, labelMap=pixels)
+    outputSegmentationImageData.Modified()
+
+    if metrics.truePositive is None:
+      logging.warning('No algorithm segmentation or ground truth points found along the scanlines')
+      return None
+
+    truePositiveOutput.setText(str(metrics.truePositive))
+    falsePositiveOutput.setText(str(metrics.falsePositive))
+    falseNegativeOutput.setText(str(metrics.falseNegative))
+    logging.info("truePositiveOutput: {}\nfalsePositiveOutput: {}\nfalseNegativeOutput: {}".format(metrics.truePositive, metrics.falsePositive, metrics.falseNegative))
+    return [metrics.truePositive, metrics.falsePositive, metrics.falseNegative]
+
+  def exportMetricsTables(self, fileName):
     '''
-    outputSegmentation.SetAndObserveImageData(outputSegmentationImageData)
-    outputSegmentation.SetRASToIJKMatrix(self.rasToIjk)
-    outputSegmentation.SetIJKToRASMatrix(self.ijkToRas)
+    Saves the tables of the last computeMergedSegmentationMetrics next to each other, e.g. metrics.csv as
+    metrics_frames.csv and metrics_scanlines.csv. Files ending in .npz are saved as compressed NumPy archives of the columns.
+    :return: [frames file, scanlines file]
     '''
-    # Compute / set true positive metric
-    truePositiveValue = float(pointsWithinAcceptableRegion) / float(totalAlgorithmSegmentationPoints) * 100
-    truePositiveOutput.setText(truePositiveValue)
-
-    # Compute / set false positive metric
-    falsePositiveValue = float(falsePositivePoints) / float(totalAlgorithmSegmentationPoints) * 100
-    falsePositiveOutput.setText(falsePositiveValue)
-
-    # Compute / set false negative metric
-    falseNegativeValue = (1 - float(pointsWithinRequiredRegion) / float(scanlinesWithSegmentation)) * 100
-    falseNegativeOutput.setText(falseNegativeValue)
-    print("truePositiveOutput: {}\nfalsePositiveOutput: {}\nfalseNegativeOutput: {}".format(truePositiveValue, falsePositiveValue, falseNegativeValue))
+    if self.metricsTables is None:
+      raise ValueError("No metrics have been computed")
+    [baseName, extension] = os.path.splitext(fileName)
+    if extension.lower() not in ['.csv', '.npz']:
+      extension = '.csv'
+    outputFiles = [baseName + '_frames' + extension, baseName + '_scanlines' + extension]
+    for table, outputFile in zip(self.metricsTables, outputFiles):
+      saveMetricsTable(table, outputFile)
+    return outputFiles
 
 class UltrasoundTransducerGeometry:
+  '''
+  Transducer geometry of a configuration file, with the same parameters as USGeometryLogic.
+  Scanlines are computed by USGeometryLib.ScanlineGeometry.
+  '''
   def __init__(self, configFile, inputVolume):
 
     self.inputVolume = inputVolume
 
-    from xml.dom import minidom
-    parser = minidom.parse(configFile)
-    scanConversionElement = parser.getElementsByTagName("ScanConversion")
-    if (len(scanConversionElement) < 1):
-      slicer.util.errorDisplay("Could not find ScanConversion element in configuration file!")
-      return False
-    elif (len(scanConversionElement) > 1):
-      slicer.util.errorDisplay("Found multiple ScanConversion elements in configuration file!")
-      return False
-
-    scanConversionElement = scanConversionElement[0]
-
-    # Values common to both linear and curvilinear
-    self.transducerGeometry = scanConversionElement.attributes['TransducerGeometry'].value
-    self.transducerCenterPixel = scanConversionElement.attributes['TransducerCenterPixel'].value
-    self.transducerCenterPixel = map(int, self.transducerCenterPixel.split(" "))
-    self.numberOfScanlines = int(scanConversionElement.attributes['NumberOfScanLines'].value)
-    self.outputImageSpacing = scanConversionElement.attributes['OutputImageSpacingMmPerPixel'].value
-    self.outputImageSpacing = map(float, self.outputImageSpacing.split(" "))
-    self.numberOfSamplesPerScanline = int(scanConversionElement.attributes['NumberOfSamplesPerScanLine'].value)
-
-    # Values just for curvilinear
-    if (self.transducerGeometry == "CURVILINEAR"):
-      self.thetaStartDeg = float(scanConversionElement.attributes['ThetaStartDeg'].value)
-      self.thetaStopDeg = float(scanConversionElement.attributes['ThetaStopDeg'].value)
-      self.radiusStartMm = float(scanConversionElement.attributes['RadiusStartMm'].value)
-      self.radiusStopMm = float(scanConversionElement.attributes['RadiusStopMm'].value)
-      self.totalDeg = abs(self.thetaStopDeg - self.thetaStartDeg)
-      self.degreesPerScanline = self.totalDeg / self.numberOfScanlines
-      self.circleCenter = [self.transducerCenterPixel[0], self.transducerCenterPixel[1] - self.radiusStartMm/self.outputImageSpacing[1]]
-    # Values just for linear
-    elif (self.transducerGeometry == "LINEAR"):
-      self.transducerWidthMm = float(scanConversionElement.attributes['TransducerWidthMm'].value)
-      self.imagingDepthMm = float(scanConversionElement.attributes['ImagingDepthMm'].value)
-      self.transducerWidthPixel = self.transducerWidthMm / float(self.outputImageSpacing[0])
-      self.topLeftPixel = [self.transducerCenterPixel[0] - 0.5 * float(self.transducerWidthPixel), self.transducerCenterPixel[1]]
-      self.scanlineSpacingPixels = self.transducerWidthPixel / float(self.numberOfScanlines)
-      self.scanlineLengthPixels = self.imagingDepthMm / self.outputImageSpacing[1]
+    try:
+      self.scanlineGeometry = ScanlineGeometry(readScanConversionGeometry(configFile))
+    except ValueError as error:
+      slicer.util.errorDisplay(str(error))
+      raise
+    for name in ScanlineGeometry.parameterNames:
+      setattr(self, name, getattr(self.scanlineGeometry, name))
 
   def scanlineEndPoints(self, scanline):
-    import math
-    # Compute curvilinear xy values
-    if (self.transducerGeometry == "CURVILINEAR"):
-
-      # Compute angle for desired scanline
-      angle = self.thetaStartDeg + scanline * self.degreesPerScanline
-      angleRadians = math.pi * angle / 180
-
-      # Compute the starting point
-      startScanlineX = self.circleCenter[0] + math.sin(angleRadians) * self.radiusStartMm / self.outputImageSpacing[0]
-      startScanlineY = self.circleCenter[1] + math.cos(angleRadians) * self.radiusStartMm / self.outputImageSpacing[1]
-
-      # Compute the ending point
-      endScanlineX = self.circleCenter[0] + math.sin(angleRadians) * self.radiusStopMm / self.outputImageSpacing[0]
-      endScanlineY = self.circleCenter[1] + math.cos(angleRadians) * self.radiusStopMm / self.outputImageSpacing[1]
-    # Compute linear xy values
-    elif (self.transducerGeometry == "LINEAR"):
-      # Compute the starting point
-      startScanlineX = self.topLeftPixel[0] + scanline * self.scanlineSpacingPixels
-      startScanlineY = self.topLeftPixel[1]
-
-      # Compute the end point
-      endScanlineX = startScanlineX # Vertical line so same 'x' value
-      endScanlineY = self.topLeftPixel[1] + self.scanlineLengthPixels
-    else:
-      # ERROR: should not reach here
-      print("Error in scanlineEndPoints")
-
-    # Combine XY values and return
-    startScanline = [startScanlineX, startScanlineY]
-    endScanline = [endScanlineX, endScanlineY]
-
-    return [startScanline, endScanline]
+    '''
+    :param scanline: (Possibly fractional) scanline number.
+    :return: [startPoint, endPoint], both [x, y] in pixels.
+    :raises ValueError: if the scanline is outside of the output image.
+    '''
+    try:
+      [startPoints, endPoints] = self.scanlineGeometry.computeScanlineEndPoints([scanline])
+    except ValueError as error:
+      logging.error(str(error))
+      raise
+    return [list(startPoints[0]), list(endPoints[0])]
 
 class Scanline():
 
@@ -832,7 +760,20 @@ class USGeometryTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_USGeometry_CreateScanlines()
+    self.test_USGeometry_RasterizeScanlines()
     self.test_USGeometry_SumManualSegmentations()
+    self.test_USGeometry_SegmentationMetricsRegression()
+    self.test_USGeometry_SegmentationMerging()
+    self.test_USGeometry_ReadScanConversionGeometry()
+    self.test_USGeometry_MetaImageSequence()
+    self.test_USGeometry_ScanlineSampler()
+    self.test_USGeometry_ResampleScanlines()
+    self.test_USGeometry_ArrayDiskCache()
+    self.test_USGeometry_SparseLabels()
+    self.test_USGeometry_MetricsTable()
+    self.test_USGeometry_MetricsLabelMap()
+    self.test_USGeometry_MetricsCurve()
+    self.test_USGeometry_CohortEvaluation()
 
   def compareVolumes(self, volume1, volume2):
     subtractFilter = vtk.vtkImageMathematics()
@@ -855,6 +796,22 @@ class USGeometryTest(ScriptedLoadableModuleTest):
     else:
       return False
 
+  def fillTubeScanlines(self, startPoints, endPoints, imageSize, radius):
+    '''
+    Draws scanlines like createScanlines did with a VTK canvas, as the reference of the numpy rasterization.
+    :return: vtkImageData of one slice.
+    '''
+    drawFilter = vtk.vtkImageCanvasSource2D()
+    drawFilter.SetExtent(0, imageSize[0] - 1, 0, imageSize[1] - 1, 0, 0)
+    drawFilter.SetScalarTypeToUnsignedChar()
+    drawFilter.SetDrawColor(0)
+    drawFilter.FillBox(0, imageSize[0] - 1, 0, imageSize[1] - 1)
+    drawFilter.SetDrawColor(1)
+    for [startPoint, endPoint] in zip(startPoints, endPoints):
+      drawFilter.FillTube(int(startPoint[0]), int(startPoint[1]), int(endPoint[0]), int(endPoint[1]), radius)
+    drawFilter.Update()
+    return drawFilter.GetOutput()
+
   def test_USGeometry_CreateScanlines(self):
     """ Ideally you should have several levels of tests.  At the lowest level
     tests should exercise the functionality of the logic with different inputs
@@ -869,30 +826,27 @@ class USGeometryTest(ScriptedLoadableModuleTest):
 
     self.delayDisplay("Starting CreateScanlines test")
 
-    # Setup testing data
-    import urllib
-    xmlFileName = 'SpineUltrasound-Lumbar-C5_config.xml'
-    testDataPath = 'https://raw.githubusercontent.com/Mattel/USBoneSegmentation/master/USGeometry/Testing/Data/Curvilinear/'
-    downloads = (
-        (testDataPath+'SpineUltrasound-Lumbar-C5-Trimmed.mha', 'SpineUltrasound-Lumbar-C5-Trimmed.mha', slicer.util.loadLabelVolume),
-        (testDataPath+'SpineUltrasound-Lumbar-C5_config.xml', xmlFileName, None),
-        (testDataPath+'GroundTruth/SpineUltrasound-Lumbar-C5_Scanline_GroundTruth.mha', 'Curvilinear_Scanline_GroundTruth.mha', slicer.util.loadLabelVolume)
-        )
-
-    # Load testing data
-    for url,name,loader in downloads:
-      filePath = slicer.app.temporaryPath + '/' + name
-      if not os.path.exists(filePath) or os.stat(filePath).st_size == 0:
-        logging.info('Requesting download %s from %s...\n' % (name, url))
-        urllib.urlretrieve(url, filePath)
-      if loader:
-        logging.info('Loading %s...' % (name,))
-        loader(filePath)
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="SpineUltrasound-Lumbar-C5-Trimmed")
-    groundTruthNode = slicer.util.getNode(pattern="Curvilinear_Scanline_GroundTruth")
-    logic = USGeometryLogic(slicer.app.temporaryPath+'/'+xmlFileName, volumeNode)
+    testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data', 'Curvilinear')
+    volumeNode = slicer.util.loadLabelVolume(os.path.join(testDataPath, 'SpineUltrasound-Lumbar-C5-Trimmed.mha'), returnNode=True)[1]
+    self.delayDisplay('Finished with loading')
+
+    logic = USGeometryLogic()
+    logic.setup(os.path.join(testDataPath, 'SpineUltrasound-Lumbar-C5_config.xml'), volumeNode)
+
+    # Scanlines drawn with the VTK canvas and appended along the frames, as createScanlines used to do
+    imgDim = volumeNode.GetImageData().GetDimensions()
+    [startPoints, endPoints] = ScanlineGeometry(logic.scanConversionGeometry).computeScanlineEndPoints(numpy.arange(logic.numberOfScanlines))
+    scanlineSlice = self.fillTubeScanlines(startPoints, endPoints, imgDim, 0.5)
+    imageAppendFilter = vtk.vtkImageAppend()
+    imageAppendFilter.SetAppendAxis(2)
+    for _ in range(imgDim[2]):
+      imageAppendFilter.AddInputData(scanlineSlice)
+    imageAppendFilter.Update()
+    groundTruthNode = slicer.vtkMRMLLabelMapVolumeNode()
+    groundTruthNode.SetName("Scanline_GroundTruth")
+    slicer.mrmlScene.AddNode(groundTruthNode)
+    groundTruthNode.SetAndObserveImageData(imageAppendFilter.GetOutput())
+
     scanlineNode = slicer.vtkMRMLLabelMapVolumeNode()
     scanlineNode.SetName("Scanline_Test")
     slicer.mrmlScene.AddNode(scanlineNode)
@@ -904,43 +858,44 @@ class USGeometryTest(ScriptedLoadableModuleTest):
     self.delayDisplay("Running createScanlines...")
     logic.createScanlines(scanlineNode)
 
-    volumeEqualityCheck = self.compareVolumes(groundTruthNode, scanlineNode)
-    if volumeEqualityCheck == True:
-      self.delayDisplay('Scanline test passed!')
-    else:
-      self.delayDisplay('Scanline test failed!')
+    self.assertTrue(self.compareVolumes(groundTruthNode, scanlineNode))
+    self.delayDisplay('Scanline test passed!')
+
+  def test_USGeometry_RasterizeScanlines(self):
+    self.delayDisplay("Starting RasterizeScanlines test")
+    from vtk.util import numpy_support
+
+    testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data')
+    for configFile in [os.path.join('Curvilinear', 'SpineUltrasound-Lumbar-C5_config.xml'), os.path.join('Linear', 'BoneUltrasound_L14_config.xml')]:
+      scanlineGeometry = ScanlineGeometry(readScanConversionGeometry(os.path.join(testDataPath, configFile)))
+      imageSize = scanlineGeometry.outputImageSizePixel[:2]
+      [startPoints, endPoints] = scanlineGeometry.computeScanlineEndPoints(numpy.arange(scanlineGeometry.numberOfScanlines))
+      for radius in [0.5, 1.0]:
+        fillTubeImage = self.fillTubeScanlines(startPoints, endPoints, imageSize, radius)
+        fillTubeArray = numpy_support.vtk_to_numpy(fillTubeImage.GetPointData().GetScalars()).reshape(imageSize[1], imageSize[0])
+        self.assertGreater(numpy.count_nonzero(fillTubeArray), 0)
+        self.assertTrue(numpy.array_equal(rasterizeScanlines(startPoints, endPoints, imageSize, radius), fillTubeArray))
+
+    # The bundled scanline ground truth was drawn with 1 pixel radius tubes
+    from USGeometryLib import MetaImageSequence
+    scanlineGeometry = ScanlineGeometry(readScanConversionGeometry(os.path.join(testDataPath, 'Curvilinear', 'SpineUltrasound-Lumbar-C5_config.xml')))
+    [startPoints, endPoints] = scanlineGeometry.computeScanlineEndPoints(numpy.arange(scanlineGeometry.numberOfScanlines))
+    groundTruthArray = MetaImageSequence(os.path.join(testDataPath, 'Curvilinear', 'GroundTruth', 'SpineUltrasound-Lumbar-C5_Scanline_GroundTruth.mha')).getFrames()
+    scanlineMask = rasterizeScanlines(startPoints, endPoints, scanlineGeometry.outputImageSizePixel[:2], 1.0)
+    self.assertTrue(numpy.array_equal(groundTruthArray, numpy.broadcast_to(scanlineMask, groundTruthArray.shape)))
+
+    self.delayDisplay("RasterizeScanlines test passed!")
 
   def test_USGeometry_SumManualSegmentations(self):
     self.delayDisplay("Starting SumManualSegmentations test")
 
-    import urllib
-    xmlFileName = 'SpineUltrasound-Lumbar-C5_config.xml'
-    testDataPath = 'https://raw.githubusercontent.com/Mattel/USBoneSegmentation/master/USGeometry/Testing/Data/Curvilinear/'
-    downloads = (
-      (testDataPath+'SpineUltrasound-Lumbar-C5-Trimmed.mha', 'SpineUltrasound-Lumbar-C5-Trimmed.mha', slicer.util.loadLabelVolume),
-      (testDataPath+'SpineUltrasound-Lumbar-C5_config.xml', xmlFileName, None),
-      (testDataPath+'TestManualSegmentations/SpineUltrasound-Lumbar-C5-TestSeg1.mha', 'TestManualSegmentations/SpineUltrasound-Lumbar-C5-TestSeg1.mha', slicer.util.loadLabelVolume),
-      (testDataPath+'TestManualSegmentations/SpineUltrasound-Lumbar-C5-TestSeg2.mha', 'TestManualSegmentations/SpineUltrasound-Lumbar-C5-TestSeg2.mha', slicer.util.loadLabelVolume),
-      (testDataPath+'TestManualSegmentations/SpineUltrasound-Lumbar-C5-TestSeg3.mha', 'TestManualSegmentations/SpineUltrasound-Lumbar-C5-TestSeg3.mha', slicer.util.loadLabelVolume),
-      (testDataPath+'GroundTruth/SummedManualSegmentations_GroundTruth.mha','SummedManualSegmentations_GroundTruth.mha', slicer.util.loadLabelVolume)
-      )
-
-    for url,name,loader in downloads:
-      filePath = slicer.app.temporaryPath + '/' + name
-      if not os.path.exists(filePath) or os.stat(filePath).st_size == 0:
-        directoryName = os.path.dirname(filePath)
-        if not os.path.exists(directoryName):
-          os.makedirs(directoryName)
-        logging.info('Requesting download %s from %s...\n' % (name,url))
-        urllib.urlretrieve(url, filePath)
-      if loader:
-        logging.info('Loading %s...' % (name,))
-        loader(filePath)
-    self.delayDisplay('Finished with downloading and loading')
-
-    volumeNode = slicer.util.getNode(pattern="SpineUltrasound-Lumbar-C5-Trimmed")
-    groundTruthNode = slicer.util.getNode(pattern="SummedManualSegmentations_GroundTruth")
-    logic = USGeometryLogic(slicer.app.temporaryPath+'/'+xmlFileName, volumeNode)
+    testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data', 'Curvilinear')
+    volumeNode = slicer.util.loadLabelVolume(os.path.join(testDataPath, 'SpineUltrasound-Lumbar-C5-Trimmed.mha'), returnNode=True)[1]
+    groundTruthNode = slicer.util.loadLabelVolume(os.path.join(testDataPath, 'GroundTruth', 'SummedManualSegmentations_GroundTruth.mha'), returnNode=True)[1]
+    self.delayDisplay('Finished with loading')
+
+    logic = USGeometryLogic()
+    logic.setup(os.path.join(testDataPath, 'SpineUltrasound-Lumbar-C5_config.xml'), volumeNode)
     summedManualSegNode = slicer.vtkMRMLLabelMapVolumeNode()
     summedManualSegNode.SetName("SummedManualSegmentations_Test")
     slicer.mrmlScene.AddNode(summedManualSegNode)
@@ -951,10 +906,471 @@ class USGeometryTest(ScriptedLoadableModuleTest):
     summedManualSegNode.AddAndObserveDisplayNodeID(summedManualSegDisplayNode.GetID())
 
     self.delayDisplay("Running sumManualSegmentations...")
-    logic.sumManualSegmentations(slicer.app.temporaryPath+'/TestManualSegmentations', summedManualSegNode)
-
-    volumeEqualityCheck = self.compareVolumes(groundTruthNode, summedManualSegNode)
-    if volumeEqualityCheck == True:
-      self.delayDisplay("Summed manual segmentations test passed!")
-    else:
-      self.delayDisplay("Summed manual segmentations test failed!")
+    logic.sumManualSegmentations(os.path.join(testDataPath, 'TestManualSegmentations'), summedManualSegNode)
+
+    self.assertEqual(summedManualSegNode.GetImageData().GetScalarType(), groundTruthNode.GetImageData().GetScalarType())
+    self.assertTrue(self.compareVolumes(groundTruthNode, summedManualSegNode))
+    self.delayDisplay("Summed manual segmentations test passed!")
+
+  def test_USGeometry_SegmentationMetricsRegression(self):
+    self.delayDisplay("Starting SegmentationMetricsRegression test")
+
+    # Percentages of the original per scanline implementation of the metrics, with the last rater's segmentation as the
+    # algorithm. They depend on the mean ground truth point being floored to a whole pixel.
+    expectedMetrics = [
+      ('Curvilinear', 'SpineUltrasound-Lumbar-C5-Trimmed.mha', 'SpineUltrasound-Lumbar-C5_config.xml', 'SpineUltrasound-Lumbar-C5-TestSeg3.mha',
+        [(0.5, [99.85835694050992, 0.141643059490085, 9.128630705394192]), (2.0, [100.0, 0.0, 7.468879668049788])]),
+      ('Linear', 'BoneUltrasound_L14_Trimmed.mha', 'BoneUltrasound_L14_config.xml', 'BoneUltrasound_L14_Trimmed-ExampleManualSeg3.mha',
+        [(0.5, [95.1657458563536, 4.834254143646409, 82.27848101265822]), (1.0, [100.0, 0.0, 48.52320675105485]),
+         (2.0, [100.0, 0.0, 4.641350210970463])])]
+    for [probeType, volumeFile, configFile, algorithmFile, distanceMetrics] in expectedMetrics:
+      testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data', probeType)
+      manualSegmentationsPath = os.path.join(testDataPath, 'TestManualSegmentations')
+      volumeNode = slicer.util.loadVolume(os.path.join(testDataPath, volumeFile), returnNode=True)[1]
+      algorithmSegmentation = slicer.util.loadLabelVolume(os.path.join(manualSegmentationsPath, algorithmFile), returnNode=True)[1]
+      logic = USGeometryLogic()
+      logic.setup(os.path.join(testDataPath, configFile), volumeNode)
+      summedImage = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+      logic.sumManualSegmentations(manualSegmentationsPath, summedImage)
+      outputSegmentation = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+      for [falseNegativeDistance, expectedPercentages] in distanceMetrics:
+        percentages = logic.computeMergedSegmentationMetrics(summedImage, outputSegmentation, algorithmSegmentation, falseNegativeDistance,
+                                                             qt.QLabel(), qt.QLabel(), qt.QLabel())
+        for [percentage, expectedPercentage] in zip(percentages, expectedPercentages):
+          self.assertAlmostEqual(percentage, expectedPercentage, places=6)
+
+    self.delayDisplay("SegmentationMetricsRegression test passed!")
+
+  def test_USGeometry_SegmentationMerging(self):
+    self.delayDisplay("Starting SegmentationMerging test")
+    import shutil, tempfile
+    from USGeometryLib import sumSparseSegmentationFiles
+    from USGeometryLib.SegmentationMerging import sumSegmentationFiles
+
+    def writeSegmentation(fileName, frames):
+      elementType = {numpy.dtype(numpy.uint8): 'MET_UCHAR', numpy.dtype(numpy.int16): 'MET_SHORT'}[frames.dtype]
+      with open(fileName, 'wb') as segmentationFile:
+        segmentationFile.write(('ObjectType = Image\nNDims = 3\nDimSize = {} {} {}\nElementType = {}\nElementDataFile = LOCAL\n'.format(
+          frames.shape[2], frames.shape[1], frames.shape[0], elementType)).encode('latin-1'))
+        segmentationFile.write(frames.astype(frames.dtype.newbyteorder('<')).tobytes())
+      return fileName
+
+    outputDirectory = tempfile.mkdtemp()
+    try:
+      # Sums that overflow the type of the segmentations are returned in a wider type
+      uint8Frames = numpy.zeros((2, 3, 4), dtype=numpy.uint8)
+      uint8Frames[1, 2, 3] = 200
+      uint8Files = [writeSegmentation(os.path.join(outputDirectory, 'uint8_{}.mha'.format(index)), uint8Frames) for index in range(3)]
+      int16Frames = numpy.zeros((2, 3, 4), dtype=numpy.int16)
+      int16Frames[0, 1, 2] = 30000
+      int16Frames[1, 0, 0] = -30000
+      int16Files = [writeSegmentation(os.path.join(outputDirectory, 'int16_{}.mha'.format(index)), int16Frames) for index in range(2)]
+      for [segmentationFiles, frames, summedType] in [[uint8Files, uint8Frames, numpy.uint16], [int16Files, int16Frames, numpy.int32]]:
+        expectedSum = frames.astype(numpy.int64) * len(segmentationFiles)
+        for numberOfWorkers in [1, 2]:
+          summedArray = sumSegmentationFiles(segmentationFiles, numberOfWorkers)
+          self.assertEqual(summedArray.dtype, numpy.dtype(summedType))
+          self.assertTrue(numpy.array_equal(summedArray, expectedSum))
+          summedLabels = sumSparseSegmentationFiles(segmentationFiles, numberOfWorkers)
+          self.assertEqual(summedLabels.dtype, numpy.dtype(summedType))
+          self.assertTrue(numpy.array_equal(summedLabels.toDense(), expectedSum))
+
+      # Sums that fit keep the type of the segmentations
+      self.assertEqual(sumSegmentationFiles(uint8Files[:1]).dtype, numpy.dtype(numpy.uint8))
+
+      # Different image sizes are found from the headers, before any pixel data is read
+      shorterFile = writeSegmentation(os.path.join(outputDirectory, 'shorter.mha'), uint8Frames[:1])
+      for sumFiles in [sumSegmentationFiles, sumSparseSegmentationFiles]:
+        with self.assertRaises(ValueError) as context:
+          sumFiles(uint8Files + [shorterFile])
+        self.assertIn('has size', str(context.exception))
+    finally:
+      shutil.rmtree(outputDirectory)
+
+    self.delayDisplay("SegmentationMerging test passed!")
+
+  def test_USGeometry_ReadScanConversionGeometry(self):
+    self.delayDisplay("Starting ReadScanConversionGeometry test")
+
+    testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data')
+    curvilinearConfigFile = os.path.join(testDataPath, 'Curvilinear', 'SpineUltrasound-Lumbar-C5_config.xml')
+    linearConfigFile = os.path.join(testDataPath, 'Linear', 'BoneUltrasound_L14_config.xml')
+
+    curvilinearGeometry = readScanConversionGeometry(curvilinearConfigFile)
+    self.assertEqual(curvilinearGeometry.transducerGeometry, "CURVILINEAR")
+    self.assertEqual(curvilinearGeometry.outputImageSizePixel, (820, 616))
+    self.assertEqual(curvilinearGeometry.numberOfScanlines, 90)
+    self.assertEqual(curvilinearGeometry.radiusStopMm, 100.0)
+    self.assertIsNone(curvilinearGeometry.imagingDepthMm)
+
+    linearGeometry = readScanConversionGeometry(linearConfigFile)
+    self.assertEqual(linearGeometry.transducerGeometry, "LINEAR")
+    self.assertEqual(linearGeometry.outputImageSpacing, (0.085, 0.195))
+    self.assertEqual(linearGeometry.transducerWidthMm, 40.0)
+
+    # Unchanged files are served from the cache
+    self.assertIs(readScanConversionGeometry(curvilinearConfigFile), curvilinearGeometry)
+
+    # The transducer geometry has the scanlines of ScanlineGeometry
+    for configFile in [curvilinearConfigFile, linearConfigFile]:
+      transducerGeometry = UltrasoundTransducerGeometry(configFile, None)
+      [startPoints, endPoints] = ScanlineGeometry(readScanConversionGeometry(configFile)).computeScanlineEndPoints([0, 7])
+      self.assertEqual(transducerGeometry.scanlineEndPoints(7), [list(startPoints[1]), list(endPoints[1])])
+    with self.assertRaises(ValueError):
+      transducerGeometry.scanlineEndPoints(-1000)
+
+    self.delayDisplay("ReadScanConversionGeometry test passed!")
+
+  def test_USGeometry_MetaImageSequence(self):
+    self.delayDisplay("Starting MetaImageSequence test")
+    from USGeometryLib import MetaImageSequence
+
+    testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data')
+    uncompressedFile = os.path.join(testDataPath, 'Curvilinear', 'SpineUltrasound-Lumbar-C5-Trimmed.mha')
+    compressedFile = os.path.join(testDataPath, 'Linear', 'BoneUltrasound_L14.mha')
+
+    for sequenceFile in [uncompressedFile, compressedFile]:
+      sequence = MetaImageSequence(sequenceFile)
+      volumeNode = slicer.util.loadVolume(sequenceFile, returnNode=True)[1]
+      volumeArray = slicer.util.arrayFromVolume(volumeNode)
+      self.assertEqual((sequence.numberOfFrames,) + sequence.frameShape, volumeArray.shape)
+      self.assertTrue(numpy.array_equal(sequence.getFrames(), volumeArray))
+      self.assertTrue(numpy.array_equal(sequence.getFrame(2), volumeArray[2]))
+      self.assertEqual(len(sequence.timestamps), sequence.numberOfFrames)
+
+    sequence = MetaImageSequence(uncompressedFile)
+    self.assertFalse(sequence.compressed)
+    self.assertIsInstance(sequence.getFrames(), numpy.memmap)
+    self.assertIn('ImageToReference', sequence.transformNames())
+    self.assertEqual(sequence.getTransforms('ImageToReference').shape, (5, 4, 4))
+
+    sequence = MetaImageSequence(compressedFile)
+    self.assertTrue(sequence.compressed)
+    self.assertEqual(sequence.transformNames(), ['ProbeToTracker', 'ReferenceToTracker', 'StylusToTracker'])
+
+    self.delayDisplay("MetaImageSequence test passed!")
+
+  def test_USGeometry_ScanlineSampler(self):
+    self.delayDisplay("Starting ScanlineSampler test")
+    from USGeometryLib import ScanlineSampler
+
+    testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data')
+    for configFile in [os.path.join(testDataPath, 'Linear', 'BoneUltrasound_L14_config.xml'),
+                       os.path.join(testDataPath, 'Curvilinear', 'SpineUltrasound-Lumbar-C5_config.xml')]:
+      scanlineGeometry = ScanlineGeometry(readScanConversionGeometry(configFile))
+      [startPoints, endPoints] = scanlineGeometry.computeScanlineEndPoints(numpy.arange(scanlineGeometry.numberOfScanlines))
+      imageSize = scanlineGeometry.outputImageSizePixel[:2]
+      frame = numpy.random.RandomState(0).randint(0, 256, (imageSize[1], imageSize[0])).astype(numpy.uint8)
+
+      # Samples are one row spacing apart along every scanline
+      sampler = ScanlineSampler(startPoints, endPoints, imageSize, scanlineGeometry.outputImageSpacing)
+      sampleSteps = numpy.diff(sampler.samplePoints, axis=1) * scanlineGeometry.outputImageSpacing
+      self.assertTrue(numpy.allclose(numpy.hypot(sampleSteps[..., 0], sampleSteps[..., 1]), scanlineGeometry.outputImageSpacing[1]))
+      profiles = sampler.sample(frame)
+      [scanlineIndices, sampleIndices] = numpy.nonzero(sampler.inImage)
+      pixels = sampler.pixelPositions(scanlineIndices, sampleIndices)
+      self.assertTrue(numpy.array_equal(profiles[scanlineIndices, sampleIndices], frame[pixels[:, 1], pixels[:, 0]]))
+
+      # Linear interpolation of a constant image is constant
+      sampler = ScanlineSampler(startPoints, endPoints, imageSize, scanlineGeometry.outputImageSpacing, 'linear')
+      profiles = sampler.sample(numpy.full(frame.shape, 100, dtype=numpy.uint8))
+      self.assertTrue(numpy.allclose(profiles[sampler.inImage], 100, atol=1e-3))
+
+    # Linear probe profiles are the image columns of the scanlines
+    sampler = ScanlineSampler([[12.7, 0]], [[12.7, 300]], imageSize, [0.085, 0.195])
+    self.assertTrue(numpy.array_equal(sampler.sample(frame)[0], frame[:, 12]))
+
+    self.delayDisplay("ScanlineSampler test passed!")
+
+  def test_USGeometry_ResampleScanlines(self):
+    self.delayDisplay("Starting ResampleScanlines test")
+
+    testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data')
+    configFile = os.path.join(testDataPath, 'Curvilinear', 'SpineUltrasound-Lumbar-C5_config.xml')
+    volumeNode = slicer.util.loadVolume(os.path.join(testDataPath, 'Curvilinear', 'SpineUltrasound-Lumbar-C5-Trimmed.mha'), returnNode=True)[1]
+    logic = USGeometryLogic()
+    logic.setup(configFile, volumeNode)
+
+    resampled = logic.getResampledScanlines(volumeNode)
+    volumeArray = slicer.util.array(volumeNode.GetID())
+    self.assertEqual(resampled.shape, (volumeArray.shape[0], logic.numberOfScanlines, logic.numberOfSamplesPerScanline + 1))
+    self.assertIs(logic.getResampledScanlines(volumeNode), resampled)
+
+    # A linear ramp along the columns is reproduced exactly at the sub-pixel sample positions
+    rampArray = numpy.broadcast_to(numpy.arange(volumeArray.shape[2], dtype=numpy.float32), volumeArray.shape)
+    resampledRamp = resampleScanlines(rampArray, logic.lookupTable)
+    self.assertTrue(numpy.allclose(resampledRamp, logic.lookupTable.samplePoints[numpy.newaxis, :, :, 0], atol=1e-3))
+
+    self.delayDisplay("ResampleScanlines test passed!")
+
+  def test_USGeometry_ArrayDiskCache(self):
+    self.delayDisplay("Starting ArrayDiskCache test")
+    import glob, shutil, tempfile
+    from USGeometryLib import ArrayDiskCache, MetaImageSequence, cachedSumSegmentationFiles
+    from USGeometryLib.SegmentationMerging import sumSegmentationFiles
+
+    testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data')
+    segmentationFiles = sorted(glob.glob(os.path.join(testDataPath, 'Curvilinear', 'TestManualSegmentations', '*.mha')))
+    cacheDirectory = tempfile.mkdtemp()
+    try:
+      arrayCache = ArrayDiskCache(cacheDirectory)
+      summedArray = cachedSumSegmentationFiles(arrayCache, segmentationFiles)
+      self.assertIsInstance(summedArray, numpy.memmap)
+      self.assertTrue(numpy.array_equal(summedArray, sumSegmentationFiles(segmentationFiles)))
+
+      # The same contents in another order are served from the cache
+      self.assertEqual(cachedSumSegmentationFiles(ArrayDiskCache(cacheDirectory), segmentationFiles[::-1]).filename, summedArray.filename)
+
+      # Least recently used arrays are evicted beyond the size limit
+      arrayCache = ArrayDiskCache(cacheDirectory, maximumSizeBytes=3000)
+      for value in range(3):
+        arrayCache.put(arrayCache.key('test', value), numpy.full(200, value))
+      self.assertIsNone(arrayCache.get(arrayCache.key('test', 0)))
+      self.assertEqual(arrayCache.get(arrayCache.key('test', 2))[0], 2)
+      self.assertLessEqual(arrayCache.sizeBytes(), 3000)
+
+      # File digests count toward the size limit, and are evicted with the arrays
+      arrayCache = ArrayDiskCache(cacheDirectory, maximumSizeBytes=0)
+      arrayCache.put(arrayCache.key('test', 3), numpy.zeros(1))
+      arrayCache.fileDigest(segmentationFiles[0])
+      self.assertEqual(len(arrayCache.cachedFiles()), 1)
+      self.assertEqual(os.path.dirname(arrayCache.cachedFiles()[0][2]), arrayCache.digestDirectory)
+
+      # Volumes are resampled one frame at a time like the whole volume
+      volumeFile = os.path.join(testDataPath, 'Curvilinear', 'SpineUltrasound-Lumbar-C5-Trimmed.mha')
+      scanConversionGeometry = readScanConversionGeometry(os.path.join(testDataPath, 'Curvilinear', 'SpineUltrasound-Lumbar-C5_config.xml'))
+      lookupTable = ScanlineGeometry(scanConversionGeometry).getLookupTable()
+      arrayCache = ArrayDiskCache(cacheDirectory)
+      resampledArray = cachedResampleScanlines(arrayCache, volumeFile, scanConversionGeometry, lookupTable)
+      self.assertTrue(numpy.array_equal(resampledArray, resampleScanlines(MetaImageSequence(volumeFile).getFrames(), lookupTable)))
+      self.assertEqual(cachedResampleScanlines(arrayCache, volumeFile, scanConversionGeometry, lookupTable).filename, resampledArray.filename)
+    finally:
+      shutil.rmtree(cacheDirectory)
+
+    self.delayDisplay("ArrayDiskCache test passed!")
+
+  def test_USGeometry_SparseLabels(self):
+    self.delayDisplay("Starting SparseLabels test")
+    import glob, shutil, tempfile
+    from USGeometryLib import ArrayDiskCache, SparseLabelVolume, cachedSumSegmentationFiles, sumSparseSegmentationFiles
+    from USGeometryLib.SegmentationMerging import sumSegmentationFiles
+    from USGeometryLib.SegmentationMetrics import computeScanlineGroundTruth
+
+    testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data', 'Curvilinear')
+    segmentationFiles = sorted(glob.glob(os.path.join(testDataPath, 'TestManualSegmentations', '*.mha')))
+    summedArray = sumSegmentationFiles(segmentationFiles)
+    summedLabels = sumSparseSegmentationFiles(segmentationFiles, numberOfWorkers=2)
+    self.assertEqual(summedLabels.dtype, summedArray.dtype)
+    self.assertTrue(numpy.array_equal(summedLabels.toDense(), summedArray))
+    self.assertEqual(summedLabels, SparseLabelVolume.fromDense(summedArray))
+    self.assertTrue(numpy.array_equal(summedLabels.frame(2), summedArray[2]))
+    self.assertLess(summedLabels.nbytes, summedArray.nbytes // 10)
+
+    # Scanline samples of the sparse and dense volumes are the same
+    scanlineGeometry = ScanlineGeometry(readScanConversionGeometry(os.path.join(testDataPath, 'SpineUltrasound-Lumbar-C5_config.xml')))
+    lookupTable = scanlineGeometry.getLookupTable()
+    sparseGroundTruth = computeScanlineGroundTruth(summedLabels, lookupTable)
+    denseGroundTruth = computeScanlineGroundTruth(summedArray, lookupTable)
+    for name in ['frames', 'scanlines', 'samples', 'counts']:
+      self.assertTrue(numpy.array_equal(getattr(sparseGroundTruth, name), getattr(denseGroundTruth, name)))
+
+    # Sparse sums are cached compressed
+    cacheDirectory = tempfile.mkdtemp()
+    try:
+      cachedLabels = cachedSumSegmentationFiles(ArrayDiskCache(cacheDirectory), segmentationFiles, sparse=True)
+      self.assertEqual(cachedSumSegmentationFiles(ArrayDiskCache(cacheDirectory), segmentationFiles, sparse=True), cachedLabels)
+      self.assertEqual(len(glob.glob(os.path.join(cacheDirectory, '*.npz'))), 1)
+    finally:
+      shutil.rmtree(cacheDirectory)
+
+    self.delayDisplay("SparseLabels test passed!")
+
+  def test_USGeometry_MetricsTable(self):
+    self.delayDisplay("Starting MetricsTable test")
+    import glob, shutil, tempfile
+    from USGeometryLib import sumSparseSegmentationFiles, computeScanlineMetricsTable, computeFrameMetricsTable, saveMetricsTable, loadMetricsTable
+    from USGeometryLib.MetricsTable import scanlineColumns
+
+    testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data', 'Curvilinear')
+    segmentationFiles = sorted(glob.glob(os.path.join(testDataPath, 'TestManualSegmentations', '*.mha')))
+    scanlineGeometry = ScanlineGeometry(readScanConversionGeometry(os.path.join(testDataPath, 'SpineUltrasound-Lumbar-C5_config.xml')))
+    summedLabels = sumSparseSegmentationFiles(segmentationFiles)
+    # The first rater's segmentation as the algorithm, with a point on a scanline without ground truth
+    lookupTable = scanlineGeometry.getLookupTable()
+    algorithmArray = sumSparseSegmentationFiles(segmentationFiles[:1]).toDense()
+    groundTruth = computeScanlineGroundTruth(summedLabels, lookupTable)
+    emptyScanline = numpy.setdiff1d(numpy.arange(lookupTable.numberOfScanlines), groundTruth.scanlines[groundTruth.frames == 0])[0]
+    [emptyColumn, emptyRow] = lookupTable.sampleIndices[emptyScanline, lookupTable.sampleIndices.shape[1] // 2]
+    algorithmArray[0, emptyRow, emptyColumn] = 1
+    algorithmLabels = SparseLabelVolume.fromDense(algorithmArray)
+    statistics = computeScanlineStatistics(summedLabels, algorithmLabels, lookupTable, scanlineGeometry.outputImageSpacing)
+    metrics = evaluateScanlineStatistics(statistics, 2.0)
+
+    # The breakdown adds up to the global metrics
+    scanlineTable = computeScanlineMetricsTable(statistics, metrics)
+    frameTable = computeFrameMetricsTable(scanlineTable, summedLabels.shape[0])
+    self.assertEqual(list(scanlineTable.keys()), scanlineColumns)
+    emptyRowIndex = emptyScanline # Frame 0
+    self.assertFalse(scanlineTable['hasGroundTruth'][emptyRowIndex])
+    self.assertEqual(scanlineTable['algorithmPoints'][emptyRowIndex], 1)
+    self.assertTrue(numpy.isnan(scanlineTable['nearestAlgorithmDistance'][emptyRowIndex]))
+    self.assertFalse(numpy.isnan(scanlineTable['nearestAlgorithmDistance'][scanlineTable['hasGroundTruth'] & (scanlineTable['algorithmPoints'] > 0)]).any())
+    self.assertEqual(frameTable['algorithmPoints'].sum(), metrics.totalAlgorithmSegmentationPoints)
+    self.assertEqual(frameTable['truePositivePoints'].sum(), metrics.pointsWithinAcceptableRegion)
+    self.assertEqual(frameTable['scanlinesWithSegmentation'].sum() - frameTable['falseNegativeScanlines'].sum(), metrics.pointsWithinRequiredRegion)
+
+    outputDirectory = tempfile.mkdtemp()
+    try:
+      saveMetricsTable(scanlineTable, os.path.join(outputDirectory, 'scanlines.npz'))
+      loadedTable = loadMetricsTable(os.path.join(outputDirectory, 'scanlines.npz'), scanlineColumns)
+      self.assertTrue(numpy.array_equal(loadedTable['truePositivePoints'], scanlineTable['truePositivePoints']))
+      saveMetricsTable(frameTable, os.path.join(outputDirectory, 'frames.csv'))
+      with open(os.path.join(outputDirectory, 'frames.csv')) as tableStream:
+        self.assertEqual(len(tableStream.readlines()), summedLabels.shape[0] + 1)
+    finally:
+      shutil.rmtree(outputDirectory)
+
+    self.delayDisplay("MetricsTable test passed!")
+
+  def test_USGeometry_MetricsLabelMap(self):
+    self.delayDisplay("Starting MetricsLabelMap test")
+    import glob
+    from USGeometryLib import sumSparseSegmentationFiles
+
+    for [probeType, configFile] in [('Curvilinear', 'SpineUltrasound-Lumbar-C5_config.xml'), ('Linear', 'BoneUltrasound_L14_config.xml')]:
+      testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data', probeType)
+      segmentationFiles = sorted(glob.glob(os.path.join(testDataPath, 'TestManualSegmentations', '*.mha')))
+      scanlineGeometry = ScanlineGeometry(readScanConversionGeometry(os.path.join(testDataPath, configFile)))
+      lookupTable = scanlineGeometry.getLookupTable()
+      summedLabels = sumSparseSegmentationFiles(segmentationFiles)
+      statistics = computeScanlineStatistics(summedLabels, sumSparseSegmentationFiles(segmentationFiles[-1:]), lookupTable, scanlineGeometry.outputImageSpacing)
+      metrics = evaluateScanlineStatistics(statistics, 1.0)
+      unitVectors = lookupTable.unitVectors
+      labelMapShape = summedLabels.shape
+
+      # The mean point and the region edges of every scanline, drawn one scanline at a time like the original implementation
+      expectedLabelMap = numpy.zeros(labelMapShape, dtype=numpy.uint8)
+      def drawPoint(x, y, z, label):
+        if 0 <= x < labelMapShape[2] and 0 <= y < labelMapShape[1]:
+          expectedLabelMap[z, y, x] = label
+      for z, i in numpy.argwhere(metrics.hasGroundTruth):
+        drawPoint(int(metrics.xMean[z, i]), int(metrics.yMean[z, i]), z, 255)
+        for regionDistance, regionLabel in [(metrics.falseNegativeRegionDistance[z, i], 1), (metrics.acceptableDistance[z, i], 2)]:
+          for direction in [1, -1]:
+            drawPoint(int(metrics.xMean[z, i] + direction * regionDistance * unitVectors[i][0]),
+                      int(metrics.yMean[z, i] + direction * regionDistance * unitVectors[i][1]), z, regionLabel)
+      labelMap = metricsLabelMap(metrics, unitVectors, labelMapShape)
+      self.assertGreater(numpy.count_nonzero(labelMap), 0)
+      self.assertTrue(numpy.array_equal(labelMap, expectedLabelMap))
+
+      # An existing array is cleared and drawn into
+      labelMap = numpy.full(labelMapShape, 7, dtype=numpy.uint8)
+      self.assertIs(metricsLabelMap(metrics, unitVectors, labelMapShape, labelMap=labelMap), labelMap)
+      self.assertTrue(numpy.array_equal(labelMap, expectedLabelMap))
+
+      # Region lines keep the mean points and cover the region edges. Every whole pixel step along a scanline is inside
+      # the acceptable region, and the false negative regions are drawn over the acceptable regions of other scanlines
+      regionLabelMap = metricsLabelMap(metrics, unitVectors, labelMapShape, regionLines=True)
+      self.assertTrue(numpy.array_equal(regionLabelMap == 255, expectedLabelMap == 255))
+      self.assertTrue(numpy.all(regionLabelMap[expectedLabelMap > 0] > 0))
+      self.assertGreater(numpy.count_nonzero(regionLabelMap), numpy.count_nonzero(expectedLabelMap))
+      for z, i in numpy.argwhere(metrics.hasGroundTruth):
+        for regionDistance, regionLabels in [(metrics.falseNegativeRegionDistance[z, i], [1, 255]), (metrics.acceptableDistance[z, i], [1, 2, 255])]:
+          for step in numpy.arange(-numpy.floor(regionDistance), numpy.floor(regionDistance) + 1):
+            x = int(metrics.xMean[z, i] + step * unitVectors[i][0])
+            y = int(metrics.yMean[z, i] + step * unitVectors[i][1])
+            if 0 <= x < labelMapShape[2] and 0 <= y < labelMapShape[1]:
+              self.assertIn(regionLabelMap[z, y, x], regionLabels)
+
+    self.delayDisplay("MetricsLabelMap test passed!")
+
+  def test_USGeometry_MetricsCurve(self):
+    self.delayDisplay("Starting MetricsCurve test")
+    from USGeometryLib import SparseLabelVolume
+
+    testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data', 'Linear')
+    manualSegmentationsPath = os.path.join(testDataPath, 'TestManualSegmentations')
+    volumeNode = slicer.util.loadVolume(os.path.join(testDataPath, 'BoneUltrasound_L14_Trimmed.mha'), returnNode=True)[1]
+    algorithmSegmentation = slicer.util.loadLabelVolume(os.path.join(manualSegmentationsPath, 'BoneUltrasound_L14_Trimmed-ExampleManualSeg3.mha'), returnNode=True)[1]
+    logic = USGeometryLogic()
+    logic.setup(os.path.join(testDataPath, 'BoneUltrasound_L14_config.xml'), volumeNode)
+    summedImage = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+    logic.sumManualSegmentations(manualSegmentationsPath, summedImage)
+
+    # Every point of the curve equals the metrics computed from scratch at its distance
+    falseNegativeDistances = [0.5, 1.0, 2.0, 5.0]
+    curve = logic.computeMetricsCurve(summedImage, algorithmSegmentation, falseNegativeDistances)
+    self.assertEqual(curve.shape, (len(falseNegativeDistances), 4))
+    for [curvePoint, falseNegativeDistance] in zip(curve, falseNegativeDistances):
+      statistics = computeScanlineStatistics(SparseLabelVolume.fromDense(slicer.util.array(summedImage.GetID())),
+        SparseLabelVolume.fromDense(slicer.util.array(algorithmSegmentation.GetID())), logic.lookupTable, logic.outputImageSpacing)
+      metrics = evaluateScanlineStatistics(statistics, falseNegativeDistance)
+      self.assertEqual(curvePoint[0], falseNegativeDistance)
+      self.assertTrue(numpy.allclose(curvePoint[1:], [metrics.truePositive, metrics.falsePositive, metrics.falseNegative]))
+    self.assertTrue(numpy.allclose(curve[:3, 1:], [[95.1657458563536, 4.834254143646409, 82.27848101265822],
+      [100.0, 0.0, 48.52320675105485], [100.0, 0.0, 4.641350210970463]]))
+
+    # Statistics are kept while the inputs are unchanged
+    statistics = logic.getScanlineStatistics(summedImage, algorithmSegmentation)
+    scanlineGroundTruth = logic.scanlineGroundTruth
+    self.assertIs(logic.getScanlineStatistics(summedImage, algorithmSegmentation), statistics)
+
+    # Modifying the algorithm segmentation recomputes the statistics, but not the ground truth
+    slicer.util.array(algorithmSegmentation.GetID())[0] = 0
+    algorithmSegmentation.GetImageData().Modified()
+    modifiedStatistics = logic.getScanlineStatistics(summedImage, algorithmSegmentation)
+    self.assertIsNot(modifiedStatistics, statistics)
+    self.assertIs(logic.scanlineGroundTruth, scanlineGroundTruth)
+    self.assertLess(len(modifiedStatistics.algorithmFrames), len(statistics.algorithmFrames))
+
+    # Modifying the summed image recomputes the ground truth as well
+    slicer.util.array(summedImage.GetID())[:] = 0
+    summedImage.GetImageData().Modified()
+    self.assertIsNot(logic.getScanlineStatistics(summedImage, algorithmSegmentation), modifiedStatistics)
+    self.assertIsNot(logic.scanlineGroundTruth, scanlineGroundTruth)
+    self.assertTrue(numpy.isnan(logic.computeMetricsCurve(summedImage, algorithmSegmentation, falseNegativeDistances)[:, 1:]).all())
+
+    self.delayDisplay("MetricsCurve test passed!")
+
+  def test_USGeometry_CohortEvaluation(self):
+    self.delayDisplay("Starting CohortEvaluation test")
+    import csv, shutil, tempfile
+    from USGeometryLib.CohortEvaluation import evaluateCohort, readManifest, writeCohortResultsCsv
+
+    testDataPath = os.path.join(os.path.dirname(__file__), 'Testing', 'Data', 'Linear')
+    outputDirectory = tempfile.mkdtemp()
+    try:
+      # The second recording has an unreadable config file
+      brokenConfigFile = os.path.join(outputDirectory, 'broken_config.xml')
+      with open(brokenConfigFile, 'w') as configStream:
+        configStream.write('<PlusConfiguration><broken')
+      manifestFile = os.path.join(outputDirectory, 'manifest.csv')
+      with open(manifestFile, 'w') as manifestStream:
+        writer = csv.writer(manifestStream, lineterminator='\n')
+        writer.writerow(['name', 'volume', 'config', 'manualSegmentations', 'algorithm'])
+        for [name, configFile] in [('linear', os.path.join(testDataPath, 'BoneUltrasound_L14_config.xml')), ('broken', brokenConfigFile)]:
+          writer.writerow([name, os.path.join(testDataPath, 'BoneUltrasound_L14_Trimmed.mha'), configFile,
+                           os.path.join(testDataPath, 'TestManualSegmentations'),
+                           os.path.join(testDataPath, 'TestManualSegmentations', 'BoneUltrasound_L14_Trimmed-ExampleManualSeg3.mha')])
+
+      cohortResults = evaluateCohort(readManifest(manifestFile), 2.0, numberOfProcesses=1, cacheDirectory=os.path.join(outputDirectory, 'cache'))
+      [linearResult, brokenResult] = cohortResults['recordings']
+      self.assertIsNone(linearResult['error'])
+      self.assertAlmostEqual(linearResult['falseNegative'], 4.641350210970463, places=6)
+      self.assertEqual(brokenResult['name'], 'broken')
+      self.assertIn('ParseError', brokenResult['error'])
+      self.assertIsNone(brokenResult['truePositive'])
+      self.assertEqual(cohortResults['aggregate']['evaluatedRecordings'], 1)
+      self.assertEqual(cohortResults['aggregate']['failedRecordings'], 1)
+
+      # The error is recorded in the row of the recording
+      writeCohortResultsCsv(cohortResults, os.path.join(outputDirectory, 'results.csv'))
+      with open(os.path.join(outputDirectory, 'results.csv')) as resultsStream:
+        rows = list(csv.DictReader(resultsStream))
+      self.assertEqual([row['name'] for row in rows], ['linear', 'broken', 'pooled'])
+      self.assertEqual(rows[0]['error'], '')
+      self.assertIn('ParseError', rows[1]['error'])
+    finally:
+      shutil.rmtree(outputDirectory)
+
+    self.delayDisplay("CohortEvaluation test passed!")
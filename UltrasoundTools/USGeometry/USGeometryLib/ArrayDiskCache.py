@@ -0,0 +1,208 @@
+import os
+import errno
+import hashlib
+import numpy
+
+from .SegmentationMerging import sumSegmentationFiles
+from .MetaImageSequence import MetaImageSequence
+from .ScanlineGeometry import resampleScanlines
+from .SparseLabels import SparseLabelVolume, sumSparseSegmentationFiles
+
+#
+# ArrayDiskCache
+#
+
+cacheVersion = 2 # Increase when a cached computation changes, so that old entries are not used
+
+class ArrayDiskCache(object):
+  """Content-addressed cache of numpy arrays in a directory, shared between sessions and processes.
+  Arrays are stored as .npy files and returned memory-mapped read-only, so opening a cached array
+  costs no more than the pages that are used. Sparse label volumes are stored compressed as .npz files. Keys are made of the content digests of the input
+  files and the parameters of the computation. When the cache grows beyond its size limit, the
+  least recently used arrays and file digests are removed.
+  """
+
+  def __init__(self, directory, maximumSizeBytes=4 << 30):
+    '''
+    :param directory: Cache directory, created if it does not exist.
+    :param maximumSizeBytes: Total size of the cached arrays and file digests kept after each store.
+    '''
+    self.directory = os.path.abspath(directory)
+    self.maximumSizeBytes = maximumSizeBytes
+    self.digestDirectory = os.path.join(self.directory, 'digests')
+    for directoryName in [self.directory, self.digestDirectory]:
+      try:
+        os.makedirs(directoryName)
+      except OSError as error:
+        if error.errno != errno.EEXIST:
+          raise
+
+  def fileDigest(self, fileName):
+    '''
+    :return: SHA-1 digest of the file contents. Digests are remembered by path, size and modification time,
+      so unchanged files are only read once.
+    '''
+    fileStat = os.stat(fileName)
+    statKey = '{0}|{1}|{2!r}'.format(os.path.abspath(fileName), fileStat.st_size, fileStat.st_mtime)
+    digestFile = os.path.join(self.digestDirectory, hashlib.sha1(statKey.encode('utf-8')).hexdigest())
+    try:
+      with open(digestFile, 'r') as digestStream:
+        digest = digestStream.read().strip()
+      if len(digest) == 40:
+        os.utime(digestFile, None) # Most recently used
+        return digest
+    except (IOError, OSError):
+      pass
+    contentHash = hashlib.sha1()
+    with open(fileName, 'rb') as fileStream:
+      for chunk in iter(lambda: fileStream.read(1 << 20), b''):
+        contentHash.update(chunk)
+    digest = contentHash.hexdigest()
+    self.writeAtomically(digestFile, lambda stream: stream.write(digest.encode('ascii')))
+    self.evict(keep=digestFile)
+    return digest
+
+  def key(self, *parts):
+    '''
+    :param parts: Values identifying the array, e.g. file digests and geometry parameters. Their repr is hashed.
+    :return: Cache key.
+    '''
+    return hashlib.sha1('\n'.join([str(cacheVersion)] + [repr(part) for part in parts]).encode('utf-8')).hexdigest()
+
+  def arrayFile(self, key, sparse=False):
+    return os.path.join(self.directory, key + ('.npz' if sparse else '.npy'))
+
+  def get(self, key, sparse=False):
+    '''
+    :param sparse: Get a SparseLabelVolume stored with the key.
+    :return: Read-only memory-mapped array or SparseLabelVolume, or None if the key is not cached.
+    '''
+    arrayFile = self.arrayFile(key, sparse)
+    try:
+      array = SparseLabelVolume.load(arrayFile) if sparse else numpy.load(arrayFile, mmap_mode='r')
+    except (IOError, OSError, ValueError, KeyError):
+      return None
+    try:
+      os.utime(arrayFile, None) # Most recently used
+    except OSError:
+      pass
+    return array
+
+  def put(self, key, array):
+    '''
+    Stores an array or SparseLabelVolume and evicts the least recently used arrays beyond the size limit.
+    :return: The stored array memory-mapped read-only, or the SparseLabelVolume.
+    '''
+    if isinstance(array, SparseLabelVolume):
+      arrayFile = self.arrayFile(key, sparse=True)
+      self.writeAtomically(arrayFile, array.save)
+      self.evict(keep=arrayFile)
+      return array
+    arrayFile = self.arrayFile(key)
+    self.writeAtomically(arrayFile, lambda stream: numpy.save(stream, numpy.asarray(array)))
+    self.evict(keep=arrayFile)
+    return numpy.load(arrayFile, mmap_mode='r')
+
+  def getOrCompute(self, key, computeArray, sparse=False):
+    '''
+    :param computeArray: Called without arguments to compute the array when it is not cached.
+    :param sparse: computeArray returns a SparseLabelVolume.
+    :return: Read-only memory-mapped array, or SparseLabelVolume.
+    '''
+    array = self.get(key, sparse)
+    if array is None:
+      array = self.put(key, computeArray())
+    return array
+
+  def writeAtomically(self, fileName, write):
+    # Concurrent readers never see a partial file
+    temporaryFile = '{0}.{1}.tmp'.format(fileName, os.getpid())
+    with open(temporaryFile, 'wb') as stream:
+      write(stream)
+    try:
+      os.rename(temporaryFile, fileName)
+    except OSError:
+      # Another process stored the same content first, or the target is open on Windows
+      os.remove(temporaryFile)
+
+  def cachedFiles(self):
+    '''
+    :return: List of [modification time, size, path] of the cached arrays and file digests, least recently used first.
+    '''
+    paths = [os.path.join(self.directory, fileName) for fileName in os.listdir(self.directory) if fileName.endswith(('.npy', '.npz'))]
+    paths += [os.path.join(self.digestDirectory, fileName) for fileName in os.listdir(self.digestDirectory) if not fileName.endswith('.tmp')]
+    entries = []
+    for path in paths:
+      try:
+        fileStat = os.stat(path)
+      except OSError:
+        continue # Evicted by another process
+      entries.append([fileStat.st_mtime, fileStat.st_size, path])
+    return sorted(entries)
+
+  def sizeBytes(self):
+    return sum(size for [modificationTime, size, path] in self.cachedFiles())
+
+  def evict(self, keep=None):
+    '''
+    Removes least recently used arrays and file digests until the cache fits in maximumSizeBytes.
+    :param keep: Path of a file that is not removed, e.g. the one just stored.
+    '''
+    entries = self.cachedFiles()
+    totalSize = sum(size for [modificationTime, size, path] in entries)
+    for [modificationTime, size, path] in entries:
+      if totalSize <= self.maximumSizeBytes:
+        break
+      if path == keep:
+        continue
+      try:
+        os.remove(path)
+      except OSError:
+        continue # Removed by another process, or still mapped on Windows
+      totalSize -= size
+
+  def clear(self):
+    for [modificationTime, size, path] in self.cachedFiles():
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+
+#
+# Cached computations
+#
+
+def cachedSumSegmentationFiles(arrayCache, segmentationFiles, numberOfWorkers=None, sparse=False):
+  '''
+  Sums segmentation files like sumSegmentationFiles, unless the same file contents were summed before.
+  :param arrayCache: ArrayDiskCache, or None to always compute.
+  :param sparse: Sum with sumSparseSegmentationFiles, the dense volume is never in memory or on disk.
+  :return: Read-only (frames, rows, columns) array, or SparseLabelVolume if sparse.
+  '''
+  sumFiles = sumSparseSegmentationFiles if sparse else sumSegmentationFiles
+  if arrayCache is None:
+    return sumFiles(segmentationFiles, numberOfWorkers)
+  # The sum does not depend on the order of the files
+  digests = sorted(arrayCache.fileDigest(segmentationFile) for segmentationFile in segmentationFiles)
+  return arrayCache.getOrCompute(arrayCache.key('sumSegmentationFiles', digests),
+    lambda: sumFiles(segmentationFiles, numberOfWorkers), sparse)
+
+def cachedResampleScanlines(arrayCache, volumeFile, scanConversionGeometry, lookupTable):
+  '''
+  Resamples the volume of a file into scanlines like resampleScanlines, unless the same file contents
+  were resampled with the same geometry before.
+  :param arrayCache: ArrayDiskCache, or None to always compute.
+  :param scanConversionGeometry: ScanConversionGeometry of lookupTable.
+  :return: Read-only float32 array of shape (frames, numberOfScanlines, numberOfSamplesPerScanline + 1).
+  '''
+  def computeArray():
+    # One frame is decompressed at a time, the volume is never in memory
+    volumeSequence = MetaImageSequence(volumeFile)
+    resampledArray = numpy.empty((volumeSequence.numberOfFrames,) + lookupTable.samplePoints.shape[:2], dtype=numpy.float32)
+    for frameIndex, frame in enumerate(volumeSequence.iterFrames()):
+      resampleScanlines(frame[numpy.newaxis], lookupTable, resampledArray[frameIndex:frameIndex + 1])
+    return resampledArray
+  if arrayCache is None:
+    return computeArray()
+  return arrayCache.getOrCompute(arrayCache.key('resampleScanlines', arrayCache.fileDigest(volumeFile), tuple(scanConversionGeometry)),
+    computeArray)
@@ -0,0 +1,231 @@
+'''
+Evaluates an algorithm segmentation against merged manual segmentations over many recordings, e.g.
+
+  python -m USGeometryLib.CohortEvaluation manifest.csv --csv results.csv --json results.json --cache-directory cache
+
+The manifest is a CSV file with name, volume, config, manualSegmentations and algorithm columns, or a JSON
+list of objects with the same keys. Relative paths are relative to the manifest. Recordings are evaluated
+on a process pool, and results are cached by the paths, sizes and modification times of their input files.
+'''
+import os
+import csv
+import json
+import glob
+import hashlib
+import logging
+import argparse
+import multiprocessing
+import numpy
+
+from .MetaImageSequence import MetaImageSequence
+from .ScanConversion import readScanConversionGeometry
+from .ScanlineGeometry import ScanlineGeometry
+from .ArrayDiskCache import ArrayDiskCache, cachedSumSegmentationFiles
+from .SparseLabels import SparseLabelVolume
+from .SegmentationMetrics import computeSegmentationMetrics
+
+#
+# CohortEvaluation
+#
+
+manifestKeys = ['name', 'volume', 'config', 'manualSegmentations', 'algorithm']
+
+countNames = ['totalAlgorithmSegmentationPoints', 'pointsWithinAcceptableRegion', 'pointsWithinRequiredRegion', 'scanlinesWithSegmentation']
+resultColumns = ['name', 'frames', 'truePositive', 'falsePositive', 'falseNegative'] + countNames + ['error']
+
+cacheVersion = 1 # Increase when the metric computation changes, so that cached results are not used
+
+def readManifest(manifestFile):
+  '''
+  :param manifestFile: CSV or JSON manifest of the recordings.
+  :return: List of recording dictionaries with absolute paths.
+  :raises ValueError: if an entry misses a key.
+  '''
+  with open(manifestFile, 'r') as manifestStream:
+    if manifestFile.lower().endswith('.json'):
+      entries = json.load(manifestStream)
+    else:
+      entries = list(csv.DictReader(manifestStream))
+  manifestDirectory = os.path.dirname(os.path.abspath(manifestFile))
+  recordings = []
+  for entryIndex, entry in enumerate(entries):
+    missingKeys = [key for key in manifestKeys[1:] if not entry.get(key)]
+    if missingKeys:
+      raise ValueError("Manifest entry {} is missing {}".format(entryIndex, ', '.join(missingKeys)))
+    recording = dict((key, os.path.join(manifestDirectory, entry[key])) for key in manifestKeys[1:])
+    recording['name'] = entry.get('name') or os.path.splitext(os.path.basename(entry['volume']))[0]
+    recordings.append(recording)
+  return recordings
+
+def manualSegmentationFiles(manualSegmentationsDirectory):
+  return sorted(glob.glob(os.path.join(manualSegmentationsDirectory, "*.mha")))
+
+def recordingCacheKey(recording, falseNegativeDistance):
+  '''
+  :return: Hash of the input file paths, sizes and modification times and of the metric parameters.
+  '''
+  inputFiles = [recording['volume'], recording['config'], recording['algorithm']] + manualSegmentationFiles(recording['manualSegmentations'])
+  keyParts = [str(cacheVersion), repr(float(falseNegativeDistance))]
+  for inputFile in inputFiles:
+    fileStat = os.stat(inputFile)
+    keyParts.append('{0}|{1}|{2!r}'.format(os.path.abspath(inputFile), fileStat.st_size, fileStat.st_mtime))
+  return hashlib.sha1('\n'.join(keyParts).encode('utf-8')).hexdigest()
+
+def evaluateRecording(recording, falseNegativeDistance, arrayCache=None):
+  '''
+  Computes the segmentation metrics of one recording.
+  :param recording: Dictionary with volume, config, manualSegmentations and algorithm paths.
+  :param falseNegativeDistance: Distance in mm.
+  :param arrayCache: ArrayDiskCache of merged manual segmentations, or None to always merge them.
+  :return: Result dictionary with the resultColumns keys.
+  :raises ValueError: if the inputs do not match each other.
+  '''
+  scanlineGeometry = ScanlineGeometry(readScanConversionGeometry(recording['config']))
+  volume = MetaImageSequence(recording['volume'])
+  scanlineGeometry.checkImageDimensions((volume.frameShape[1], volume.frameShape[0]))
+  volumeShape = (volume.numberOfFrames,) + volume.frameShape
+
+  # Workers already run in parallel, so segmentation files of one recording are read on a single thread.
+  # Segmentations are only kept as their labeled voxels, so long recordings do not fill the memory of every worker.
+  summedArray = cachedSumSegmentationFiles(arrayCache, manualSegmentationFiles(recording['manualSegmentations']), numberOfWorkers=1, sparse=True)
+  algorithmArray = SparseLabelVolume.fromFile(recording['algorithm'])
+  for arrayName, array in [('Manual segmentations', summedArray), ('Algorithm segmentation', algorithmArray)]:
+    if array.shape != volumeShape:
+      raise ValueError("{} size {} does not match the volume size {}".format(arrayName, array.shape, volumeShape))
+
+  metrics = computeSegmentationMetrics(summedArray, algorithmArray, scanlineGeometry.getLookupTable(),
+    scanlineGeometry.outputImageSpacing, falseNegativeDistance)
+  result = {'name': recording['name'], 'frames': volume.numberOfFrames, 'error': None}
+  for name in ['truePositive', 'falsePositive', 'falseNegative'] + countNames:
+    result[name] = getattr(metrics, name)
+  return result
+
+def evaluateRecordingCached(arguments):
+  '''
+  Process pool task, evaluates a recording unless its result is in the cache directory.
+  Errors are returned in the result, so that one bad recording does not stop the cohort. Merged manual
+  segmentations are cached in the arrays subdirectory, so evaluating other algorithms or distances does not merge them again.
+  '''
+  [recording, falseNegativeDistance, cacheDirectory] = arguments
+  try:
+    cacheFile = None
+    arrayCache = None
+    if cacheDirectory:
+      arrayCache = ArrayDiskCache(os.path.join(cacheDirectory, 'arrays'))
+      cacheFile = os.path.join(cacheDirectory, recordingCacheKey(recording, falseNegativeDistance) + '.json')
+      if os.path.exists(cacheFile):
+        with open(cacheFile, 'r') as cacheStream:
+          result = json.load(cacheStream)
+        result['name'] = recording['name']
+        return result
+    result = evaluateRecording(recording, falseNegativeDistance, arrayCache)
+  except Exception as error:
+    # Any error of a recording, e.g. an unreadable config file, only fails its own row
+    logging.debug('Evaluation of {0} failed'.format(recording['name']), exc_info=True)
+    return dict([(name, None) for name in resultColumns], name=recording['name'], error='{0}: {1}'.format(type(error).__name__, error))
+  if cacheFile:
+    # Write to a temporary file first, so that concurrent readers never see a partial result
+    temporaryFile = '{0}.{1}.tmp'.format(cacheFile, os.getpid())
+    with open(temporaryFile, 'w') as cacheStream:
+      json.dump(result, cacheStream)
+    try:
+      os.rename(temporaryFile, cacheFile)
+    except OSError:
+      os.remove(temporaryFile) # Another worker cached the same result first
+  return result
+
+def aggregateResults(results):
+  '''
+  :param results: Per-recording result dictionaries.
+  :return: Dictionary of pooled metrics (from the summed point counts of all recordings) and the mean and
+    standard deviation of the per-recording metrics, over the recordings without errors.
+  '''
+  evaluated = [result for result in results if not result['error'] and result['truePositive'] is not None]
+  aggregate = {'recordings': len(results), 'evaluatedRecordings': len(evaluated),
+               'failedRecordings': len([result for result in results if result['error']])}
+  totals = dict((name, sum(result[name] for result in evaluated)) for name in countNames)
+  aggregate.update(totals)
+  aggregate['frames'] = sum(result['frames'] for result in evaluated)
+  aggregate['pooledTruePositive'] = None
+  aggregate['pooledFalsePositive'] = None
+  aggregate['pooledFalseNegative'] = None
+  if totals['totalAlgorithmSegmentationPoints'] > 0 and totals['scanlinesWithSegmentation'] > 0:
+    aggregate['pooledTruePositive'] = float(totals['pointsWithinAcceptableRegion']) / totals['totalAlgorithmSegmentationPoints'] * 100
+    aggregate['pooledFalsePositive'] = 100 - aggregate['pooledTruePositive']
+    aggregate['pooledFalseNegative'] = (1 - float(totals['pointsWithinRequiredRegion']) / totals['scanlinesWithSegmentation']) * 100
+  for name in ['truePositive', 'falsePositive', 'falseNegative']:
+    values = [result[name] for result in evaluated]
+    aggregate['mean' + name[0].upper() + name[1:]] = float(numpy.mean(values)) if values else None
+    aggregate['std' + name[0].upper() + name[1:]] = float(numpy.std(values)) if values else None
+  return aggregate
+
+def evaluateCohort(recordings, falseNegativeDistance, numberOfProcesses=None, cacheDirectory=None):
+  '''
+  Evaluates the segmentation metrics of many recordings on a process pool.
+  :param recordings: Recording dictionaries, e.g. from readManifest.
+  :param falseNegativeDistance: Distance in mm.
+  :param numberOfProcesses: Number of worker processes, the number of processors by default.
+  :param cacheDirectory: Directory of cached results, results are not cached if None.
+  :return: Dictionary with the per-recording 'recordings' results in manifest order and the 'aggregate' results.
+  '''
+  if cacheDirectory and not os.path.isdir(cacheDirectory):
+    os.makedirs(cacheDirectory)
+  tasks = [(recording, falseNegativeDistance, cacheDirectory) for recording in recordings]
+  if numberOfProcesses is None:
+    numberOfProcesses = multiprocessing.cpu_count()
+  numberOfProcesses = max(1, min(numberOfProcesses, len(tasks)))
+  if numberOfProcesses == 1:
+    results = [evaluateRecordingCached(task) for task in tasks]
+  else:
+    pool = multiprocessing.Pool(numberOfProcesses)
+    try:
+      results = pool.map(evaluateRecordingCached, tasks, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+  for result in results:
+    if result['error']:
+      logging.error('Evaluation of {0} failed: {1}'.format(result['name'], result['error']))
+  return {'falseNegativeDistance': falseNegativeDistance, 'recordings': results, 'aggregate': aggregateResults(results)}
+
+def writeCohortResultsCsv(cohortResults, outputFile):
+  '''
+  Writes one row per recording, followed by a row of the pooled metrics named "pooled".
+  '''
+  aggregate = cohortResults['aggregate']
+  with open(outputFile, 'w') as outputStream:
+    writer = csv.DictWriter(outputStream, fieldnames=resultColumns, lineterminator='\n')
+    writer.writeheader()
+    for result in cohortResults['recordings']:
+      writer.writerow(result)
+    pooledRow = dict((name, aggregate.get(name)) for name in countNames + ['frames'])
+    pooledRow.update({'name': 'pooled', 'truePositive': aggregate['pooledTruePositive'],
+                      'falsePositive': aggregate['pooledFalsePositive'], 'falseNegative': aggregate['pooledFalseNegative']})
+    writer.writerow(pooledRow)
+
+def writeCohortResultsJson(cohortResults, outputFile):
+  with open(outputFile, 'w') as outputStream:
+    json.dump(cohortResults, outputStream, indent=2)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Evaluate segmentation metrics over a cohort of ultrasound recordings.')
+  parser.add_argument('manifest', help='CSV or JSON manifest with name, volume, config, manualSegmentations and algorithm')
+  parser.add_argument('--false-negative-distance', type=float, default=2.0, help='False negative distance in mm')
+  parser.add_argument('--processes', type=int, default=None, help='Number of worker processes (default: number of processors)')
+  parser.add_argument('--cache-directory', default=None, help='Directory of cached per-recording results')
+  parser.add_argument('--csv', default=None, help='Output CSV file of per-recording and pooled metrics')
+  parser.add_argument('--json', default=None, help='Output JSON file of per-recording and aggregated metrics')
+  args = parser.parse_args(argv)
+
+  cohortResults = evaluateCohort(readManifest(args.manifest), args.false_negative_distance, args.processes, args.cache_directory)
+  if args.csv:
+    writeCohortResultsCsv(cohortResults, args.csv)
+  if args.json:
+    writeCohortResultsJson(cohortResults, args.json)
+  if not args.csv and not args.json:
+    print(json.dumps(cohortResults['aggregate'], indent=2))
+  return 1 if cohortResults['aggregate']['failedRecordings'] else 0
+
+if __name__ == '__main__':
+  import sys
+  sys.exit(main())
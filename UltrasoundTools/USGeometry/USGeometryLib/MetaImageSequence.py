@@ -0,0 +1,207 @@
+import os
+import zlib
+import numpy
+
+#
+# MetaImageSequence
+#
+
+metaImageElementTypes = {
+  'MET_CHAR': numpy.int8,
+  'MET_UCHAR': numpy.uint8,
+  'MET_SHORT': numpy.int16,
+  'MET_USHORT': numpy.uint16,
+  'MET_INT': numpy.int32,
+  'MET_UINT': numpy.uint32,
+  'MET_LONG_LONG': numpy.int64,
+  'MET_ULONG_LONG': numpy.uint64,
+  'MET_FLOAT': numpy.float32,
+  'MET_DOUBLE': numpy.float64,
+  }
+
+class MetaImageSequence(object):
+  """PLUS sequence MetaImage (.mha/.mhd) file read without loading it into the scene.
+  The header is parsed once: per-frame transforms, transform statuses and timestamps are collected
+  into numpy arrays. Uncompressed pixel data is memory mapped, so frames are only read from disk
+  when they are accessed. Compressed pixel data is decompressed as a stream, one frame at a time.
+  """
+
+  def __init__(self, fileName, chunkSizeBytes=1 << 20):
+    '''
+    :param fileName: Path of the sequence file.
+    :param chunkSizeBytes: Size of compressed data read from the file at a time.
+    :raises ValueError: if the file is not a MetaImage file that can be read.
+    '''
+    self.fileName = fileName
+    self.chunkSizeBytes = chunkSizeBytes
+    self.header = {}
+    self.frameFields = {}
+    self.transformMatrices = {}
+    self.transformStatus = {}
+    self.timestamps = None
+    self.memoryMappedFrames = None
+    self.streamState = None
+    self.readHeader()
+
+  def readHeader(self):
+    frameValues = {}
+    with open(self.fileName, 'rb') as headerStream:
+      while True:
+        line = headerStream.readline()
+        if not line:
+          raise ValueError("MetaImage header has no ElementDataFile field: " + self.fileName)
+        [name, separator, value] = line.decode('latin-1').partition('=')
+        if not separator:
+          continue
+        name = name.strip()
+        value = value.strip()
+        if name.startswith('Seq_Frame'):
+          [frameIndex, separator, fieldName] = name[len('Seq_Frame'):].partition('_')
+          frameValues.setdefault(fieldName, {})[int(frameIndex)] = value
+          continue
+        self.header[name] = value
+        if name == 'ElementDataFile':
+          self.dataOffset = headerStream.tell()
+          break
+
+    try:
+      dimensions = [int(size) for size in self.header['DimSize'].split()]
+      self.dtype = numpy.dtype(metaImageElementTypes[self.header['ElementType']])
+    except KeyError as error:
+      raise ValueError("MetaImage header is missing or has unsupported {}: {}".format(error, self.fileName))
+    if self.header.get('BinaryDataByteOrderMSB', 'False') == 'True':
+      self.dtype = self.dtype.newbyteorder('>')
+    else:
+      self.dtype = self.dtype.newbyteorder('<')
+
+    self.numberOfFrames = dimensions[2] if len(dimensions) > 2 else 1
+    self.frameShape = (dimensions[1], dimensions[0])
+    numberOfChannels = int(self.header.get('ElementNumberOfChannels', '1'))
+    if numberOfChannels > 1:
+      self.frameShape += (numberOfChannels,)
+    self.frameSizeBytes = int(numpy.prod(self.frameShape)) * self.dtype.itemsize
+    self.spacing = [float(spacing) for spacing in self.header.get('ElementSpacing', '1 1 1').split()]
+    self.compressed = self.header.get('CompressedData', 'False') == 'True'
+
+    dataFile = self.header['ElementDataFile']
+    if dataFile == 'LOCAL':
+      self.dataFileName = self.fileName
+    elif dataFile == 'LIST' or '%' in dataFile:
+      raise ValueError("MetaImage files with lists of data files are not supported: " + self.fileName)
+    else:
+      self.dataFileName = os.path.join(os.path.dirname(self.fileName), dataFile)
+      self.dataOffset = 0
+
+    for fieldName, values in frameValues.items():
+      if fieldName.endswith('TransformStatus'):
+        continue
+      if fieldName.endswith('Transform'):
+        transformName = fieldName[:-len('Transform')]
+        matrices = numpy.full((self.numberOfFrames, 4, 4), numpy.nan)
+        status = numpy.zeros(self.numberOfFrames, dtype=bool)
+        for frameIndex, matrix in values.items():
+          matrices[frameIndex] = numpy.array([float(element) for element in matrix.split()]).reshape(4, 4)
+          status[frameIndex] = True
+        for frameIndex, frameStatus in frameValues.get(fieldName + 'Status', {}).items():
+          status[frameIndex] &= (frameStatus == 'OK')
+        self.transformMatrices[transformName] = matrices
+        self.transformStatus[transformName] = status
+      elif fieldName == 'Timestamp':
+        self.timestamps = numpy.full(self.numberOfFrames, numpy.nan)
+        for frameIndex, timestamp in values.items():
+          self.timestamps[frameIndex] = float(timestamp)
+      else:
+        self.frameFields[fieldName] = [values.get(frameIndex) for frameIndex in range(self.numberOfFrames)]
+
+  def transformNames(self):
+    '''
+    :return: Names of the per-frame transforms, e.g. "ProbeToTracker".
+    '''
+    return sorted(self.transformMatrices.keys())
+
+  def getTransforms(self, transformName):
+    '''
+    :param transformName: Transform name without the Transform suffix, e.g. "ProbeToTracker".
+    :return: (frames, 4, 4) array of transform matrices, NaN for frames where the transform status is not OK.
+    :raises KeyError: if the sequence has no such transform.
+    '''
+    transforms = self.transformMatrices[transformName].copy()
+    transforms[~self.transformStatus[transformName]] = numpy.nan
+    return transforms
+
+  def getFrames(self):
+    '''
+    All frames as a (frames, rows, columns) array. For uncompressed data this is a read-only memory map
+    and no pixel data is read until it is accessed. Compressed data is decompressed completely, use
+    iterFrames to keep memory bounded.
+    '''
+    if not self.compressed:
+      if self.memoryMappedFrames is None:
+        self.memoryMappedFrames = numpy.memmap(self.dataFileName, dtype=self.dtype, mode='r',
+          offset=self.dataOffset, shape=(self.numberOfFrames,) + self.frameShape)
+      return self.memoryMappedFrames
+    frames = numpy.empty((self.numberOfFrames,) + self.frameShape, dtype=self.dtype)
+    for frameIndex, frame in enumerate(self.iterFrames()):
+      frames[frameIndex] = frame
+    return frames
+
+  def getFrame(self, frameIndex):
+    '''
+    :return: One frame as a (rows, columns) array. Uncompressed frames are views of the memory map.
+      Compressed frames are decompressed from the last accessed frame if possible, so
+      accessing frames in increasing order does not decompress the data more than once.
+    '''
+    if frameIndex < 0:
+      frameIndex += self.numberOfFrames
+    if frameIndex < 0 or frameIndex >= self.numberOfFrames:
+      raise IndexError("Frame index out of range: {}".format(frameIndex))
+    if not self.compressed:
+      return self.getFrames()[frameIndex]
+    if self.streamState is None or self.streamState[0] > frameIndex:
+      self.streamState = [0, self.iterCompressedFrames()]
+    while True:
+      frame = next(self.streamState[1])
+      self.streamState[0] += 1
+      if self.streamState[0] > frameIndex:
+        return frame
+
+  def iterFrames(self, start=0, stop=None):
+    '''
+    Iterates over frames in order. Only one frame of decompressed data is held in memory at a time.
+    Compressed data cannot be seeked, so frames before start are still decompressed.
+    '''
+    if stop is None or stop > self.numberOfFrames:
+      stop = self.numberOfFrames
+    if not self.compressed:
+      frames = self.getFrames()
+      for frameIndex in range(start, stop):
+        yield frames[frameIndex]
+      return
+    compressedFrames = self.iterCompressedFrames()
+    for frameIndex in range(stop):
+      frame = next(compressedFrames)
+      if frameIndex >= start:
+        yield frame
+
+  def iterCompressedFrames(self):
+    decompressor = zlib.decompressobj()
+    frameData = bytearray()
+    compressedData = b''
+    with open(self.dataFileName, 'rb') as dataStream:
+      dataStream.seek(self.dataOffset)
+      for frameIndex in range(self.numberOfFrames):
+        while len(frameData) < self.frameSizeBytes:
+          if not compressedData:
+            compressedData = dataStream.read(self.chunkSizeBytes)
+            if not compressedData:
+              # Input is consumed, only output buffered in the decompressor is left
+              remainingData = decompressor.flush()
+              if not remainingData:
+                raise ValueError("Compressed pixel data ends at frame {}: {}".format(frameIndex, self.fileName))
+              frameData.extend(remainingData)
+              continue
+          frameData.extend(decompressor.decompress(compressedData, self.frameSizeBytes - len(frameData)))
+          compressedData = decompressor.unconsumed_tail
+        frame = numpy.frombuffer(bytes(frameData[:self.frameSizeBytes]), dtype=self.dtype).reshape(self.frameShape)
+        del frameData[:self.frameSizeBytes]
+        yield frame
@@ -0,0 +1,124 @@
+import csv
+import json
+import logging
+import collections
+import numpy
+
+#
+# MetricsTable
+#
+
+# Columns of the tables, a table is an OrderedDict of equally long column arrays
+scanlineColumns = ['frame', 'scanline', 'hasGroundTruth', 'xMean', 'yMean', 'std',
+                   'algorithmPoints', 'truePositivePoints', 'falsePositivePoints', 'falseNegative',
+                   'nearestAlgorithmDistance', 'falseNegativeRegionDistance', 'acceptableDistance']
+frameColumns = ['frame', 'scanlinesWithSegmentation', 'algorithmPoints', 'truePositivePoints', 'falsePositivePoints',
+                'falseNegativeScanlines', 'truePositive', 'falsePositive', 'falseNegative']
+
+metricsLogger = logging.getLogger('USGeometry.metrics') # Rows are logged as JSON at DEBUG level, if enabled
+
+def computeScanlineMetricsTable(statistics, metrics):
+  '''
+  Breaks the segmentation metrics down to every scanline of every frame.
+  :param statistics: ScanlineStatistics the metrics were evaluated from.
+  :param metrics: SegmentationMetrics of one false negative distance.
+  :return: Table with the scanlineColumns, one row per scanline of every frame in frame order. Distances are in pixels,
+    nearestAlgorithmDistance is NaN on scanlines without algorithm points or without ground truth, and ground truth columns
+    are only valid where hasGroundTruth.
+  '''
+  hasGroundTruth = metrics.hasGroundTruth
+  scanlineShape = hasGroundTruth.shape
+  frames = statistics.algorithmFrames
+  scanlines = statistics.algorithmScanlines
+  distances = statistics.algorithmDistances
+  scanlineIndices = frames * scanlineShape[1] + scanlines
+
+  # Same point classification as evaluateScanlineStatistics
+  withinAcceptableRegion = hasGroundTruth[frames, scanlines] & (distances <= metrics.acceptableDistance[frames, scanlines])
+  withinRequiredRegion = distances < metrics.falseNegativeRegionDistance[frames, scanlines]
+  def scanlineCounts(selected=None):
+    return numpy.bincount(scanlineIndices if selected is None else scanlineIndices[selected], minlength=hasGroundTruth.size)
+  requiredRegionIdentified = scanlineCounts(withinRequiredRegion).reshape(scanlineShape) > 0
+
+  nearestAlgorithmDistance = numpy.full(hasGroundTruth.size, numpy.inf)
+  numpy.minimum.at(nearestAlgorithmDistance, scanlineIndices, distances)
+  # Without ground truth the distances are to the meaningless mean point (0, 0)
+  nearestAlgorithmDistance[numpy.isinf(nearestAlgorithmDistance) | ~hasGroundTruth.ravel()] = numpy.nan
+
+  algorithmPoints = scanlineCounts()
+  truePositivePoints = scanlineCounts(withinAcceptableRegion)
+  [frameIndices, scanlineNumbers] = numpy.indices(scanlineShape).reshape(2, -1)
+  return collections.OrderedDict([
+    ('frame', frameIndices), ('scanline', scanlineNumbers), ('hasGroundTruth', hasGroundTruth.ravel()),
+    ('xMean', metrics.xMean.ravel()), ('yMean', metrics.yMean.ravel()), ('std', statistics.std.ravel()),
+    ('algorithmPoints', algorithmPoints), ('truePositivePoints', truePositivePoints), ('falsePositivePoints', algorithmPoints - truePositivePoints),
+    ('falseNegative', (hasGroundTruth & ~requiredRegionIdentified).ravel()), ('nearestAlgorithmDistance', nearestAlgorithmDistance),
+    ('falseNegativeRegionDistance', numpy.ascontiguousarray(metrics.falseNegativeRegionDistance).ravel()),
+    ('acceptableDistance', metrics.acceptableDistance.ravel())])
+
+def computeFrameMetricsTable(scanlineTable, numberOfFrames):
+  '''
+  :param scanlineTable: Table from computeScanlineMetricsTable.
+  :return: Table with the frameColumns, one row per frame. Percentages are NaN where there are no points to compare.
+  '''
+  def frameSums(values):
+    return numpy.bincount(scanlineTable['frame'], weights=values, minlength=numberOfFrames).astype(numpy.int64)
+  scanlinesWithSegmentation = frameSums(scanlineTable['hasGroundTruth'])
+  algorithmPoints = frameSums(scanlineTable['algorithmPoints'])
+  truePositivePoints = frameSums(scanlineTable['truePositivePoints'])
+  falseNegativeScanlines = frameSums(scanlineTable['falseNegative'])
+  comparable = (algorithmPoints > 0) & (scanlinesWithSegmentation > 0)
+  def percentage(numerators, denominators):
+    return numpy.where(comparable, 100.0 * numerators / numpy.maximum(denominators, 1), numpy.nan)
+  return collections.OrderedDict([
+    ('frame', numpy.arange(numberOfFrames)), ('scanlinesWithSegmentation', scanlinesWithSegmentation),
+    ('algorithmPoints', algorithmPoints), ('truePositivePoints', truePositivePoints), ('falsePositivePoints', algorithmPoints - truePositivePoints),
+    ('falseNegativeScanlines', falseNegativeScanlines),
+    ('truePositive', percentage(truePositivePoints, algorithmPoints)), ('falsePositive', percentage(algorithmPoints - truePositivePoints, algorithmPoints)),
+    ('falseNegative', percentage(falseNegativeScanlines, scanlinesWithSegmentation))])
+
+def tableRows(table, selected=None):
+  '''
+  :param selected: Boolean array of the rows to return, all rows by default.
+  :return: Iterator of row dictionaries with Python values, NaN as None.
+  '''
+  columns = [(name, values if selected is None else values[selected]) for name, values in table.items()]
+  for rowIndex in range(len(columns[0][1]) if columns else 0):
+    row = collections.OrderedDict()
+    for name, values in columns:
+      value = values[rowIndex].item()
+      row[name] = None if isinstance(value, float) and value != value else value
+    yield row
+
+def logMetricsTable(table, tableName, selected=None):
+  '''
+  Logs rows of a table as JSON to the USGeometry.metrics logger, only if it is enabled for DEBUG messages, e.g. with
+  logging.getLogger('USGeometry.metrics').setLevel(logging.DEBUG)
+  '''
+  if not metricsLogger.isEnabledFor(logging.DEBUG):
+    return
+  for row in tableRows(table, selected):
+    metricsLogger.debug(json.dumps(collections.OrderedDict([('table', tableName)] + list(row.items()))))
+
+def writeMetricsTableCsv(table, outputFile):
+  with open(outputFile, 'w') as outputStream:
+    writer = csv.writer(outputStream, lineterminator='\n')
+    writer.writerow(list(table.keys()))
+    writer.writerows(zip(*[values.tolist() for values in table.values()]))
+
+def saveMetricsTable(table, outputFile):
+  '''
+  Saves a table as a compressed .npz file of its columns, or as CSV if outputFile ends with .csv.
+  '''
+  if outputFile.lower().endswith('.csv'):
+    writeMetricsTableCsv(table, outputFile)
+  else:
+    numpy.savez_compressed(outputFile, **table)
+
+def loadMetricsTable(inputFile, columns):
+  '''
+  :param columns: Column names in order, scanlineColumns or frameColumns.
+  :return: Table of a .npz file written by saveMetricsTable.
+  '''
+  with numpy.load(inputFile) as arrays:
+    return collections.OrderedDict((name, arrays[name]) for name in columns)
@@ -0,0 +1,134 @@
+import json
+import time
+import functools
+import threading
+import collections
+import numpy
+
+#
+# Profiling
+#
+
+try:
+  clock = time.perf_counter
+except AttributeError:
+  clock = time.time # Python 2
+
+class DisabledTimer(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, traceback):
+    return False
+
+disabledTimer = DisabledTimer() # Shared by all disabled timers, so a disabled stage costs no allocation
+
+class StageTimer(object):
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    self.startTime = clock()
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, traceback):
+    self.profiler.addDuration(self.name, clock() - self.startTime)
+    return False
+
+class Profiler(object):
+  """Named stage timers and event counters of a logic, e.g.
+
+    with profiler.timer('detection'):
+      ...
+    profiler.count('framesProcessed')
+
+  Disabled by default; a disabled profiler does not read the clock and does not record anything.
+  Timers and counters can be recorded from worker threads.
+  """
+
+  def __init__(self, enabled=False, maximumSamples=10000):
+    '''
+    :param enabled: Record timers and counters.
+    :param maximumSamples: Number of most recent durations kept per stage for the percentiles.
+    '''
+    self.enabled = enabled
+    self.maximumSamples = maximumSamples
+    self.lock = threading.Lock()
+    self.reset()
+
+  def setEnabled(self, enabled):
+    self.enabled = enabled
+
+  def reset(self):
+    with self.lock:
+      self.durations = collections.OrderedDict() # Stage name: deque of the recent durations in seconds
+      self.stageCounts = collections.OrderedDict()
+      self.stageTotals = collections.OrderedDict()
+      self.counters = collections.OrderedDict()
+
+  def timer(self, name):
+    '''
+    :return: Context manager that records the duration of its block as the stage name.
+    '''
+    if not self.enabled:
+      return disabledTimer
+    return StageTimer(self, name)
+
+  def addDuration(self, name, seconds):
+    with self.lock:
+      if name not in self.durations:
+        self.durations[name] = collections.deque(maxlen=self.maximumSamples)
+        self.stageCounts[name] = 0
+        self.stageTotals[name] = 0.0
+      self.durations[name].append(seconds)
+      self.stageCounts[name] += 1
+      self.stageTotals[name] += seconds
+
+  def count(self, name, increment=1):
+    if not self.enabled:
+      return
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + increment
+
+  def summary(self):
+    '''
+    :return: Dictionary of 'timers', with the call count, total, mean, median (p50), 95th percentile (p95) and maximum
+      milliseconds of every stage, and 'counters'. Percentiles are of the most recent maximumSamples calls.
+    '''
+    with self.lock:
+      timers = collections.OrderedDict()
+      for name, durations in self.durations.items():
+        durationsMs = numpy.array(durations) * 1000.0
+        [p50Ms, p95Ms] = numpy.percentile(durationsMs, [50, 95])
+        timers[name] = collections.OrderedDict([
+          ('count', self.stageCounts[name]), ('totalMs', self.stageTotals[name] * 1000.0),
+          ('meanMs', self.stageTotals[name] * 1000.0 / self.stageCounts[name]),
+          ('p50Ms', float(p50Ms)), ('p95Ms', float(p95Ms)), ('maxMs', float(durationsMs.max()))])
+      return collections.OrderedDict([('timers', timers), ('counters', collections.OrderedDict(self.counters))])
+
+  def summaryText(self):
+    '''
+    :return: One line per stage and counter, e.g. for a message label.
+    '''
+    summary = self.summary()
+    lines = ['{0}: {1} calls, p50 {2:.1f} ms, p95 {3:.1f} ms'.format(name, timer['count'], timer['p50Ms'], timer['p95Ms'])
+             for name, timer in summary['timers'].items()]
+    lines += ['{0}: {1}'.format(name, value) for name, value in summary['counters'].items()]
+    return '\n'.join(lines)
+
+  def writeJson(self, outputFile):
+    with open(outputFile, 'w') as outputStream:
+      json.dump(self.summary(), outputStream, indent=2)
+
+def profiledMethod(name):
+  '''
+  Decorator that times every call of a method as the stage name, with the profiler attribute of its object.
+  '''
+  def decorator(method):
+    @functools.wraps(method)
+    def profiled(self, *args, **kwargs):
+      with self.profiler.timer(name):
+        return method(self, *args, **kwargs)
+    return profiled
+  return decorator
@@ -0,0 +1,98 @@
+import os
+import collections
+import threading
+import numpy
+
+#
+# ScanConversionGeometry
+#
+
+ScanConversionGeometry = collections.namedtuple('ScanConversionGeometry', [
+  'transducerGeometry', 'outputImageSizePixel', 'transducerCenterPixel', 'outputImageSpacing',
+  'numberOfScanlines', 'numberOfSamplesPerScanline',
+  'thetaStartDeg', 'thetaStopDeg', 'radiusStartMm', 'radiusStopMm', # Curvilinear only, None for linear
+  'transducerWidthMm', 'imagingDepthMm']) # Linear only, None for curvilinear
+
+scanConversionGeometryCacheSize = 256
+scanConversionGeometryCache = collections.OrderedDict()
+scanConversionGeometryCacheLock = threading.Lock()
+
+def readScanConversionGeometry(configFile):
+  '''
+  Reads the ScanConversion element of a PLUS configuration file. Results are memoized by
+  file path, modification time and size, so a configuration shared by many recordings is only parsed once.
+  :param configFile: Path of the PLUS configuration file.
+  :return: ScanConversionGeometry
+  :raises ValueError: if the file has no valid ScanConversion element.
+  '''
+  fileStat = os.stat(configFile)
+  cacheKey = (os.path.abspath(configFile), fileStat.st_mtime, fileStat.st_size)
+  with scanConversionGeometryCacheLock:
+    geometry = scanConversionGeometryCache.pop(cacheKey, None)
+  if geometry is None:
+    geometry = parseScanConversionGeometry(configFile)
+  with scanConversionGeometryCacheLock:
+    scanConversionGeometryCache[cacheKey] = geometry
+    while len(scanConversionGeometryCache) > scanConversionGeometryCacheSize:
+      scanConversionGeometryCache.popitem(last=False)
+  return geometry
+
+def parseScanConversionGeometry(configFile):
+  '''
+  Parses the ScanConversion element of a PLUS configuration file. The file is read as a stream
+  and parsing stops at the first ScanConversion element, so the rest of the configuration
+  (e.g. large DataCollection sections following it) is never processed.
+  :param configFile: Path of the PLUS configuration file.
+  :return: ScanConversionGeometry
+  :raises ValueError: if the file has no valid ScanConversion element.
+  '''
+  from xml.etree import ElementTree
+  attributes = None
+  with open(configFile, 'rb') as configStream:
+    for event, element in ElementTree.iterparse(configStream, events=('start',)):
+      if element.tag == "ScanConversion":
+        attributes = dict(element.attrib)
+        break
+  if attributes is None:
+    raise ValueError("Could not find ScanConversion element in configuration file!")
+
+  try:
+    transducerGeometry = attributes['TransducerGeometry'].upper()
+    if (transducerGeometry != "CURVILINEAR" and transducerGeometry != "LINEAR"):
+      raise ValueError("TransducerGeometry must be either CURVILINEAR or LINEAR")
+    numberOfScanlines = int(attributes['NumberOfScanLines'])
+    if (numberOfScanlines < 0):
+      raise ValueError("NumberOfScanLines: {} cannot be less than 0".format(numberOfScanlines))
+
+    curvilinearValues = [None] * 4
+    linearValues = [None] * 2
+    if (transducerGeometry == "CURVILINEAR"):
+      curvilinearValues = [float(attributes[name]) for name in ['ThetaStartDeg', 'ThetaStopDeg', 'RadiusStartMm', 'RadiusStopMm']]
+    elif (transducerGeometry == "LINEAR"):
+      linearValues = [float(attributes[name]) for name in ['TransducerWidthMm', 'ImagingDepthMm']]
+
+    return ScanConversionGeometry(
+      transducerGeometry,
+      tuple(int(value) for value in attributes['OutputImageSizePixel'].split()),
+      tuple(int(value) for value in attributes['TransducerCenterPixel'].split()),
+      tuple(float(value) for value in attributes['OutputImageSpacingMmPerPixel'].split()),
+      numberOfScanlines,
+      int(attributes['NumberOfSamplesPerScanLine']),
+      *(curvilinearValues + linearValues))
+  except KeyError as error:
+    raise ValueError("ScanConversion element is missing attribute {}".format(error))
+
+def readConfigTransform(configFile, fromFrame, toFrame):
+  '''
+  Reads a transform of the CoordinateDefinitions element of a PLUS configuration file.
+  :param configFile: Path of the PLUS configuration file.
+  :param fromFrame: Name of the From coordinate frame, e.g. "Image".
+  :param toFrame: Name of the To coordinate frame, e.g. "Probe".
+  :return: 4x4 numpy array, or None if the configuration does not define the transform.
+  '''
+  from xml.etree import ElementTree
+  with open(configFile, 'rb') as configStream:
+    for event, element in ElementTree.iterparse(configStream, events=('end',)):
+      if element.tag == "Transform" and element.get('From') == fromFrame and element.get('To') == toFrame:
+        return numpy.array([float(value) for value in element.get('Matrix').split()]).reshape(4, 4)
+  return None
@@ -0,0 +1,418 @@
+import math
+import collections
+import threading
+import numpy
+
+def rasterizeScanlines(startPoints, endPoints, imageSize, radius=0.5):
+  '''
+  Draws all scanlines into a label image at once. Pixels are set exactly like vtkImageCanvasSource2D.FillTube
+  does with truncated end points, but only the few pixels next to each scanline are tested.
+  :param startPoints: (numberOfScanlines, 2) array of scanline start points in pixels.
+  :param endPoints: (numberOfScanlines, 2) array of scanline end points in pixels.
+  :param imageSize: Image slice size in pixels as [columns, rows].
+  :param radius: Tube radius in pixels.
+  :return: (rows, columns) unsigned char array, 1 on scanlines and 0 elsewhere.
+  '''
+  a = numpy.asarray(startPoints).astype(int)
+  b = numpy.asarray(endPoints).astype(int)
+  mask = numpy.zeros((imageSize[1], imageSize[0]), dtype=numpy.uint8)
+  if len(a) == 0:
+    return mask
+
+  # Step along the major axis of each scanline, at most a few pixels across it can be in the tube
+  majorAxis = (numpy.abs(b[:, 1] - a[:, 1]) > numpy.abs(b[:, 0] - a[:, 0])).astype(int)
+  minorAxis = 1 - majorAxis
+  scanlineIndices = numpy.arange(len(a))
+  aMajor = a[scanlineIndices, majorAxis]
+  bMajor = b[scanlineIndices, majorAxis]
+  aMinor = a[scanlineIndices, minorAxis]
+  bMinor = b[scanlineIndices, minorAxis]
+  margin = int(math.ceil(radius))
+  majorStart = numpy.minimum(aMajor, bMajor) - margin
+  majorLength = numpy.abs(bMajor - aMajor) + 2 * margin + 1
+  majorSteps = numpy.arange(majorLength.max())
+  major = majorStart[:, numpy.newaxis] + majorSteps[numpy.newaxis, :]
+  slope = (bMinor - aMinor) / numpy.maximum(numpy.abs(bMajor - aMajor), 1).astype(float) * numpy.where(bMajor >= aMajor, 1, -1)
+  minorCenter = numpy.rint(aMinor[:, numpy.newaxis] + (major - aMajor[:, numpy.newaxis]) * slope[:, numpy.newaxis]).astype(int)
+  minorOffsets = numpy.arange(-margin - 1, margin + 2)
+  minor = minorCenter[:, :, numpy.newaxis] + minorOffsets[numpy.newaxis, numpy.newaxis, :]
+  major = numpy.broadcast_to(major[:, :, numpy.newaxis], minor.shape)
+  inRange = numpy.broadcast_to((majorSteps[numpy.newaxis, :] < majorLength[:, numpy.newaxis])[:, :, numpy.newaxis], minor.shape)
+
+  idx0 = numpy.where(majorAxis[:, numpy.newaxis, numpy.newaxis] == 0, major, minor)
+  idx1 = numpy.where(majorAxis[:, numpy.newaxis, numpy.newaxis] == 0, minor, major)
+  inImage = inRange & (idx0 >= 0) & (idx0 < imageSize[0]) & (idx1 >= 0) & (idx1 < imageSize[1])
+
+  # Same tests as vtkImageCanvasSource2D.FillTube
+  [a0, a1, b0, b1] = [values[:, numpy.newaxis, numpy.newaxis] for values in [a[:, 0], a[:, 1], b[:, 0], b[:, 1]]]
+  n0 = a0 - b0
+  n1 = a1 - b1
+  ak = n0 * a0 + n1 * a1
+  bk = n0 * b0 + n1 * b1
+  k = n0 * idx0 + n1 * idx1
+  fract = (k - bk) / numpy.maximum(ak - bk, 1).astype(float)
+  v0 = b0 + fract * (a0 - b0) - idx0
+  v1 = b1 + fract * (a1 - b1) - idx1
+  inTube = inImage & (k >= bk) & (k <= ak) & (v0 * v0 + v1 * v1 <= radius * radius)
+  mask[idx1[inTube], idx0[inTube]] = 1
+  return mask
+
+def bilinearSamplesInImage(samplePoints, imageSize):
+  '''
+  :return: Boolean array with the shape of samplePoints without the last axis, True where all four pixels around the sample are in the image.
+  '''
+  return ((samplePoints >= 0) & (samplePoints <= numpy.array(imageSize) - 1)).all(axis=-1)
+
+def bilinearSampleWeights(samplePoints, imageSize, inImage=None):
+  '''
+  Precomputes bilinear interpolation of images at fixed sample points, as four gathers of flat pixel indices.
+  :param samplePoints: (..., 2) array of sample points in pixel coordinates.
+  :param imageSize: Image slice size in pixels as [columns, rows].
+  :param inImage: Samples to interpolate, the ones with all four pixels in the image by default. Others read pixel 0 with zero weight.
+  :return: [flatIndices, weights], lists of the four corner pixel index arrays (row * columns + column) and float32 weight arrays.
+  '''
+  samplePoints = numpy.asarray(samplePoints, dtype=float)
+  if inImage is None:
+    inImage = bilinearSamplesInImage(samplePoints, imageSize)
+  corners = numpy.minimum(numpy.floor(samplePoints).astype(int), numpy.array(imageSize) - 2).clip(0)
+  fractions = samplePoints - corners
+  flatIndices = []
+  weights = []
+  for [offsetX, offsetY] in [[0, 0], [1, 0], [0, 1], [1, 1]]:
+    weightX = fractions[..., 0] if offsetX else 1 - fractions[..., 0]
+    weightY = fractions[..., 1] if offsetY else 1 - fractions[..., 1]
+    flatIndices.append(numpy.where(inImage, (corners[..., 1] + offsetY) * imageSize[0] + corners[..., 0] + offsetX, 0))
+    weights.append(numpy.where(inImage, weightX * weightY, 0).astype(numpy.float32))
+  return [flatIndices, weights]
+
+#
+# ScanlineLookupTable
+#
+
+class ScanlineLookupTable(object):
+  """Scanline geometry precomputed for one ScanConversion configuration and image size.
+  Instances are shared between logic objects through getScanlineLookupTable, so the
+  arrays are made read-only.
+  """
+
+  def __init__(self, startPoints, endPoints, numberOfSamplesPerScanline, imageSize):
+    '''
+    :param startPoints: (numberOfScanlines, 2) array of scanline start points in pixels.
+    :param endPoints: (numberOfScanlines, 2) array of scanline end points in pixels.
+    :param numberOfSamplesPerScanline: Samples are placed like the points of a vtkLineSource with this resolution.
+    :param imageSize: Image slice size in pixels as [columns, rows].
+    '''
+    self.startPoints = numpy.asarray(startPoints, dtype=float)
+    self.endPoints = numpy.asarray(endPoints, dtype=float)
+    self.numberOfScanlines = len(self.startPoints)
+    self.imageSize = tuple(imageSize)
+
+    directions = self.endPoints - self.startPoints
+    self.unitVectors = directions / numpy.linalg.norm(directions, axis=1)[:, numpy.newaxis]
+
+    # Sample points in pixels, shape (numberOfScanlines, numberOfSamplesPerScanline + 1, 2)
+    sampleFractions = numpy.linspace(0.0, 1.0, numberOfSamplesPerScanline + 1)
+    self.samplePoints = self.startPoints[:, numpy.newaxis, :] + sampleFractions[numpy.newaxis, :, numpy.newaxis] * directions[:, numpy.newaxis, :]
+    self.sampleIndices = self.samplePoints.astype(int)
+
+    # Inverse map from each pixel to the scanline sampling it, -1 for pixels not on any scanline.
+    # Where scanlines share a pixel (e.g. close to a curvilinear transducer) the higher scanline number is kept.
+    self.pixelToScanline = numpy.full((self.imageSize[1], self.imageSize[0]), -1, dtype=numpy.int16)
+    self.pixelToScanline[self.sampleIndices[:, :, 1], self.sampleIndices[:, :, 0]] = numpy.arange(self.numberOfScanlines)[:, numpy.newaxis]
+
+    # Label image of the scanlines, same for every frame
+    self.scanlineMask = rasterizeScanlines(self.startPoints, self.endPoints, self.imageSize)
+
+    # Bilinear interpolation at the exact sample points, for resampleScanlines
+    [bilinearIndices, bilinearWeights] = bilinearSampleWeights(self.samplePoints, self.imageSize)
+    self.bilinearIndices = numpy.array(bilinearIndices)
+    self.bilinearWeights = numpy.array(bilinearWeights)
+
+    # Flat sample indices (scanline * samples + sample) sorted by their flat pixel index (row * columns + column), for samplesAtPixels
+    samplePixels = (self.sampleIndices[:, :, 1] * self.imageSize[0] + self.sampleIndices[:, :, 0]).ravel()
+    self.sampleOrder = numpy.argsort(samplePixels, kind='mergesort')
+    self.sortedSamplePixels = samplePixels[self.sampleOrder]
+
+    for array in [self.startPoints, self.endPoints, self.unitVectors, self.samplePoints, self.sampleIndices, self.pixelToScanline, self.scanlineMask,
+                  self.bilinearIndices, self.bilinearWeights, self.sampleOrder, self.sortedSamplePixels]:
+      array.flags.writeable = False
+
+  def samplesAtPixels(self, flatPixels):
+    '''
+    Finds every scanline sample on the given pixels, e.g. to sample sparse labels without a dense image.
+    :param flatPixels: Flat pixel indices (row * columns + column).
+    :return: [pixelIndices, scanlines, samples], where pixelIndices are the positions in flatPixels of the pixels of the samples.
+    '''
+    flatPixels = numpy.asarray(flatPixels)
+    first = numpy.searchsorted(self.sortedSamplePixels, flatPixels, side='left')
+    counts = numpy.searchsorted(self.sortedSamplePixels, flatPixels, side='right') - first
+    pixelIndices = numpy.repeat(numpy.arange(len(flatPixels)), counts)
+    sampleRanks = numpy.repeat(first - numpy.cumsum(counts) + counts, counts) + numpy.arange(counts.sum())
+    [scanlines, samples] = numpy.divmod(self.sampleOrder[sampleRanks], self.sampleIndices.shape[1])
+    return [pixelIndices, scanlines, samples]
+
+
+#
+# ScanlineSampler
+#
+
+class ScanlineSampler(object):
+  """Image intensity profiles along scanlines of any direction, from precomputed pixel indices.
+  Samples are one row spacing apart along each scanline, starting at its start point and continuing
+  to the image border, so profile index times the row spacing is the depth in mm for linear and
+  curvilinear probes alike. Sampling a frame is one gather (four for linear interpolation), so every
+  probe geometry costs the same per frame.
+  """
+
+  def __init__(self, startPoints, endPoints, imageSize, outputImageSpacing, interpolation='nearest'):
+    '''
+    :param startPoints: (numberOfScanlines, 2) array of scanline start points in pixels.
+    :param endPoints: (numberOfScanlines, 2) array of scanline end points in pixels, only used for the directions.
+    :param imageSize: Image slice size in pixels as [columns, rows].
+    :param outputImageSpacing: Pixel spacing in mm as [column spacing, row spacing].
+    :param interpolation: 'nearest' takes the pixel containing the sample point, 'linear' interpolates bilinearly.
+    :raises ValueError: for an unknown interpolation.
+    '''
+    if interpolation not in ['nearest', 'linear']:
+      raise ValueError("Unknown scanline interpolation: {}".format(interpolation))
+    self.interpolation = interpolation
+    self.imageSize = tuple(imageSize)
+    startPoints = numpy.asarray(startPoints, dtype=float)
+    spacing = numpy.asarray(outputImageSpacing[:2], dtype=float)
+
+    # Pixel step of one row spacing in mm along each scanline
+    directionsMm = (numpy.asarray(endPoints, dtype=float) - startPoints) * spacing
+    steps = directionsMm / numpy.linalg.norm(directionsMm, axis=1)[:, numpy.newaxis] * spacing[1] / spacing
+
+    # Enough samples to reach the image border from every start point
+    numberOfSamples = int(numpy.ceil(numpy.hypot(self.imageSize[0] * spacing[0], self.imageSize[1] * spacing[1]) / spacing[1])) + 1
+    self.samplePoints = startPoints[:, numpy.newaxis, :] + numpy.arange(numberOfSamples)[numpy.newaxis, :, numpy.newaxis] * steps[:, numpy.newaxis, :]
+    if interpolation == 'nearest':
+      self.sampleIndices = numpy.floor(self.samplePoints).astype(int)
+      inImage = ((self.sampleIndices >= 0) & (self.sampleIndices < self.imageSize)).all(axis=2)
+    else:
+      inImage = bilinearSamplesInImage(self.samplePoints, self.imageSize)
+    numberOfSamples = max(1, int(inImage.sum(axis=1).max()))
+    self.samplePoints = self.samplePoints[:, :numberOfSamples]
+    self.inImage = inImage[:, :numberOfSamples]
+
+    # Flat pixel indices, samples outside the image read pixel 0 and are zeroed
+    if interpolation == 'nearest':
+      self.sampleIndices = self.sampleIndices[:, :numberOfSamples]
+      self.flatIndices = [numpy.where(self.inImage, self.sampleIndices[:, :, 1] * self.imageSize[0] + self.sampleIndices[:, :, 0], 0)]
+      self.weights = None
+    else:
+      [self.flatIndices, self.weights] = bilinearSampleWeights(self.samplePoints, self.imageSize, self.inImage)
+    self.numberOfScanlines = len(startPoints)
+    self.numberOfSamples = numberOfSamples
+
+  def sample(self, frame):
+    '''
+    :param frame: Image as a (rows, columns) array.
+    :return: (numberOfScanlines, numberOfSamples) array of intensities, zero beyond the image border.
+      Nearest sampling keeps the image type, linear interpolation returns float32.
+    '''
+    flatFrame = numpy.ascontiguousarray(frame).reshape(-1)
+    if self.interpolation == 'nearest':
+      profiles = flatFrame[self.flatIndices[0]]
+      profiles[~self.inImage] = 0
+      return profiles
+    profiles = self.weights[0] * flatFrame[self.flatIndices[0]]
+    for flatIndices, weights in zip(self.flatIndices[1:], self.weights[1:]):
+      profiles += weights * flatFrame[flatIndices]
+    return profiles
+
+  def pixelPositions(self, scanlineIndices, sampleIndices):
+    '''
+    :return: (len(scanlineIndices), 2) array of pixel coordinates of the samples, whole pixels for nearest sampling.
+    '''
+    if self.interpolation == 'nearest':
+      return self.sampleIndices[scanlineIndices, sampleIndices]
+    return self.samplePoints[scanlineIndices, sampleIndices]
+
+
+scanlineLookupTableCacheSize = 16
+scanlineLookupTableCache = collections.OrderedDict()
+scanlineLookupTableCacheLock = threading.Lock()
+
+def getScanlineLookupTable(geometryKey, createLookupTable):
+  '''
+  Returns the lookup table of a scanline geometry from the process-wide LRU cache.
+  :param geometryKey: Hashable key made of the ScanConversion attributes, including the image size.
+  :param createLookupTable: Called without arguments to create the lookup table when it is not cached.
+  :return: ScanlineLookupTable
+  '''
+  with scanlineLookupTableCacheLock:
+    lookupTable = scanlineLookupTableCache.pop(geometryKey, None)
+    if lookupTable is not None:
+      scanlineLookupTableCache[geometryKey] = lookupTable # Most recently used
+      return lookupTable
+  # Created without the lock, so that other geometries are not blocked meanwhile
+  createdLookupTable = createLookupTable()
+  with scanlineLookupTableCacheLock:
+    # If another thread created the same geometry meanwhile, the first table inserted is shared
+    lookupTable = scanlineLookupTableCache.pop(geometryKey, createdLookupTable)
+    while len(scanlineLookupTableCache) >= scanlineLookupTableCacheSize:
+      scanlineLookupTableCache.popitem(last=False)
+    scanlineLookupTableCache[geometryKey] = lookupTable
+  return lookupTable
+
+#
+# ScanlineGeometry
+#
+
+class ScanlineGeometry(object):
+  """Scanline positions of a ScanConversion configuration, in image pixel coordinates.
+  Only depends on numpy, so it can be used in worker processes without Slicer.
+  """
+
+  # Attributes derived from the configuration, copied by USGeometryLogic for its callers
+  parameterNames = ['transducerGeometry', 'outputImageSizePixel', 'transducerCenterPixel', 'numberOfScanlines',
+    'outputImageSpacing', 'numberOfSamplesPerScanline',
+    'thetaStartDeg', 'thetaStopDeg', 'radiusStartMm', 'radiusStopMm', 'totalDeg', 'degreesPerScanline', 'circleCenter',
+    'transducerWidthMm', 'imagingDepthMm', 'transducerWidthPixel', 'topLeftPixel', 'scanlineSpacingPixels', 'scanlineLengthPixels']
+
+  def __init__(self, scanConversionGeometry):
+    '''
+    :param scanConversionGeometry: ScanConversionGeometry, e.g. from readScanConversionGeometry.
+    :raises ValueError: if the transducer does not fit in the output image.
+    '''
+    self.scanConversionGeometry = scanConversionGeometry
+    for name in self.parameterNames:
+      setattr(self, name, None)
+
+    # Values common to both linear and curvilinear
+    self.transducerGeometry = scanConversionGeometry.transducerGeometry
+    self.outputImageSizePixel = list(scanConversionGeometry.outputImageSizePixel)
+    self.transducerCenterPixel = list(scanConversionGeometry.transducerCenterPixel)
+    self.numberOfScanlines = scanConversionGeometry.numberOfScanlines
+    self.outputImageSpacing = list(scanConversionGeometry.outputImageSpacing)
+    self.numberOfSamplesPerScanline = scanConversionGeometry.numberOfSamplesPerScanline
+
+    # Values just for curvilinear
+    if (self.transducerGeometry == "CURVILINEAR"):
+      self.thetaStartDeg = scanConversionGeometry.thetaStartDeg
+      self.thetaStopDeg = scanConversionGeometry.thetaStopDeg
+      self.radiusStartMm = scanConversionGeometry.radiusStartMm
+      self.radiusStopMm = scanConversionGeometry.radiusStopMm
+      self.totalDeg = abs(self.thetaStopDeg - self.thetaStartDeg)
+      self.degreesPerScanline = self.totalDeg / self.numberOfScanlines
+      self.circleCenter = [self.transducerCenterPixel[0], self.transducerCenterPixel[1] - self.radiusStartMm/self.outputImageSpacing[1]]
+    # Values just for linear
+    elif (self.transducerGeometry == "LINEAR"):
+      self.transducerWidthMm = scanConversionGeometry.transducerWidthMm
+      self.imagingDepthMm = scanConversionGeometry.imagingDepthMm
+      if int(self.transducerWidthMm / self.outputImageSpacing[0]) > self.outputImageSizePixel[0]:
+        newTransducerWidthMm = int(self.outputImageSizePixel[0] * self.outputImageSpacing[0])
+        raise ValueError('Transducer width: ' + str( int(self.transducerWidthMm / self.outputImageSpacing[0]) ) +
+                         ' px does not fit in output image width: ' + str( self.outputImageSizePixel[0] ) + ' px! ' +
+                         ' Try using transducer width of ' + str( newTransducerWidthMm ) + ' mm.')
+      self.transducerWidthPixel = int(self.transducerWidthMm / self.outputImageSpacing[0])
+      self.topLeftPixel = [int(self.transducerCenterPixel[0] - 0.5 * self.transducerWidthPixel), self.transducerCenterPixel[1]]
+      # There are (numberOfScanlines - 1) spaces between first and last scanline
+      self.scanlineSpacingPixels = float(self.transducerWidthPixel - 1) / (self.numberOfScanlines - 1)
+      if int(self.imagingDepthMm / self.outputImageSpacing[1]) > self.outputImageSizePixel[1]:
+        newDepthMm = self.outputImageSizePixel[1] * self.outputImageSpacing[1]
+        raise ValueError('Imaging depth: ' + str(self.imagingDepthMm) + ' mm does not fit in output image size!' +
+                         ' Try using imaging depth of ' + str(newDepthMm) + ' mm or smaller.')
+      self.scanlineLengthPixels = int(self.imagingDepthMm / self.outputImageSpacing[1])
+
+  def checkImageDimensions(self, imageDimensions):
+    '''
+    :param imageDimensions: Image size in pixels, the first two values are checked against the configuration.
+    :raises ValueError: if the image slice size is not the output image size of the configuration.
+    '''
+    if (self.outputImageSizePixel[0] != imageDimensions[0]
+        or self.outputImageSizePixel[1] != imageDimensions[1]):
+      raise ValueError("Input volume size does not correspond to size specified in configuration file.\n " \
+                       "Input volume slice: [{} {}]\n" \
+                       "Configuration file slice: [{} {}]".format(imageDimensions[0], imageDimensions[1], self.outputImageSizePixel[0], self.outputImageSizePixel[1]))
+
+  def computeScanlineEndPoints(self, scanlineNumbers):
+    '''
+    Computes the end points of several scanlines at once.
+    :param scanlineNumbers: Sequence of (possibly fractional) scanline numbers.
+    :return: [startPoints, endPoints], both (len(scanlineNumbers), 2) arrays of pixel coordinates.
+    :raises ValueError: if a scanline is outside of the output image.
+    '''
+    scanlineNumbers = numpy.asarray(scanlineNumbers, dtype=float)
+    # Compute curvilinear xy values
+    if (self.transducerGeometry == "CURVILINEAR"):
+
+      # Compute angle for desired scanlines
+      angleRadians = numpy.radians(self.thetaStartDeg + scanlineNumbers * self.degreesPerScanline)
+
+      # Compute the starting points
+      startScanlineX = self.circleCenter[0] + numpy.sin(angleRadians) * self.radiusStartMm / self.outputImageSpacing[0]
+      startScanlineY = self.circleCenter[1] + numpy.cos(angleRadians) * self.radiusStartMm / self.outputImageSpacing[1]
+
+      # Compute the ending points
+      endScanlineX = self.circleCenter[0] + numpy.sin(angleRadians) * self.radiusStopMm / self.outputImageSpacing[0]
+      endScanlineY = self.circleCenter[1] + numpy.cos(angleRadians) * self.radiusStopMm / self.outputImageSpacing[1]
+
+    # Compute linear xy values
+    else:
+      # Compute the starting points
+      startScanlineX = self.topLeftPixel[0] + scanlineNumbers * self.scanlineSpacingPixels
+      startScanlineY = numpy.full_like(scanlineNumbers, self.topLeftPixel[1])
+
+      # Compute the end points
+      endScanlineX = startScanlineX # Vertical line so same 'x' value
+      endScanlineY = numpy.full_like(scanlineNumbers, self.topLeftPixel[1] + self.scanlineLengthPixels)
+
+    # Verify acceptable starting and ending points for scanlines
+    for pointName, values, size in [("starting point X", startScanlineX, self.outputImageSizePixel[0]),
+                                    ("starting point Y", startScanlineY, self.outputImageSizePixel[1]),
+                                    ("ending point X", endScanlineX, self.outputImageSizePixel[0]),
+                                    ("ending point Y", endScanlineY, self.outputImageSizePixel[1])]:
+      outOfBounds = (values < 0) | (values > size - 1)
+      if outOfBounds.any():
+        raise ValueError("Scanline {} value: {} out of bounds!".format(pointName, values[outOfBounds][0]))
+
+    # Combine XY values and return
+    startPoints = numpy.column_stack([startScanlineX, startScanlineY])
+    endPoints = numpy.column_stack([endScanlineX, endScanlineY])
+
+    return [startPoints, endPoints]
+
+  def createLookupTable(self):
+    [startPoints, endPoints] = self.computeScanlineEndPoints(numpy.arange(self.numberOfScanlines))
+    return ScanlineLookupTable(startPoints, endPoints, self.numberOfSamplesPerScanline, self.outputImageSizePixel[:2])
+
+  def getLookupTable(self):
+    '''
+    :return: ScanlineLookupTable of all scanlines, shared by every geometry with the same configuration.
+    '''
+    return getScanlineLookupTable(self.scanConversionGeometry, self.createLookupTable)
+
+def sampleScanlines(volumeArray, sampleIndices):
+  '''
+  Gathers the scanline samples of every frame in a single indexing operation.
+  :param volumeArray: Volume voxels as a (frames, rows, columns) array.
+  :param sampleIndices: Sample pixel indices of a ScanlineLookupTable.
+  :return: Array of shape (frames, numberOfScanlines, numberOfSamplesPerScanline + 1).
+  '''
+  return volumeArray[:, sampleIndices[:, :, 1], sampleIndices[:, :, 0]]
+
+def resampleScanlines(volumeArray, lookupTable, outputArray=None):
+  '''
+  Resamples a scan converted volume back into scanlines, interpolating bilinearly at the exact sample points
+  instead of truncating them to pixels. Each scanline of a frame is a contiguous row of the result.
+  :param volumeArray: Volume voxels as a (frames, rows, columns) array.
+  :param lookupTable: ScanlineLookupTable of the image geometry.
+  :param outputArray: Optional float32 array of the result shape to fill.
+  :return: float32 array of shape (frames, numberOfScanlines, numberOfSamplesPerScanline + 1).
+  '''
+  resampledShape = (volumeArray.shape[0],) + lookupTable.samplePoints.shape[:2]
+  if outputArray is None:
+    outputArray = numpy.empty(resampledShape, dtype=numpy.float32)
+  elif outputArray.shape != resampledShape:
+    raise ValueError("Resampled scanlines size {} does not match {}".format(outputArray.shape, resampledShape))
+  for frameIndex in range(volumeArray.shape[0]):
+    # One frame at a time keeps the gathered corners in cache
+    flatFrame = numpy.ascontiguousarray(volumeArray[frameIndex]).reshape(-1)
+    frameOutput = outputArray[frameIndex]
+    numpy.multiply(lookupTable.bilinearWeights[0], flatFrame[lookupTable.bilinearIndices[0]], out=frameOutput)
+    for corner in range(1, 4):
+      frameOutput += lookupTable.bilinearWeights[corner] * flatFrame[lookupTable.bilinearIndices[corner]]
+  return outputArray
@@ -0,0 +1,94 @@
+import threading
+import multiprocessing
+import multiprocessing.pool
+import numpy
+
+from .MetaImageSequence import MetaImageSequence
+
+#
+# SegmentationMerging
+#
+
+def summedSegmentationType(segmentationType, numberOfSegmentations):
+  '''
+  :return: Smallest integer type that can hold the sum of numberOfSegmentations images of segmentationType without overflow.
+  '''
+  typeInfo = numpy.iinfo(segmentationType)
+  largestSum = int(typeInfo.max) * numberOfSegmentations
+  smallestSum = int(typeInfo.min) * numberOfSegmentations
+  for summedType in [numpy.uint16, numpy.uint32, numpy.uint64] if smallestSum >= 0 else [numpy.int16, numpy.int32, numpy.int64]:
+    if numpy.iinfo(summedType).max >= largestSum and numpy.iinfo(summedType).min <= smallestSum:
+      return numpy.dtype(summedType)
+  raise ValueError("Sum of {} segmentations does not fit in a 64 bit integer".format(numberOfSegmentations))
+
+def narrowSegmentationSum(summedValues, segmentationType):
+  '''
+  :param summedValues: Sum of segmentations, in the type from summedSegmentationType.
+  :return: summedValues as segmentationType if every value fits in it, so that e.g. the sum of a few binary
+    label maps has the type of the label maps, otherwise summedValues unchanged.
+  '''
+  typeInfo = numpy.iinfo(segmentationType)
+  if summedValues.size == 0 or (summedValues.min() >= typeInfo.min and summedValues.max() <= typeInfo.max):
+    return summedValues.astype(segmentationType)
+  return summedValues
+
+def openSegmentationFiles(segmentationFiles):
+  '''
+  Reads and checks the headers of segmentation files to be summed, without reading any pixel data.
+  :return: [segmentations, summedShape, segmentationType, summedType], the MetaImageSequence of every file, the size of their sum,
+    their common type, and the type that holds their sum without overflow.
+  :raises ValueError: if there are no files, or their image sizes or types are different.
+  '''
+  if not segmentationFiles:
+    raise ValueError("No segmentation files to sum")
+  segmentations = [MetaImageSequence(segmentationFile) for segmentationFile in segmentationFiles]
+  summedShape = (segmentations[0].numberOfFrames,) + segmentations[0].frameShape
+  for segmentation in segmentations:
+    shape = (segmentation.numberOfFrames,) + segmentation.frameShape
+    if shape != summedShape:
+      raise ValueError("Segmentation {} has size {}, but {} has size {}".format(
+        segmentation.fileName, shape, segmentations[0].fileName, summedShape))
+    if not numpy.issubdtype(segmentation.dtype, numpy.integer):
+      raise ValueError("Segmentation {} is not an integer image".format(segmentation.fileName))
+  segmentationType = numpy.result_type(*[segmentation.dtype for segmentation in segmentations])
+  return [segmentations, summedShape, segmentationType, summedSegmentationType(segmentationType, len(segmentations))]
+
+def sumSegmentationFiles(segmentationFiles, numberOfWorkers=None):
+  '''
+  Sums segmentation MetaImage files, e.g. manual segmentations of the same recording by several raters.
+  Files are decoded concurrently on a thread pool, and every decoded frame is added in place to one
+  summed image, so memory use does not grow with the number of files. File reading, decompression
+  and numpy additions release the interpreter lock, so the threads run in parallel.
+  The logic sums with sumSparseSegmentationFiles, which keeps only the labeled voxels; this dense sum stays
+  supported for callers that need the whole array, e.g. cachedSumSegmentationFiles(sparse=False), and is the
+  reference the sparse sum is tested against.
+  :param segmentationFiles: Paths of the segmentation files.
+  :param numberOfWorkers: Number of files decoded at a time, the number of processors by default.
+  :return: (frames, rows, columns) array of the type of the segmentations if the sum fits in it, otherwise of a
+    wide enough integer type to hold the sum.
+  :raises ValueError: if there are no files, or their image sizes or types are different.
+  '''
+  [segmentations, summedShape, segmentationType, summedType] = openSegmentationFiles(segmentationFiles)
+  summedImage = numpy.zeros(summedShape, dtype=summedType)
+  frameLocks = [threading.Lock() for frameIndex in range(summedShape[0])]
+
+  def addSegmentation(segmentation):
+    for frameIndex, frame in enumerate(segmentation.iterFrames()):
+      with frameLocks[frameIndex]:
+        summedImage[frameIndex] += frame
+
+  if numberOfWorkers is None:
+    numberOfWorkers = multiprocessing.cpu_count()
+  numberOfWorkers = max(1, min(numberOfWorkers, len(segmentations)))
+  if numberOfWorkers == 1:
+    for segmentation in segmentations:
+      addSegmentation(segmentation)
+    return narrowSegmentationSum(summedImage, segmentationType)
+
+  pool = multiprocessing.pool.ThreadPool(numberOfWorkers)
+  try:
+    pool.map(addSegmentation, segmentations, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+  return narrowSegmentationSum(summedImage, segmentationType)
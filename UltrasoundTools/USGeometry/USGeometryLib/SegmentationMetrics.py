@@ -0,0 +1,240 @@
+import collections
+import numpy
+
+
+#
+# SegmentationMetrics
+#
+
+SegmentationMetrics = collections.namedtuple('SegmentationMetrics', [
+  'truePositive', 'falsePositive', 'falseNegative', # Percentages, None if there are no points to compare
+  'totalAlgorithmSegmentationPoints', 'pointsWithinAcceptableRegion', 'pointsWithinRequiredRegion', 'scanlinesWithSegmentation',
+  'hasGroundTruth', 'xMean', 'yMean', # Per scanline of every frame, shape (frames, scanlines)
+  'falseNegativeRegionDistance', 'acceptableDistance']) # Region half widths in pixels along the scanline
+
+ScanlineStatistics = collections.namedtuple('ScanlineStatistics', [
+  'hasGroundTruth', 'xMean', 'yMean', 'std', # Ground truth per scanline of every frame, shape (frames, scanlines)
+  'algorithmFrames', 'algorithmScanlines', 'algorithmDistances', # Per algorithm segmentation sample on the scanlines
+  'unitVectorLengthMm']) # Length in mm of one pixel step along each scanline
+
+ScanlineGroundTruth = collections.namedtuple('ScanlineGroundTruth', [
+  'frames', 'scanlines', 'samples', # Sample position of every scanline sample on the ground truth
+  'counts', # Number of raters that segmented each of those samples
+  'numberOfFrames', 'numberOfScanlines'])
+
+def nonzeroScanlineSamples(labels, lookupTable):
+  '''
+  Finds the scanline samples on a label volume. Dense volumes are sampled one frame at a time, so that memory only
+  grows with the number of labeled samples; sparse volumes only look up their labeled voxels.
+  :param labels: Label volume as a (frames, rows, columns) array, or a SparseLabelVolume.
+  :param lookupTable: ScanlineLookupTable of the image geometry.
+  :return: [frames, scanlines, samples, values] arrays of the nonzero samples, ordered by frame, scanline and sample.
+  '''
+  if hasattr(labels, 'nonzeroScanlineSamples'):
+    return labels.nonzeroScanlineSamples(lookupTable)
+  sampleRows = lookupTable.sampleIndices[:, :, 1]
+  sampleColumns = lookupTable.sampleIndices[:, :, 0]
+  [frames, scanlines, samples, values] = [[], [], [], []]
+  for frameIndex in range(labels.shape[0]):
+    frameSamples = labels[frameIndex][sampleRows, sampleColumns]
+    [frameScanlines, frameSampleIndices] = numpy.nonzero(frameSamples)
+    frames.append(numpy.full(len(frameScanlines), frameIndex, dtype=numpy.intp))
+    scanlines.append(frameScanlines)
+    samples.append(frameSampleIndices)
+    values.append(frameSamples[frameScanlines, frameSampleIndices])
+  if not frames:
+    return [numpy.zeros(0, dtype=numpy.intp)] * 3 + [numpy.zeros(0, dtype=labels.dtype)]
+  return [numpy.concatenate(frames), numpy.concatenate(scanlines), numpy.concatenate(samples), numpy.concatenate(values)]
+
+def computeScanlineGroundTruth(summedArray, lookupTable):
+  '''
+  :param summedArray: Summed manual segmentations as a (frames, rows, columns) array or SparseLabelVolume.
+  :param lookupTable: ScanlineLookupTable of the image geometry.
+  :return: ScanlineGroundTruth, the rater count of every segmented scanline sample.
+  '''
+  [frames, scanlines, samples, counts] = nonzeroScanlineSamples(summedArray, lookupTable)
+  return ScanlineGroundTruth(frames, scanlines, samples, counts, summedArray.shape[0], lookupTable.numberOfScanlines)
+
+def computeScanlineStatistics(summedArray, algorithmArray, lookupTable, outputImageSpacing, groundTruth=None):
+  '''
+  Computes everything of the segmentation metrics that does not depend on the false negative distance.
+  Only the segmented samples are stored, each with its rater count as weight, so memory does not depend on
+  the number of raters or the length of the scanlines.
+  :param summedArray: Summed manual segmentations as a (frames, rows, columns) array or SparseLabelVolume. Not used if groundTruth is given.
+  :param algorithmArray: Algorithm segmentation as a (frames, rows, columns) array or SparseLabelVolume, nonzero on the segmentation.
+  :param lookupTable: ScanlineLookupTable of the image geometry.
+  :param outputImageSpacing: Pixel spacing in mm as [column spacing, row spacing].
+  :param groundTruth: ScanlineGroundTruth computed before, e.g. to compare several algorithms to the same ground truth.
+  :return: ScanlineStatistics
+  '''
+  if groundTruth is None:
+    groundTruth = computeScanlineGroundTruth(summedArray, lookupTable)
+  sampleX = lookupTable.sampleIndices[:, :, 0]
+  sampleY = lookupTable.sampleIndices[:, :, 1]
+  scanlineShape = (groundTruth.numberOfFrames, groundTruth.numberOfScanlines)
+  numberOfScanlineFrames = scanlineShape[0] * scanlineShape[1]
+
+  # Weighted sums of every scanline of every frame in closed form
+  scanlineIndices = groundTruth.frames * scanlineShape[1] + groundTruth.scanlines
+  weights = groundTruth.counts.astype(float)
+  groundTruthX = sampleX[groundTruth.scanlines, groundTruth.samples]
+  groundTruthY = sampleY[groundTruth.scanlines, groundTruth.samples]
+  def scanlineSums(values):
+    return numpy.bincount(scanlineIndices, weights=values, minlength=numberOfScanlineFrames).reshape(scanlineShape)
+
+  # Mean ground truth point, each sample weighted by its overlap count. The mean is floored to a whole pixel,
+  # as the integer division of the pixel index sums did in the per scanline implementation
+  groundTruthTotals = scanlineSums(weights)
+  hasGroundTruth = groundTruthTotals > 0
+  safeTotals = numpy.where(hasGroundTruth, groundTruthTotals, 1.0)
+  integerTotals = numpy.rint(safeTotals).astype(numpy.int64)
+  xMean = (numpy.rint(scanlineSums(weights * groundTruthX)).astype(numpy.int64) // integerTotals).astype(float)
+  yMean = (numpy.rint(scanlineSums(weights * groundTruthY)).astype(numpy.int64) // integerTotals).astype(float)
+
+  # Standard deviation of the ground truth distances from the mean point
+  groundTruthDistances = numpy.sqrt((groundTruthX - xMean.flat[scanlineIndices]) ** 2 + (groundTruthY - yMean.flat[scanlineIndices]) ** 2)
+  meanDistance = scanlineSums(weights * groundTruthDistances) / safeTotals
+  std = numpy.sqrt(scanlineSums(weights * (groundTruthDistances - meanDistance.flat[scanlineIndices]) ** 2) / safeTotals)
+  std += 1 # This is so that when calculating true positive point from the false negative point we only extend further (ie. std of 0 means the true positive point is at same point, and > 0 moves out from false negative point)
+
+  # Algorithm segmentation point distances to the mean point
+  [algorithmFrames, algorithmScanlines, algorithmSampleIndices] = nonzeroScanlineSamples(algorithmArray, lookupTable)[:3]
+  algorithmDistances = numpy.sqrt((sampleX[algorithmScanlines, algorithmSampleIndices] - xMean[algorithmFrames, algorithmScanlines]) ** 2 +
+                                  (sampleY[algorithmScanlines, algorithmSampleIndices] - yMean[algorithmFrames, algorithmScanlines]) ** 2)
+
+  unitVectors = lookupTable.unitVectors
+  unitVectorLengthMm = numpy.sqrt((unitVectors[:, 0] * outputImageSpacing[0]) ** 2 + (unitVectors[:, 1] * outputImageSpacing[1]) ** 2)
+
+  return ScanlineStatistics(hasGroundTruth, xMean, yMean, std, algorithmFrames, algorithmScanlines, algorithmDistances, unitVectorLengthMm)
+
+def evaluateScanlineStatistics(statistics, falseNegativeDistance):
+  '''
+  Computes the segmentation metrics for one false negative distance. Only compares the algorithm
+  segmentation samples to the distance thresholds, so it is cheap to call for many distances.
+  :param statistics: ScanlineStatistics
+  :param falseNegativeDistance: Distance in mm.
+  :return: SegmentationMetrics
+  '''
+  hasGroundTruth = statistics.hasGroundTruth
+  frames = statistics.algorithmFrames
+  scanlines = statistics.algorithmScanlines
+  distances = statistics.algorithmDistances
+
+  # Factor the unit vector of each scanline needs to be multiplied by to get to false negative distance
+  unitVectorFactor = falseNegativeDistance / statistics.unitVectorLengthMm
+  falseNegativeRegionDistance = numpy.broadcast_to(unitVectorFactor[numpy.newaxis, :], hasGroundTruth.shape)
+  acceptableDistance = unitVectorFactor[numpy.newaxis, :] * statistics.std
+
+  withinAcceptableRegion = hasGroundTruth[frames, scanlines] & (distances <= acceptableDistance[frames, scanlines])
+  withinRequiredRegion = distances < unitVectorFactor[scanlines]
+  requiredRegionIdentified = numpy.zeros(hasGroundTruth.shape, dtype=bool)
+  requiredRegionIdentified[frames[withinRequiredRegion], scanlines[withinRequiredRegion]] = True
+  requiredRegionIdentified &= hasGroundTruth
+
+  totalAlgorithmSegmentationPoints = len(distances)
+  pointsWithinAcceptableRegion = int(withinAcceptableRegion.sum())
+  falsePositivePoints = totalAlgorithmSegmentationPoints - pointsWithinAcceptableRegion
+  pointsWithinRequiredRegion = int(requiredRegionIdentified.sum())
+  scanlinesWithSegmentation = int(hasGroundTruth.sum())
+
+  [truePositiveValue, falsePositiveValue, falseNegativeValue] = [None, None, None]
+  if totalAlgorithmSegmentationPoints > 0 and scanlinesWithSegmentation > 0:
+    truePositiveValue = float(pointsWithinAcceptableRegion) / float(totalAlgorithmSegmentationPoints) * 100
+    falsePositiveValue = float(falsePositivePoints) / float(totalAlgorithmSegmentationPoints) * 100
+    falseNegativeValue = (1 - float(pointsWithinRequiredRegion) / float(scanlinesWithSegmentation)) * 100
+
+  return SegmentationMetrics(truePositiveValue, falsePositiveValue, falseNegativeValue,
+    totalAlgorithmSegmentationPoints, pointsWithinAcceptableRegion, pointsWithinRequiredRegion, scanlinesWithSegmentation,
+    hasGroundTruth, statistics.xMean, statistics.yMean, falseNegativeRegionDistance, acceptableDistance)
+
+def computeMetricsCurve(statistics, falseNegativeDistances):
+  '''
+  Evaluates the segmentation metrics over a range of false negative distances, e.g. for an ROC-style curve.
+  :param statistics: ScanlineStatistics
+  :param falseNegativeDistances: Distances in mm.
+  :return: (len(falseNegativeDistances), 4) array of distance, true positive, false positive and false negative percentages,
+    NaN where there are no points to compare.
+  '''
+  curve = numpy.full((len(falseNegativeDistances), 4), numpy.nan)
+  for distanceIndex, falseNegativeDistance in enumerate(falseNegativeDistances):
+    metrics = evaluateScanlineStatistics(statistics, falseNegativeDistance)
+    curve[distanceIndex, 0] = falseNegativeDistance
+    if metrics.truePositive is not None:
+      curve[distanceIndex, 1:] = [metrics.truePositive, metrics.falsePositive, metrics.falseNegative]
+  return curve
+
+# Labels of the metrics label map
+meanPointLabel = 255
+falseNegativeRegionLabel = 1
+acceptableRegionLabel = 2
+
+def metricsLabelMap(metrics, unitVectors, labelMapShape, regionLines=False, labelMap=None):
+  '''
+  Draws the mean ground truth point and the false negative and acceptable regions of every scanline with
+  ground truth, all scanlines at once.
+  :param metrics: SegmentationMetrics
+  :param unitVectors: Scanline unit vectors of the ScanlineLookupTable, in pixels.
+  :param labelMapShape: Label map size as (frames, rows, columns).
+  :param regionLines: Draw the regions as lines along the scanlines, instead of only their edge points.
+  :param labelMap: uint8 array of labelMapShape to draw into, e.g. a view of an image node. A new array by default.
+  :return: Label map with meanPointLabel, falseNegativeRegionLabel and acceptableRegionLabel, zero elsewhere.
+  '''
+  if labelMap is None:
+    labelMap = numpy.zeros(labelMapShape, dtype=numpy.uint8)
+  else:
+    labelMap[...] = 0
+  [frames, scanlines] = numpy.nonzero(metrics.hasGroundTruth)
+  xMean = metrics.xMean[frames, scanlines]
+  yMean = metrics.yMean[frames, scanlines]
+  regionDistances = [metrics.falseNegativeRegionDistance[frames, scanlines], metrics.acceptableDistance[frames, scanlines]]
+  regionLabels = [falseNegativeRegionLabel, acceptableRegionLabel]
+  numberOfPoints = len(frames)
+
+  if regionLines:
+    # Acceptable region lines first, then the false negative regions and mean points drawn over them
+    [pointIndices, offsets, labels] = [[], [], []]
+    for regionDistance, regionLabel in reversed(list(zip(regionDistances, regionLabels))):
+      # Whole pixel steps along the scanline, and the region edges
+      halfLengths = numpy.ceil(regionDistance).astype(numpy.intp)
+      counts = 2 * halfLengths + 1
+      starts = numpy.cumsum(counts) - counts
+      steps = numpy.arange(counts.sum()) - numpy.repeat(starts + halfLengths, counts)
+      regionPointIndices = numpy.repeat(numpy.arange(numberOfPoints), counts)
+      pointIndices.append(regionPointIndices)
+      offsets.append(numpy.clip(steps, -regionDistance[regionPointIndices], regionDistance[regionPointIndices]))
+      labels.append(numpy.full(len(steps), regionLabel, dtype=numpy.uint8))
+    pointIndices.append(numpy.arange(numberOfPoints))
+    offsets.append(numpy.zeros(numberOfPoints))
+    labels.append(numpy.full(numberOfPoints, meanPointLabel, dtype=numpy.uint8))
+    [pointIndices, offsets, labels] = [numpy.concatenate(pointIndices), numpy.concatenate(offsets), numpy.concatenate(labels)]
+  else:
+    # Mean point, then the false negative and acceptable region edges of every scanline
+    pointIndices = numpy.repeat(numpy.arange(numberOfPoints), 5)
+    offsets = numpy.column_stack([numpy.zeros(numberOfPoints), regionDistances[0], -regionDistances[0], regionDistances[1], -regionDistances[1]]).ravel()
+    labels = numpy.tile(numpy.array([meanPointLabel] + [falseNegativeRegionLabel] * 2 + [acceptableRegionLabel] * 2, dtype=numpy.uint8), numberOfPoints)
+
+  pointScanlines = scanlines[pointIndices]
+  x = (xMean[pointIndices] + offsets * unitVectors[pointScanlines, 0]).astype(numpy.intp)
+  y = (yMean[pointIndices] + offsets * unitVectors[pointScanlines, 1]).astype(numpy.intp)
+  inImage = (x >= 0) & (x < labelMapShape[2]) & (y >= 0) & (y < labelMapShape[1])
+  voxelIndices = (frames[pointIndices[inImage]] * labelMapShape[1] + y[inImage]) * labelMapShape[2] + x[inImage]
+  # Where points overlap, the last one drawn is kept
+  [voxelIndices, lastIndices] = numpy.unique(voxelIndices[::-1], return_index=True)
+  labelMap.reshape(-1)[voxelIndices] = labels[inImage][::-1][lastIndices]
+  return labelMap
+
+def computeSegmentationMetrics(summedArray, algorithmArray, lookupTable, outputImageSpacing, falseNegativeDistance):
+  '''
+  Compares an algorithm segmentation to merged manual segmentations along every scanline of every frame.
+  The mean manual segmentation point of a scanline is the ground truth; algorithm points closer to it than the
+  spread of the manual points are true positives, and a scanline is a false negative if no algorithm point is
+  within falseNegativeDistance of it.
+  :param summedArray: Summed manual segmentations as a (frames, rows, columns) array.
+  :param algorithmArray: Algorithm segmentation as a (frames, rows, columns) array, nonzero on the segmentation.
+  :param lookupTable: ScanlineLookupTable of the image geometry.
+  :param outputImageSpacing: Pixel spacing in mm as [column spacing, row spacing].
+  :param falseNegativeDistance: Distance in mm.
+  :return: SegmentationMetrics
+  '''
+  statistics = computeScanlineStatistics(summedArray, algorithmArray, lookupTable, outputImageSpacing)
+  return evaluateScanlineStatistics(statistics, falseNegativeDistance)
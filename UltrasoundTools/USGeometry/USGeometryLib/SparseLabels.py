@@ -0,0 +1,161 @@
+import multiprocessing
+import multiprocessing.pool
+import numpy
+
+from .MetaImageSequence import MetaImageSequence
+from .SegmentationMerging import openSegmentationFiles, narrowSegmentationSum
+
+#
+# SparseLabelVolume
+#
+
+class SparseLabelVolume(object):
+  """Label volume stored as the flat voxel indices and values of its nonzero voxels.
+  Bone surface segmentations are thin curves, a few pixels per image column, so this takes orders
+  of magnitude less memory and disk space than the dense volume. Dense arrays are only needed at the
+  scene boundary, see fromDense and toDense.
+  """
+
+  def __init__(self, shape, indices, values):
+    '''
+    :param shape: Volume size as (frames, rows, columns).
+    :param indices: Sorted, unique flat voxel indices ((frame * rows + row) * columns + column) of the nonzero voxels.
+    :param values: Label values of those voxels.
+    '''
+    self.shape = tuple(int(size) for size in shape)
+    self.indices = numpy.asarray(indices, dtype=numpy.int64)
+    self.values = numpy.asarray(values)
+    self.frameSize = self.shape[1] * self.shape[2]
+
+  @property
+  def dtype(self):
+    return self.values.dtype
+
+  @property
+  def nbytes(self):
+    return self.indices.nbytes + self.values.nbytes
+
+  @classmethod
+  def fromFrames(cls, frames, shape, dtype):
+    '''
+    :param frames: Iterable of (rows, columns) arrays, e.g. MetaImageSequence.iterFrames(), so that the dense volume is never in memory.
+    '''
+    if len(shape) != 3:
+      raise ValueError("Label volume size {} is not (frames, rows, columns)".format(tuple(shape)))
+    [indices, values] = [[], []]
+    for frameIndex, frame in enumerate(frames):
+      frameIndices = numpy.flatnonzero(frame)
+      indices.append(frameIndices + frameIndex * shape[1] * shape[2])
+      values.append(frame.ravel()[frameIndices])
+    if not indices:
+      return cls(shape, numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=dtype))
+    return cls(shape, numpy.concatenate(indices), numpy.concatenate(values).astype(dtype, copy=False))
+
+  @classmethod
+  def fromDense(cls, volumeArray):
+    '''
+    :param volumeArray: Label volume as a (frames, rows, columns) array.
+    '''
+    return cls.fromFrames(volumeArray, volumeArray.shape, volumeArray.dtype)
+
+  @classmethod
+  def fromFile(cls, fileName):
+    '''
+    Reads a label MetaImage file one frame at a time.
+    '''
+    sequence = MetaImageSequence(fileName)
+    return cls.fromFrames(sequence.iterFrames(), (sequence.numberOfFrames,) + sequence.frameShape, sequence.dtype)
+
+  def toDense(self, dtype=None):
+    '''
+    :return: (frames, rows, columns) array.
+    '''
+    volumeArray = numpy.zeros(self.shape, dtype=dtype or self.dtype)
+    volumeArray.reshape(-1)[self.indices] = self.values
+    return volumeArray
+
+  def frame(self, frameIndex):
+    '''
+    :return: Dense (rows, columns) array of one frame.
+    '''
+    [first, last] = numpy.searchsorted(self.indices, [frameIndex * self.frameSize, (frameIndex + 1) * self.frameSize])
+    frameArray = numpy.zeros(self.shape[1:], dtype=self.dtype)
+    frameArray.reshape(-1)[self.indices[first:last] - frameIndex * self.frameSize] = self.values[first:last]
+    return frameArray
+
+  def nonzeroScanlineSamples(self, lookupTable):
+    '''
+    Finds the scanline samples on the labeled voxels without a dense volume.
+    :param lookupTable: ScanlineLookupTable of the image geometry.
+    :return: [frames, scanlines, samples, values] arrays of the nonzero samples, ordered by frame, scanline and sample.
+    '''
+    [frames, pixels] = numpy.divmod(self.indices, self.frameSize)
+    [voxelIndices, scanlines, samples] = lookupTable.samplesAtPixels(pixels)
+    frames = frames[voxelIndices]
+    numberOfSamples = lookupTable.sampleIndices.shape[1]
+    order = numpy.argsort((frames * lookupTable.numberOfScanlines + scanlines) * numberOfSamples + samples, kind='mergesort')
+    return [frames[order], scanlines[order], samples[order], self.values[voxelIndices[order]]]
+
+  def save(self, fileName):
+    numpy.savez_compressed(fileName, shape=numpy.array(self.shape), indices=self.indices, values=self.values)
+
+  @classmethod
+  def load(cls, fileName):
+    with numpy.load(fileName) as arrays:
+      return cls(arrays['shape'], arrays['indices'], arrays['values'])
+
+  def __eq__(self, other):
+    return (isinstance(other, SparseLabelVolume) and self.shape == other.shape and
+            numpy.array_equal(self.indices, other.indices) and numpy.array_equal(self.values, other.values))
+
+  def __ne__(self, other):
+    return not self == other
+
+#
+# Sparse merging
+#
+
+def sumSparseLabels(labelVolumes, summedType=None):
+  '''
+  :param labelVolumes: SparseLabelVolume list of the same shape.
+  :param summedType: Type of the summed values, the common type of the inputs by default.
+  :return: SparseLabelVolume of the voxelwise sum, without the voxels that sum to zero.
+  '''
+  shape = labelVolumes[0].shape
+  for labelVolume in labelVolumes:
+    if labelVolume.shape != shape:
+      raise ValueError("Label volume size {} does not match {}".format(labelVolume.shape, shape))
+  if summedType is None:
+    summedType = numpy.result_type(*[labelVolume.dtype for labelVolume in labelVolumes])
+  indices = numpy.concatenate([labelVolume.indices for labelVolume in labelVolumes])
+  values = numpy.concatenate([labelVolume.values.astype(numpy.int64) for labelVolume in labelVolumes])
+  [summedIndices, inverse] = numpy.unique(indices, return_inverse=True)
+  summedValues = numpy.zeros(len(summedIndices), dtype=numpy.int64)
+  numpy.add.at(summedValues, inverse, values)
+  nonzero = summedValues != 0
+  return SparseLabelVolume(shape, summedIndices[nonzero], summedValues[nonzero].astype(summedType))
+
+def sumSparseSegmentationFiles(segmentationFiles, numberOfWorkers=None):
+  '''
+  Sums segmentation MetaImage files like sumSegmentationFiles, but only keeps the labeled voxels in memory.
+  :param segmentationFiles: Paths of the segmentation files.
+  :param numberOfWorkers: Number of files decoded at a time, the number of processors by default.
+  :return: SparseLabelVolume of the same type as sumSegmentationFiles.
+  :raises ValueError: if there are no files, or their image sizes or types are different.
+  '''
+  [segmentations, summedShape, segmentationType, summedType] = openSegmentationFiles(segmentationFiles)
+  readSegmentation = lambda segmentation: SparseLabelVolume.fromFrames(segmentation.iterFrames(), summedShape, segmentation.dtype)
+  if numberOfWorkers is None:
+    numberOfWorkers = multiprocessing.cpu_count()
+  numberOfWorkers = max(1, min(numberOfWorkers, len(segmentations)))
+  if numberOfWorkers == 1:
+    labelVolumes = [readSegmentation(segmentation) for segmentation in segmentations]
+  else:
+    pool = multiprocessing.pool.ThreadPool(numberOfWorkers)
+    try:
+      labelVolumes = pool.map(readSegmentation, segmentations, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+  summedLabels = sumSparseLabels(labelVolumes, summedType)
+  return SparseLabelVolume(summedShape, summedLabels.indices, narrowSegmentationSum(summedLabels.values, segmentationType))
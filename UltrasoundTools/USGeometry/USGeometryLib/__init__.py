@@ -0,0 +1,8 @@
+from .MetaImageSequence import MetaImageSequence
+from .ScanConversion import ScanConversionGeometry, readScanConversionGeometry, readConfigTransform
+from .ScanlineGeometry import ScanlineGeometry, ScanlineLookupTable, ScanlineSampler, rasterizeScanlines, sampleScanlines, resampleScanlines
+from .SegmentationMetrics import SegmentationMetrics, ScanlineStatistics, ScanlineGroundTruth, computeSegmentationMetrics, computeScanlineGroundTruth, computeScanlineStatistics, evaluateScanlineStatistics, computeMetricsCurve
+from .MetricsTable import computeScanlineMetricsTable, computeFrameMetricsTable, saveMetricsTable, loadMetricsTable, writeMetricsTableCsv
+from .Profiling import Profiler, profiledMethod
+from .SparseLabels import SparseLabelVolume, sumSparseLabels, sumSparseSegmentationFiles
+from .ArrayDiskCache import ArrayDiskCache, cachedSumSegmentationFiles, cachedResampleScanlines